@@ -0,0 +1,178 @@
+"""
+Local stand-in for the Open-Meteo forecast API, for benchmarks.
+
+Answers GET /v1/forecast with deterministic current_weather payloads, one per
+comma-separated coordinate (a list for several, an object for one, like the
+real API). Latency, server errors and 429 throttling can be injected:
+
+    python benchmarks/fake_open_meteo.py --port 8090 --latency-ms 50 \\
+        --jitter-ms 20 --error-rate 0.01 --throttle-rate 0.02 --retry-after 1
+
+Point the app at it with OPEN_METEO_URL=http://127.0.0.1:8090/v1/forecast.
+"""
+import argparse
+import json
+import random
+import threading
+import time
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+def current_weather(latitude, longitude, now):
+    # stable for a given coordinate and quarter hour, like the real feed
+    seed = hash((round(latitude, 4), round(longitude, 4), now.hour, now.minute // 15))
+    rng = random.Random(seed)
+    return {
+        "latitude": latitude,
+        "longitude": longitude,
+        "generationtime_ms": 0.1,
+        "utc_offset_seconds": 0,
+        "timezone": "GMT",
+        "elevation": 0.0,
+        "current_weather": {
+            "time": now.strftime("%Y-%m-%dT%H:") + "%02d" % (now.minute - now.minute % 15),
+            "temperature": round(rng.uniform(-20, 40), 1),
+            "windspeed": round(rng.uniform(0, 60), 1),
+            "winddirection": rng.randrange(360),
+            "weathercode": rng.choice([0, 1, 2, 3, 45, 61, 71, 95]),
+            "is_day": 1,
+        },
+    }
+
+
+class Stats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = {"requests": 0, "locations": 0, "ok": 0, "errors": 0, "throttled": 0, "bad_request": 0}
+
+    def add(self, **counts):
+        with self.lock:
+            for key, value in counts.items():
+                self.counts[key] += value
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.counts)
+
+
+class FakeOpenMeteoHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server_version = "FakeOpenMeteo/1.0"
+
+    def log_message(self, format, *args):
+        if self.server.options.verbose:
+            super().log_message(format, *args)
+
+    def send_json(self, status, body, headers=None):
+        content = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(content)
+
+    def do_GET(self):
+        options = self.server.options
+        stats = self.server.stats
+        url = urlparse(self.path)
+
+        if url.path == "/stats":
+            return self.send_json(200, stats.snapshot())
+        if url.path != "/v1/forecast":
+            return self.send_json(404, {"error": True, "reason": "Not Found"})
+
+        delay = options.latency_ms + random.uniform(-options.jitter_ms, options.jitter_ms)
+        if delay > 0:
+            time.sleep(delay / 1000)
+
+        roll = random.random()
+        if roll < options.throttle_rate:
+            stats.add(requests=1, throttled=1)
+            return self.send_json(
+                429,
+                {"error": True, "reason": "Too many concurrent requests"},
+                {"Retry-After": str(options.retry_after)},
+            )
+        if roll < options.throttle_rate + options.error_rate:
+            stats.add(requests=1, errors=1)
+            return self.send_json(503, {"error": True, "reason": "Service Unavailable"})
+
+        query = parse_qs(url.query)
+        try:
+            latitudes = [float(v) for v in query["latitude"][0].split(",")]
+            longitudes = [float(v) for v in query["longitude"][0].split(",")]
+        except (KeyError, ValueError):
+            stats.add(requests=1, bad_request=1)
+            return self.send_json(400, {"error": True, "reason": "Invalid coordinates"})
+        if len(latitudes) != len(longitudes) or not all(-90 <= lat <= 90 for lat in latitudes):
+            stats.add(requests=1, bad_request=1)
+            return self.send_json(400, {"error": True, "reason": "Invalid coordinates"})
+
+        now = datetime.now(timezone.utc)
+        payloads = [current_weather(lat, lon, now) for lat, lon in zip(latitudes, longitudes)]
+        stats.add(requests=1, ok=1, locations=len(payloads))
+        self.send_json(200, payloads if len(payloads) > 1 else payloads[0])
+
+
+def make_server(host="127.0.0.1", port=8090, latency_ms=0, jitter_ms=0, error_rate=0.0,
+                throttle_rate=0.0, retry_after=1, verbose=False):
+    """Build (but do not start) a fake server; port 0 picks a free port."""
+    server = ThreadingHTTPServer((host, port), FakeOpenMeteoHandler)
+    server.daemon_threads = True
+    server.options = argparse.Namespace(
+        latency_ms=latency_ms,
+        jitter_ms=jitter_ms,
+        error_rate=error_rate,
+        throttle_rate=throttle_rate,
+        retry_after=retry_after,
+        verbose=verbose,
+    )
+    server.stats = Stats()
+    return server
+
+
+def start_in_thread(**options):
+    """Start a fake server in a daemon thread. Returns (server, forecast_url)."""
+    server = make_server(**options)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    host, port = server.server_address[:2]
+    return server, "http://%s:%s/v1/forecast" % (host, port)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--latency-ms", type=float, default=0, help="added latency per request")
+    parser.add_argument("--jitter-ms", type=float, default=0, help="+/- random jitter on the latency")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests answered 503")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="fraction of requests answered 429")
+    parser.add_argument("--retry-after", type=int, default=1, help="Retry-After seconds sent with 429")
+    parser.add_argument("--verbose", action="store_true", help="log every request")
+    args = parser.parse_args()
+
+    server = make_server(
+        host=args.host,
+        port=args.port,
+        latency_ms=args.latency_ms,
+        jitter_ms=args.jitter_ms,
+        error_rate=args.error_rate,
+        throttle_rate=args.throttle_rate,
+        retry_after=args.retry_after,
+        verbose=args.verbose,
+    )
+    print("Fake Open-Meteo listening on http://%s:%s/v1/forecast" % server.server_address[:2])
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print(json.dumps(server.stats.snapshot()))
+
+
+if __name__ == "__main__":
+    main()
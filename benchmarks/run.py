@@ -0,0 +1,429 @@
+"""
+Benchmark harness for the sync paths and the read API.
+
+Scenarios:
+
+    sync-single  sync_single_city for every benchmark city from a thread pool
+    sync-all     sync_all_cities_task, either eagerly in this process
+                 (--mode eager) or on running Celery workers (--mode worker)
+    sync-async   the asyncio sync engine (run_async_sync)
+    api          GET /api/weather/ and /api/weather/<id>/, in-process through
+                 the Django test client or over HTTP with --base-url
+
+Unless --upstream-url is given, a fake Open-Meteo server
+(benchmarks/fake_open_meteo.py) is started in this process with the --fake-*
+options. Worker mode needs the workers to call the same upstream, so start
+the fake server separately and run the workers and this script with the same
+OPEN_METEO_URL / --upstream-url.
+
+Redis state (rate limiter, circuit breaker, response cache, change feed,
+Celery broker) goes to Redis database 15 of REDIS_URL, or to --redis-url,
+so a run neither reads nor changes the live state; the rate limiter and
+circuit breaker are reset at the start. The rate limiter is off unless
+--rate-limit is given, so results measure the sync path rather than the
+token bucket. Worker mode needs the workers on the same --redis-url and
+limiter settings.
+
+Benchmark cities are named "bench-00000"... and are removed afterwards unless
+--keep is given. sync-all syncs every enabled city, so run it against a
+dedicated database. Results are printed (or written to --output) as JSON with
+throughput and p50/p95/p99 latencies, for comparison between versions.
+"""
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from pathlib import Path
+from urllib.parse import urlsplit, urlunsplit
+
+ROOT = Path(__file__).resolve().parent.parent
+CITY_PREFIX = "bench-"
+BENCH_REDIS_DB = 15
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return None
+    rank = max(0, min(len(sorted_values) - 1, round(pct / 100 * len(sorted_values) + 0.5) - 1))
+    return sorted_values[rank]
+
+
+def summarize(latencies, duration, errors=0):
+    """Throughput and latency percentiles (ms) for a list of latencies in seconds."""
+    values = sorted(latencies)
+    ms = lambda v: round(v * 1000, 3) if v is not None else None
+    return {
+        "count": len(values),
+        "errors": errors,
+        "duration_s": round(duration, 3),
+        "throughput_per_s": round(len(values) / duration, 2) if duration > 0 else None,
+        "latency_ms": {
+            "p50": ms(percentile(values, 50)),
+            "p95": ms(percentile(values, 95)),
+            "p99": ms(percentile(values, 99)),
+            "mean": ms(sum(values) / len(values)) if values else None,
+            "max": ms(values[-1]) if values else None,
+        },
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, stderr=subprocess.DEVNULL, text=True,
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def bench_redis_url(redis_url):
+    """`redis_url` with the database replaced by BENCH_REDIS_DB."""
+    return urlunsplit(urlsplit(redis_url)._replace(path="/%d" % BENCH_REDIS_DB))
+
+
+def setup_django(upstream_url, redis_url, rate_limit, rate_limit_burst):
+    os.environ["OPEN_METEO_URL"] = upstream_url
+    os.environ["REDIS_URL"] = redis_url
+    os.environ["WEATHER_RATE_LIMIT_ENABLED"] = "1" if rate_limit else "0"
+    if rate_limit:
+        os.environ["WEATHER_RATE_LIMIT"] = str(rate_limit)
+    if rate_limit_burst:
+        os.environ["WEATHER_RATE_LIMIT_BURST"] = str(rate_limit_burst)
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "config.settings")
+    sys.path.insert(0, str(ROOT))
+    import django
+    django.setup()
+
+
+def reset_upstream_state():
+    """Start from a full token bucket at the configured rate and a closed circuit."""
+    from django.core.cache import cache
+    from weather.circuit import open_meteo_circuit
+    from weather.ratelimit import open_meteo_limiter
+    from weather.redis_client import get_redis
+
+    get_redis().delete(open_meteo_limiter.key)
+    cache.delete_many([open_meteo_circuit.state_key, open_meteo_circuit.failures_key, open_meteo_circuit.probe_key])
+
+
+def run_settings():
+    """Settings that shape the results, for the report."""
+    from django.conf import settings
+
+    redis_url = urlsplit(settings.REDIS_URL)
+    return {
+        # without credentials
+        "redis": redis_url.netloc.rpartition("@")[2] + redis_url.path,
+        "rate_limit": {
+            "enabled": settings.WEATHER_RATE_LIMIT_ENABLED,
+            "rate": settings.WEATHER_RATE_LIMIT,
+            "burst": settings.WEATHER_RATE_LIMIT_BURST,
+            "min": settings.WEATHER_RATE_LIMIT_MIN,
+            "max": settings.WEATHER_RATE_LIMIT_MAX,
+            "max_wait": settings.WEATHER_RATE_LIMIT_MAX_WAIT,
+        },
+        "circuit_failure_threshold": settings.WEATHER_CIRCUIT_FAILURE_THRESHOLD,
+        "sync_batch_size": settings.WEATHER_SYNC_BATCH_SIZE,
+    }
+
+
+def city_names(count):
+    return ["%s%05d" % (CITY_PREFIX, i) for i in range(count)]
+
+
+def seed_cities(count):
+    """Create (or reset) `count` benchmark cities spread over the globe."""
+    from weather.models import City
+
+    cities = [
+        City(
+            name=name,
+            latitude=round(-60 + (i * 7.31) % 130, 4),
+            longitude=round(-180 + (i * 13.77) % 360, 4),
+            enabled=True,
+        )
+        for i, name in enumerate(city_names(count))
+    ]
+    City.objects.bulk_create(
+        cities,
+        batch_size=1000,
+        update_conflicts=True,
+        unique_fields=["name"],
+        update_fields=["latitude", "longitude", "enabled"],
+    )
+    return count
+
+
+def seed_weather(count):
+    """Benchmark Weather rows for the API scenario, where none exist yet."""
+    from django.utils import timezone as dj_timezone
+    from weather.models import City, Weather
+
+    now = dj_timezone.now()
+    rows = [
+        Weather(
+            city_name=c["name"],
+            latitude=c["latitude"],
+            longitude=c["longitude"],
+            temperature=20.0,
+            windspeed=5.0,
+            winddirection=180,
+            weathercode=1,
+            time=now,
+            synced_at=now,
+        )
+        for c in City.objects.filter(name__in=city_names(count)).values("name", "latitude", "longitude")
+    ]
+    Weather.objects.bulk_create(rows, batch_size=1000, ignore_conflicts=True)
+
+
+def cleanup(count):
+    from weather.models import City, Observation, Weather
+
+    names = city_names(count)
+    for start in range(0, len(names), 1000):
+        chunk = names[start:start + 1000]
+        Observation.objects.filter(city_name__in=chunk).delete()
+        Weather.objects.filter(city_name__in=chunk).delete()
+        City.objects.filter(name__in=chunk).delete()
+
+
+def completion_latencies(count, started_at):
+    """Seconds from `started_at` until each benchmark city was synced."""
+    from weather.models import Weather
+
+    synced = Weather.objects.filter(
+        city_name__in=city_names(count), synced_at__gte=started_at,
+    ).values_list("synced_at", flat=True)
+    return [(s - started_at).total_seconds() for s in synced]
+
+
+def bench_sync_single(args):
+    from weather.models import City
+    from weather.services import sync_single_city
+
+    cities = list(City.objects.filter(name__in=city_names(args.cities)).sync_payloads())
+    latencies = []
+    errors = 0
+    lock = threading.Lock()
+
+    def run(city):
+        nonlocal errors
+        started = time.perf_counter()
+        try:
+            ok = sync_single_city(city)
+        except Exception:
+            ok = False
+        elapsed = time.perf_counter() - started
+        with lock:
+            latencies.append(elapsed)
+            errors += not ok
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(args.workers) as pool:
+        list(pool.map(run, cities))
+    return {"sync_single_city": summarize(latencies, time.perf_counter() - started, errors)}
+
+
+def bench_sync_all(args):
+    from django.utils import timezone as dj_timezone
+    from config.celery import app
+    from weather.tasks import sync_all_cities_task
+
+    started_at = dj_timezone.now()
+    started = time.perf_counter()
+    if args.mode == "eager":
+        app.conf.task_always_eager = True
+        sync_all_cities_task.apply(kwargs={"force": True})
+    else:
+        sync_all_cities_task.delay(force=True)
+        deadline = started + args.timeout
+        while time.perf_counter() < deadline:
+            if len(completion_latencies(args.cities, started_at)) >= args.cities:
+                break
+            time.sleep(0.5)
+    duration = time.perf_counter() - started
+
+    latencies = completion_latencies(args.cities, started_at)
+    return {
+        "sync_all_cities_task": summarize(latencies, duration, errors=args.cities - len(latencies)),
+    }
+
+
+def bench_sync_async(args):
+    from django.utils import timezone as dj_timezone
+    from weather.async_sync import run_async_sync
+    from weather.models import City
+
+    cities = City.objects.filter(name__in=city_names(args.cities)).order_by("id").sync_payloads()
+    started_at = dj_timezone.now()
+    started = time.perf_counter()
+    results = run_async_sync(cities, args.concurrency)
+    duration = time.perf_counter() - started
+
+    latencies = completion_latencies(args.cities, started_at)
+    return {
+        "sync_cities_async": summarize(latencies, duration, errors=len(results) - sum(results.values())),
+    }
+
+
+def bench_api(args):
+    from weather.models import Weather
+
+    seed_weather(args.cities)
+    ids = list(Weather.objects.filter(city_name__in=city_names(args.cities)).values_list("id", flat=True))
+    endpoints = {
+        "weather_list": lambda n: "/api/weather/?limit=%d" % args.page_size,
+        "weather_detail": lambda n: "/api/weather/%d/" % random.choice(ids),
+    }
+
+    if args.base_url:
+        import requests
+
+        local = threading.local()
+
+        def get(path):
+            session = getattr(local, "session", None)
+            if session is None:
+                session = local.session = requests.Session()
+            return session.get(args.base_url.rstrip("/") + path).status_code
+    else:
+        from django.conf import settings
+        from django.test import Client
+
+        settings.ALLOWED_HOSTS.append("testserver")
+        local = threading.local()
+
+        def get(path):
+            client = getattr(local, "client", None)
+            if client is None:
+                client = local.client = Client()
+            return client.get(path).status_code
+
+    results = {}
+    for name, build_path in endpoints.items():
+        latencies = []
+        errors = 0
+        lock = threading.Lock()
+
+        def run(n):
+            nonlocal errors
+            path = build_path(n)
+            if args.cache_bust:
+                # a unique URL per request, so the response cache never hits
+                path += ("&" if "?" in path else "?") + "_=%d" % n
+            started = time.perf_counter()
+            status = get(path)
+            elapsed = time.perf_counter() - started
+            with lock:
+                latencies.append(elapsed)
+                errors += status != 200
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(args.workers) as pool:
+            list(pool.map(run, range(args.requests)))
+        results[name] = summarize(latencies, time.perf_counter() - started, errors)
+    return results
+
+
+SCENARIOS = {
+    "sync-single": bench_sync_single,
+    "sync-all": bench_sync_all,
+    "sync-async": bench_sync_async,
+    "api": bench_api,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("scenario", choices=SCENARIOS)
+    parser.add_argument("--cities", type=int, default=100, help="number of benchmark cities")
+    parser.add_argument("--workers", type=int, default=8, help="client threads (sync-single, api)")
+    parser.add_argument("--mode", choices=("eager", "worker"), default="eager", help="sync-all execution mode")
+    parser.add_argument("--timeout", type=float, default=600, help="seconds to wait for workers (sync-all --mode worker)")
+    parser.add_argument("--concurrency", type=int, default=None, help="sync-async concurrency")
+    parser.add_argument("--requests", type=int, default=1000, help="requests per endpoint (api)")
+    parser.add_argument("--page-size", type=int, default=100, help="limit for /api/weather/ (api)")
+    parser.add_argument("--cache-bust", action="store_true", help="make every API request miss the response cache")
+    parser.add_argument("--base-url", help="benchmark a running server instead of the in-process test client")
+    parser.add_argument("--upstream-url", help="Open-Meteo URL to use instead of an in-process fake server")
+    parser.add_argument("--fake-latency-ms", type=float, default=20)
+    parser.add_argument("--fake-jitter-ms", type=float, default=5)
+    parser.add_argument("--fake-error-rate", type=float, default=0.0)
+    parser.add_argument("--fake-throttle-rate", type=float, default=0.0)
+    parser.add_argument("--fake-retry-after", type=int, default=1)
+    parser.add_argument(
+        "--rate-limit", type=float, default=0,
+        help="shared Open-Meteo rate limit in requests/s for the run (default 0: limiter off); "
+        "WEATHER_RATE_LIMIT_MIN/MAX still bound how it adapts",
+    )
+    parser.add_argument("--rate-limit-burst", type=float, default=None, help="token bucket size (with --rate-limit)")
+    parser.add_argument(
+        "--redis-url",
+        help="Redis for limiter, circuit, cache, feed and broker state (default: database %d of REDIS_URL)" % BENCH_REDIS_DB,
+    )
+    parser.add_argument("--seed", type=int, default=0, help="random seed for request selection")
+    parser.add_argument("--keep", action="store_true", help="keep the benchmark cities afterwards")
+    parser.add_argument("--output", help="write the JSON report to this file")
+    args = parser.parse_args()
+
+    if args.scenario == "sync-all" and args.mode == "worker" and not args.upstream_url:
+        parser.error("--mode worker needs --upstream-url (the workers must call the same upstream)")
+    if args.scenario == "sync-all" and args.mode == "worker" and not args.redis_url:
+        parser.error("--mode worker needs --redis-url (the workers must use the same Redis)")
+    if args.rate_limit < 0:
+        parser.error("--rate-limit must be 0 (off) or positive")
+    redis_url = args.redis_url or bench_redis_url(os.environ.get("REDIS_URL", "redis://127.0.0.1:6379/0"))
+    random.seed(args.seed)
+    run_started_at = datetime.now(timezone.utc).isoformat()
+
+    fake = None
+    upstream_url = args.upstream_url
+    if not upstream_url:
+        sys.path.insert(0, str(Path(__file__).resolve().parent))
+        from fake_open_meteo import start_in_thread
+
+        fake, upstream_url = start_in_thread(
+            port=0,
+            latency_ms=args.fake_latency_ms,
+            jitter_ms=args.fake_jitter_ms,
+            error_rate=args.fake_error_rate,
+            throttle_rate=args.fake_throttle_rate,
+            retry_after=args.fake_retry_after,
+        )
+    setup_django(upstream_url, redis_url, args.rate_limit, args.rate_limit_burst)
+    reset_upstream_state()
+
+    seed_cities(args.cities)
+    try:
+        results = SCENARIOS[args.scenario](args)
+    finally:
+        if not args.keep:
+            cleanup(args.cities)
+        if fake is not None:
+            fake.shutdown()
+
+    report = {
+        "scenario": args.scenario,
+        "started_at": run_started_at,
+        "git_commit": git_commit(),
+        "params": {k: v for k, v in vars(args).items() if k not in ("output", "redis_url")},
+        "settings": run_settings(),
+        "upstream": fake.stats.snapshot() if fake is not None else {"url": upstream_url},
+        "results": results,
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        Path(args.output).write_text(output + "\n")
+    print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -58,6 +58,7 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    "weather.metrics.ViewMetricsMiddleware",
 ]
 
 ROOT_URLCONF = 'config.urls'
@@ -155,5 +156,134 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 REDIS_URL = os.environ["REDIS_URL"]
 CELERY_BROKER_URL = REDIS_URL
 CELERY_RESULT_BACKEND = REDIS_URL
+# periodic tasks, run with: celery -A config beat
+CELERY_BEAT_SCHEDULE = {
+    "maintain-observation-partitions": {
+        "task": "weather.tasks.maintain_observation_partitions_task",
+        "schedule": 3600.0,
+    },
+}
+
+# cache (Redis, shared by web and worker processes)
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.redis.RedisCache",
+        "LOCATION": REDIS_URL,
+        "KEY_PREFIX": "weather-sync",
+    }
+}
 
+# weather sync
+# Cities per shard task dispatched by the sync coordinator.
+WEATHER_SYNC_SHARD_SIZE = int(os.getenv("WEATHER_SYNC_SHARD_SIZE", "1000"))
+# Number of cities fetched per Open-Meteo request; 0 or 1 keeps one task per city.
+WEATHER_SYNC_BATCH_SIZE = int(os.getenv("WEATHER_SYNC_BATCH_SIZE", "0"))
+# Rows written per INSERT ... ON CONFLICT statement when saving many cities.
+WEATHER_DB_BATCH_SIZE = int(os.getenv("WEATHER_DB_BATCH_SIZE", "500"))
+
+# Open-Meteo HTTP client (one pooled keep-alive session per worker process)
+# The URL can point at a stand-in server, e.g. benchmarks/fake_open_meteo.py.
+OPEN_METEO_URL = os.getenv("OPEN_METEO_URL", "https://api.open-meteo.com/v1/forecast")
+OPEN_METEO_POOL_CONNECTIONS = int(os.getenv("OPEN_METEO_POOL_CONNECTIONS", "4"))
+OPEN_METEO_POOL_MAXSIZE = int(os.getenv("OPEN_METEO_POOL_MAXSIZE", "10"))
+OPEN_METEO_CONNECT_TIMEOUT = float(os.getenv("OPEN_METEO_CONNECT_TIMEOUT", "3.05"))
+OPEN_METEO_READ_TIMEOUT = float(os.getenv("OPEN_METEO_READ_TIMEOUT", "10"))
+
+# Grid coalescing: round fetch coordinates to this many degrees (0 disables,
+# 0.02 ~ 2 km matches Open-Meteo's finest models) so nearby cities share one
+# fetch; workers share fetched payloads for WEATHER_GRID_CACHE_TTL seconds.
+WEATHER_FETCH_GRID_DEGREES = float(os.getenv("WEATHER_FETCH_GRID_DEGREES", "0"))
+WEATHER_GRID_CACHE_TTL = int(os.getenv("WEATHER_GRID_CACHE_TTL", "60"))
+# Seconds a worker waits for a point another worker is fetching before it
+# fetches the point itself.
+WEATHER_FETCH_INFLIGHT_WAIT = float(os.getenv("WEATHER_FETCH_INFLIGHT_WAIT", "10"))
+
+# Requests in flight at once for the asyncio sync engine.
+WEATHER_ASYNC_CONCURRENCY = int(os.getenv("WEATHER_ASYNC_CONCURRENCY", "50"))
+
+# Upper bound on how long a cached API response lives; sync writes invalidate earlier.
+WEATHER_RESPONSE_CACHE_TTL = int(os.getenv("WEATHER_RESPONSE_CACHE_TTL", "300"))
+# Serve list/detail/sync with the native async views (for ASGI servers).
+WEATHER_ASYNC_VIEWS = os.getenv("WEATHER_ASYNC_VIEWS", "0") == "1"
+# JSON encoder for list/detail responses: "json" (byte-identical to JsonResponse)
+# or "orjson" (faster, compact output; needs the orjson package).
+WEATHER_JSON_BACKEND = os.getenv("WEATHER_JSON_BACKEND", "json")
+
+# Change feed (/api/weather/feed/): publish changed snapshots to Redis, keep
+# about WEATHER_FEED_MAXLEN of them for Last-Event-ID replay, and send a
+# keepalive comment after WEATHER_FEED_KEEPALIVE idle seconds.
+WEATHER_FEED_ENABLED = os.getenv("WEATHER_FEED_ENABLED", "1") == "1"
+WEATHER_FEED_MAXLEN = int(os.getenv("WEATHER_FEED_MAXLEN", "10000"))
+WEATHER_FEED_KEEPALIVE = float(os.getenv("WEATHER_FEED_KEEPALIVE", "15"))
+# Events buffered for a slow feed client before it is disconnected to catch up by replay.
+WEATHER_FEED_CLIENT_BUFFER = int(os.getenv("WEATHER_FEED_CLIENT_BUFFER", "1000"))
+
+# Hourly forecast variables requested from Open-Meteo with every sync and
+# stored packed per city (empty disables), over WEATHER_FORECAST_DAYS days.
+hourly_variables_env = os.getenv("WEATHER_HOURLY_VARIABLES", "temperature_2m,windspeed_10m")
+WEATHER_HOURLY_VARIABLES = [v.strip() for v in hourly_variables_env.split(",") if v.strip()]
+WEATHER_FORECAST_DAYS = int(os.getenv("WEATHER_FORECAST_DAYS", "7"))
+
+# Observation history: days kept, and daily partitions created ahead of time.
+WEATHER_HISTORY_RETENTION_DAYS = int(os.getenv("WEATHER_HISTORY_RETENTION_DAYS", "30"))
+WEATHER_HISTORY_PARTITIONS_AHEAD = int(os.getenv("WEATHER_HISTORY_PARTITIONS_AHEAD", "7"))
+
+# Snapshots identical to the stored one are not rewritten; with this on,
+# their synced_at is still bumped (one narrow UPDATE), off writes nothing.
+WEATHER_TOUCH_UNCHANGED = os.getenv("WEATHER_TOUCH_UNCHANGED", "1") == "1"
+
+# Sync triggers within this many seconds of a started run join it instead.
+WEATHER_SYNC_LOCK_TTL = int(os.getenv("WEATHER_SYNC_LOCK_TTL", "300"))
+# Redis progress counters of a sync run expire this long after its last update.
+WEATHER_SYNC_RUN_TTL = int(os.getenv("WEATHER_SYNC_RUN_TTL", "86400"))
+# Skip cities synced within this many seconds (0 disables)...
+WEATHER_SYNC_FRESHNESS_TTL = int(os.getenv("WEATHER_SYNC_FRESHNESS_TTL", "300"))
+# ...or whose upstream reading is younger than the Open-Meteo update interval.
+WEATHER_UPSTREAM_INTERVAL = int(os.getenv("WEATHER_UPSTREAM_INTERVAL", "900"))
+
+# Cluster-wide Open-Meteo rate limit (requests/s, one per location). The rate
+# starts at WEATHER_RATE_LIMIT and adapts between MIN and MAX: +INCREASE/s
+# while responses are healthy, xDECREASE on 429, 5xx, errors or responses
+# slower than WEATHER_RATE_LIMIT_SLOW_SECONDS, at most once per
+# DECREASE_INTERVAL seconds and not for requests sent before the last one.
+WEATHER_RATE_LIMIT_ENABLED = os.getenv("WEATHER_RATE_LIMIT_ENABLED", "1") == "1"
+WEATHER_RATE_LIMIT = float(os.getenv("WEATHER_RATE_LIMIT", "10"))
+WEATHER_RATE_LIMIT_MIN = float(os.getenv("WEATHER_RATE_LIMIT_MIN", "1"))
+WEATHER_RATE_LIMIT_MAX = float(os.getenv("WEATHER_RATE_LIMIT_MAX", "50"))
+WEATHER_RATE_LIMIT_BURST = float(os.getenv("WEATHER_RATE_LIMIT_BURST", "20"))
+WEATHER_RATE_LIMIT_INCREASE = float(os.getenv("WEATHER_RATE_LIMIT_INCREASE", "1"))
+WEATHER_RATE_LIMIT_DECREASE = float(os.getenv("WEATHER_RATE_LIMIT_DECREASE", "0.5"))
+WEATHER_RATE_LIMIT_SLOW_SECONDS = float(os.getenv("WEATHER_RATE_LIMIT_SLOW_SECONDS", "5"))
+WEATHER_RATE_LIMIT_DECREASE_INTERVAL = float(os.getenv("WEATHER_RATE_LIMIT_DECREASE_INTERVAL", "5"))
+# A task waits at most this long for a token before re-queueing itself.
+WEATHER_RATE_LIMIT_MAX_WAIT = float(os.getenv("WEATHER_RATE_LIMIT_MAX_WAIT", "30"))
+# Rate-limit and open-circuit deferrals a sync task gets before it gives up.
+WEATHER_SYNC_MAX_DEFERRALS = int(os.getenv("WEATHER_SYNC_MAX_DEFERRALS", "60"))
+
+# Open-Meteo circuit breaker: this many failed requests (network errors, 5xx)
+# within the window open it; while open, sync tasks are deferred without
+# calling the API, then a single probe request decides whether it closes.
+WEATHER_CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("WEATHER_CIRCUIT_FAILURE_THRESHOLD", "10"))
+WEATHER_CIRCUIT_FAILURE_WINDOW = int(os.getenv("WEATHER_CIRCUIT_FAILURE_WINDOW", "30"))
+WEATHER_CIRCUIT_OPEN_SECONDS = int(os.getenv("WEATHER_CIRCUIT_OPEN_SECONDS", "60"))
+WEATHER_CIRCUIT_PROBE_TIMEOUT = int(os.getenv("WEATHER_CIRCUIT_PROBE_TIMEOUT", "30"))
+
+# Refresh scheduler (Celery beat): every WEATHER_SCHEDULER_TICK seconds,
+# dispatch up to WEATHER_SCHEDULER_BUDGET of the most overdue cities (default:
+# what WEATHER_RATE_LIMIT allows per tick; 0 disables). Claimed cities are
+# not claimed again for WEATHER_SCHEDULER_LEASE seconds unless they sync.
+WEATHER_SCHEDULER_TICK = float(os.getenv("WEATHER_SCHEDULER_TICK", "60"))
+WEATHER_SCHEDULER_BUDGET = int(os.getenv("WEATHER_SCHEDULER_BUDGET", str(int(WEATHER_RATE_LIMIT * WEATHER_SCHEDULER_TICK))))
+WEATHER_SCHEDULER_LEASE = int(os.getenv("WEATHER_SCHEDULER_LEASE", "600"))
+CELERY_BEAT_SCHEDULE["schedule-due-cities"] = {
+    "task": "weather.tasks.schedule_due_cities_task",
+    "schedule": WEATHER_SCHEDULER_TICK,
+}
 
+# Aggregates (/api/weather/aggregates/) are updated by every sync and
+# rebuilt from the database every WEATHER_AGGREGATES_RECOMPUTE seconds.
+WEATHER_AGGREGATES_RECOMPUTE = float(os.getenv("WEATHER_AGGREGATES_RECOMPUTE", "3600"))
+CELERY_BEAT_SCHEDULE["recompute-weather-aggregates"] = {
+    "task": "weather.tasks.recompute_weather_aggregates_task",
+    "schedule": WEATHER_AGGREGATES_RECOMPUTE,
+}
@@ -14,14 +14,26 @@ Including another URLconf
     1. Import the include() function: from django.urls import include, path
     2. Add a URL to urlpatterns:  path('blog/', include('blog.urls'))
 """
+from django.conf import settings
 from django.contrib import admin
 from django.urls import path
-from weather import views
+from weather import async_views, views
+
+# native async list/detail/sync views for ASGI deployments
+hot_views = async_views if settings.WEATHER_ASYNC_VIEWS else views
 
 urlpatterns = [
     path('admin/', admin.site.urls),
-    path("api/weather/", views.weather_list),
-    path("api/weather/<int:id>/", views.weather_detail),
-    path("api/sync/", views.sync_weather),
+    path("api/weather/", hot_views.weather_list),
+    path("api/weather/export/", views.weather_export),
+    path("api/weather/nearest/", views.weather_nearest),
+    path("api/weather/feed/", async_views.weather_feed),
+    path("api/weather/aggregates/", views.weather_aggregates),
+    path("api/weather/forecast/", views.weather_forecast),
+    path("api/weather/<int:id>/", hot_views.weather_detail),
+    path("api/weather/<int:id>/history/", views.weather_history),
+    path("api/sync/", hot_views.sync_weather),
+    path("api/sync/<str:run_id>/", views.sync_status),
     path("api/csrf/", views.csrf_token),
+    path("metrics/", views.metrics),
 ]
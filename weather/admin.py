@@ -1,3 +1,16 @@
 from django.contrib import admin
 
-# Register your models here.
+from .models import City, SyncRun
+
+
+@admin.register(City)
+class CityAdmin(admin.ModelAdmin):
+    list_display = ("name", "latitude", "longitude", "enabled", "refresh_interval")
+    list_filter = ("enabled",)
+    search_fields = ("name",)
+
+
+@admin.register(SyncRun)
+class SyncRunAdmin(admin.ModelAdmin):
+    list_display = ("id", "status", "started_at", "finished_at", "cities", "succeeded", "failed", "client_error")
+    list_filter = ("status",)
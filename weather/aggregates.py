@@ -0,0 +1,230 @@
+import logging
+from uuid import uuid4
+from django.conf import settings
+from redis.exceptions import RedisError
+from .models import Weather
+from .redis_client import get_redis
+from .utils import chunked
+
+logger = logging.getLogger(__name__)
+
+# Global and per-weathercode temperature/windspeed statistics, kept in Redis
+# and updated from the sync write path, so reading them costs a few Redis
+# commands instead of a table scan. Each group ("all", "code:<weathercode>")
+# has a hash of counts and running sums and, per metric, a sorted set of
+# city -> value whose ends are the extremes. The current values of every
+# city are kept too, so a change moves the city out of its old group first.
+# Running float sums drift slightly; recompute_weather_aggregates_task
+# rebuilds everything from the database periodically, into keys of its own
+# that replace the live ones only once complete.
+PREFIX = "weather:agg"
+METRICS = ("temperature", "windspeed")
+
+# KEYS: ready flag, per-city values hash, set of weathercodes.
+# ARGV: key prefix, then (city, weathercode, temperature, windspeed) per
+# snapshot, "" for nulls. A no-op until a rebuild has set the ready flag,
+# so a partial state is never mistaken for the full one.
+UPDATE_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return 0
+end
+local cities, codes, prefix = KEYS[2], KEYS[3], ARGV[1]
+local metrics = {'temperature', 'windspeed'}
+
+local function apply(group, city, values, sign)
+    local key = prefix .. ':' .. group
+    redis.call('HINCRBY', key, 'n', sign)
+    for j, metric in ipairs(metrics) do
+        local v = values[j]
+        if v ~= '' then
+            redis.call('HINCRBY', key, metric .. '_n', sign)
+            redis.call('HINCRBYFLOAT', key, metric .. '_sum', sign * tonumber(v))
+            if sign > 0 then
+                redis.call('ZADD', key .. ':' .. metric, v, city)
+            else
+                redis.call('ZREM', key .. ':' .. metric, city)
+            end
+        end
+    end
+end
+
+for i = 2, #ARGV, 4 do
+    local city, code = ARGV[i], ARGV[i + 1]
+    local new = {ARGV[i + 2], ARGV[i + 3]}
+    local old = redis.call('HGET', cities, city)
+    if old then
+        local old_code, t, w = string.match(old, '^([^,]*),([^,]*),([^,]*)$')
+        apply('all', city, {t, w}, -1)
+        apply('code:' .. old_code, city, {t, w}, -1)
+    end
+    apply('all', city, new, 1)
+    apply('code:' .. code, city, new, 1)
+    redis.call('SADD', codes, code)
+    redis.call('HSET', cities, city, code .. ',' .. new[1] .. ',' .. new[2])
+end
+return 1
+"""
+
+# KEYS: n (source, destination) pairs, then keys to delete. ARGV: n.
+# Renames the rebuilt keys over the live ones in one step.
+SWAP_SCRIPT = """
+local n = tonumber(ARGV[1])
+for i = 1, n do
+    local source, destination = KEYS[2 * i - 1], KEYS[2 * i]
+    if redis.call('EXISTS', source) == 1 then
+        redis.call('RENAME', source, destination)
+    else
+        redis.call('DEL', destination)
+    end
+end
+for i = 2 * n + 1, #KEYS do
+    redis.call('DEL', KEYS[i])
+end
+return n
+"""
+
+
+def _keys(prefix=None):
+    prefix = prefix or PREFIX
+    return "%s:ready" % prefix, "%s:cities" % prefix, "%s:codes" % prefix
+
+
+def _group_keys(prefix, group):
+    key = "%s:%s" % (prefix, group)
+    return [key] + ["%s:%s" % (key, metric) for metric in METRICS]
+
+
+def _groups(codes):
+    return ["all"] + ["code:%s" % code.decode() for code in codes]
+
+
+def _args(rows, prefix=None):
+    """Script arguments for (city_name, weathercode, temperature, windspeed) rows."""
+    args = [prefix or PREFIX]
+    for city_name, weathercode, temperature, windspeed in rows:
+        args += [
+            city_name,
+            "" if weathercode is None else str(weathercode),
+            "" if temperature is None else repr(float(temperature)),
+            "" if windspeed is None else repr(float(windspeed)),
+        ]
+    return args
+
+
+def record_snapshots(weathers):
+    """
+    Fold changed Weather snapshots into the aggregates. Called after the
+    write commits; Redis errors are logged and never fail a sync.
+    """
+    if not weathers:
+        return
+    rows = [(w.city_name, w.weathercode, w.temperature, w.windspeed) for w in weathers]
+    try:
+        get_redis().eval(UPDATE_SCRIPT, 3, *_keys(), *_args(rows))
+    except RedisError:
+        logger.exception("Could not update weather aggregates")
+
+
+def rebuild_aggregates():
+    """
+    Recompute the aggregates from the Weather table. They are built chunk by
+    chunk under a temporary prefix, so Redis is never blocked for long and
+    readers keep the previous state, then renamed over the live keys at once.
+    Snapshots saved while the rebuild runs are folded in by later syncs.
+    """
+    redis = get_redis()
+    build = "%s:build:%s" % (PREFIX, uuid4().hex)
+    ready, cities, codes = _keys(build)
+    try:
+        redis.set(ready, 1)
+        rows = (
+            Weather.objects.order_by()
+            .values_list("city_name", "weathercode", "temperature", "windspeed")
+            .iterator(chunk_size=settings.WEATHER_DB_BATCH_SIZE)
+        )
+        count = 0
+        for chunk in chunked(rows, settings.WEATHER_DB_BATCH_SIZE):
+            redis.eval(UPDATE_SCRIPT, 3, ready, cities, codes, *_args(chunk, build))
+            count += len(chunk)
+
+        groups = _groups(redis.smembers(codes))
+        renames = list(zip(_keys(build), _keys()))
+        for group in groups:
+            renames += zip(_group_keys(build, group), _group_keys(PREFIX, group))
+        # groups of weathercodes no city has any more
+        stale = [
+            key
+            for group in _groups(redis.smembers(_keys()[2]))
+            if group not in groups
+            for key in _group_keys(PREFIX, group)
+        ]
+        keys = [key for pair in renames for key in pair] + stale
+        redis.eval(SWAP_SCRIPT, len(keys), *keys, len(renames))
+    except Exception:
+        # leave no half-built keys behind
+        try:
+            leftovers = list(redis.scan_iter("%s*" % build))
+            if leftovers:
+                redis.delete(*leftovers)
+        except RedisError:
+            pass
+        raise
+    logger.info("Rebuilt weather aggregates from %d snapshots", count)
+    return count
+
+
+def _group_stats(state, extremes):
+    stats = {"cities": int(state.get(b"n", 0))}
+    for metric in METRICS:
+        n = int(state.get(b"%s_n" % metric.encode(), 0))
+        lowest, highest = extremes[metric]
+        stats[metric] = {
+            "count": n,
+            "min": lowest[0][1] if lowest else None,
+            "min_city": lowest[0][0].decode() if lowest else None,
+            "max": highest[0][1] if highest else None,
+            "max_city": highest[0][0].decode() if highest else None,
+            "mean": round(float(state[b"%s_sum" % metric.encode()]) / n, 3) if n else None,
+        }
+    return stats
+
+
+def read_aggregates():
+    """
+    Global and per-weathercode statistics, or None before the first rebuild.
+    Costs two Redis round trips whatever the number of cities.
+    """
+    redis = get_redis()
+    ready, _, codes_key = _keys()
+    pipe = redis.pipeline(transaction=False)
+    pipe.exists(ready)
+    pipe.smembers(codes_key)
+    exists, members = pipe.execute()
+    if not exists:
+        return None
+
+    # numeric weathercode order, nulls ("") last
+    codes = sorted((m.decode() for m in members), key=lambda c: (c == "", int(c) if c else 0))
+    groups = ["all"] + ["code:%s" % code for code in codes]
+    pipe = redis.pipeline(transaction=True)
+    for group in groups:
+        key = "%s:%s" % (PREFIX, group)
+        pipe.hgetall(key)
+        for metric in METRICS:
+            pipe.zrange("%s:%s" % (key, metric), 0, 0, withscores=True)
+            pipe.zrange("%s:%s" % (key, metric), -1, -1, withscores=True)
+    replies = iter(pipe.execute())
+
+    stats = {}
+    for group in groups:
+        state = next(replies)
+        extremes = {metric: (next(replies), next(replies)) for metric in METRICS}
+        stats[group] = _group_stats(state, extremes)
+
+    body = stats.pop("all")
+    body["by_weathercode"] = {
+        group.split(":", 1)[1] or "null": group_stats
+        for group, group_stats in stats.items()
+        if group_stats["cities"]
+    }
+    return body
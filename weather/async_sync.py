@@ -0,0 +1,192 @@
+import asyncio
+import logging
+import time
+import httpx
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import connections
+from .http_client import build_async_client
+from .circuit import CircuitOpen, open_meteo_circuit
+from .coalesce import acache_payload, aclaim_fetch, aget_cached_payload, arelease_fetch, await_payload, fetch_point
+from .metrics import CITY_SYNC_TOTAL, COALESCED_FETCHES_TOTAL, TASK_RETRIES_TOTAL, upstream_outcome
+from .ratelimit import open_meteo_limiter, parse_retry_after
+from .retry import SYNC_MAX_RETRIES, is_retryable_status, retry_countdown
+from .services import OPEN_METEO_URL, open_meteo_params, record_open_meteo_response, save_weather_bulk
+
+logger = logging.getLogger(__name__)
+
+
+async def acquire_request_slot():
+    """
+    Pass the circuit breaker and take a token from the shared rate limiter,
+    without blocking the loop. Returns whether the request is the half-open
+    probe. A won probe is given back while waiting for a token, so it is only
+    held by a request that is about to be sent.
+    """
+    while True:
+        probe = await asyncio.to_thread(open_meteo_circuit.before_request)
+        try:
+            wait = await asyncio.to_thread(open_meteo_limiter.try_acquire)
+        except BaseException:
+            await asyncio.to_thread(open_meteo_circuit.release_probe, probe)
+            raise
+        if not wait:
+            return probe
+        await asyncio.to_thread(open_meteo_circuit.release_probe, probe)
+        await asyncio.sleep(wait)
+
+
+async def fetch_city_async(client, semaphore, city_data):
+    """
+    Fetch current weather for one city, retrying network errors, 5xx and 429
+    with the same backoff as sync_city_task (or after Retry-After, if later).
+    Other 4xx responses are not retried. Every request goes through the shared
+    circuit breaker and rate limiter and reports its outcome back to them;
+    while the circuit is open, attempts wait for it instead of calling the API.
+    Returns the payload, or None if the city could not be fetched.
+    """
+    city_name = city_data["city_name"]
+    params = open_meteo_params(city_data["latitude"], city_data["longitude"])
+
+    for attempt in range(SYNC_MAX_RETRIES + 1):
+        retry_after = 0
+        try:
+            probe = await acquire_request_slot()
+            # only the request itself holds a slot, backoff sleeps do not
+            async with semaphore:
+                started = time.monotonic()
+                try:
+                    resp = await client.get(OPEN_METEO_URL, params=params)
+                except httpx.TransportError:
+                    await asyncio.to_thread(
+                        record_open_meteo_response, None, time.monotonic() - started, 0, probe,
+                    )
+                    raise
+            if resp.status_code in (429, 503):
+                retry_after = parse_retry_after(resp.headers.get("Retry-After"))
+            await asyncio.to_thread(
+                record_open_meteo_response, resp.status_code, time.monotonic() - started, retry_after, probe,
+            )
+            resp.raise_for_status()
+            return resp.json()
+        except httpx.HTTPStatusError as e:
+            status = e.response.status_code
+            if not is_retryable_status(status):
+                CITY_SYNC_TOTAL.labels("client_error").inc()
+                logger.warning("Client error (no retry) city=%s status=%s", city_name, status)
+                return None
+            reason, label = "status %s" % status, upstream_outcome(status)
+        except httpx.TransportError as e:
+            reason, label = repr(e), "network_error"
+        except ValueError as e:
+            reason, label = repr(e), "invalid_payload"
+        except CircuitOpen as e:
+            retry_after = e.retry_after
+            reason, label = str(e), "circuit_open"
+
+        if attempt == SYNC_MAX_RETRIES:
+            CITY_SYNC_TOTAL.labels("failed").inc()
+            logger.error("Giving up on city=%s after %d retries (%s)", city_name, attempt, reason)
+            return None
+        TASK_RETRIES_TOTAL.labels("sync_cities_async", label).inc()
+        countdown = max(retry_countdown(attempt), retry_after)
+        logger.warning("Retrying city=%s in %.1fs (%s)", city_name, countdown, reason)
+        await asyncio.sleep(countdown)
+
+
+async def _aiter_cities(cities):
+    if hasattr(cities, "aiterator"):
+        async for city_data in cities.aiterator(chunk_size=settings.WEATHER_SYNC_SHARD_SIZE):
+            yield city_data
+    else:
+        for city_data in cities:
+            yield city_data
+
+
+async def sync_cities_async(cities, concurrency=None):
+    """
+    Fetch many cities concurrently from one event loop and bulk-save them.
+    At most `concurrency` requests are in flight (WEATHER_ASYNC_CONCURRENCY by
+    default), and only a small window of pending cities is held in memory, so
+    `cities` can be any iterable, or a QuerySet which is then streamed with
+    aiterator(). Cities sharing a fetch point (see weather.coalesce) share
+    one request. Returns a dict of city_name -> True/False.
+    """
+    concurrency = concurrency or settings.WEATHER_ASYNC_CONCURRENCY
+    max_pending = concurrency * 2
+    semaphore = asyncio.Semaphore(concurrency)
+    save = sync_to_async(save_weather_bulk)
+
+    results = {}
+    fetched = []
+    pending = set()
+
+    async def collect(done):
+        for task in done:
+            city_data, payload = task.result()
+            if payload is None:
+                results[city_data["city_name"]] = False
+            else:
+                fetched.append((city_data, payload))
+        if len(fetched) >= settings.WEATHER_DB_BATCH_SIZE:
+            results.update(await save(fetched[:]))
+            fetched.clear()
+
+    # cities whose fetch point is already being fetched wait for that request
+    inflight = {}
+
+    async def fetch_shared(client, city_data, point):
+        payload = await aget_cached_payload(point)
+        if payload is not None:
+            COALESCED_FETCHES_TOTAL.labels("cache").inc()
+            return payload
+        # another worker is fetching this point: wait for its payload
+        claimed = await aclaim_fetch(point)
+        if not claimed:
+            payload = await await_payload(point)
+            if payload is not None:
+                COALESCED_FETCHES_TOTAL.labels("shared").inc()
+                return payload
+        request = {"city_name": city_data["city_name"], "latitude": point[0], "longitude": point[1]}
+        try:
+            payload = await fetch_city_async(client, semaphore, request)
+            if payload is not None:
+                await acache_payload(point, payload)
+        finally:
+            if claimed:
+                await arelease_fetch(point)
+        return payload
+
+    async def fetch(client, city_data):
+        point = fetch_point(city_data)
+        shared = inflight.get(point)
+        if shared is not None:
+            COALESCED_FETCHES_TOTAL.labels("shared").inc()
+            return city_data, await asyncio.shield(shared)
+        shared = inflight[point] = asyncio.ensure_future(fetch_shared(client, city_data, point))
+        shared.add_done_callback(lambda _: inflight.pop(point, None))
+        return city_data, await shared
+
+    async with build_async_client(concurrency) as client:
+        async for city_data in _aiter_cities(cities):
+            if len(pending) >= max_pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                await collect(done)
+            pending.add(asyncio.create_task(fetch(client, city_data)))
+
+        if pending:
+            done, _ = await asyncio.wait(pending)
+            await collect(done)
+
+    try:
+        if fetched:
+            results.update(await save(fetched))
+    finally:
+        # the ORM ran in asgiref's worker thread; don't leak its connection
+        await sync_to_async(connections.close_all)()
+    return results
+
+
+def run_async_sync(cities, concurrency=None):
+    """Run sync_cities_async to completion from synchronous code."""
+    return asyncio.run(sync_cities_async(cities, concurrency))
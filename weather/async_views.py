@@ -0,0 +1,109 @@
+from asgiref.sync import sync_to_async
+from django.core.handlers.asgi import ASGIRequest
+from django.http import JsonResponse, StreamingHttpResponse
+from django.views.decorators.csrf import csrf_protect
+from django.views.decorators.http import require_http_methods
+
+from .cache import cached_weather_response
+from .feed import feed_events
+from .models import Weather, WeatherPayload
+from .tasks import start_sync_all_cities
+from .views import (
+    WEATHER_FIELDS,
+    approximate_count,
+    fast_json_response,
+    keyset_page,
+    parse_force,
+    parse_include,
+    parse_keyset_params,
+    parse_list_params,
+    serialize_weather_rows,
+    set_last_modified,
+    sync_started_response,
+)
+
+# Async versions of the hot weather views, served without a thread per
+# request under ASGI (WEATHER_ASYNC_VIEWS=1). Responses are identical to
+# weather.views.
+
+async def fetch_rows(qs):
+    """WEATHER_FIELDS tuples of a queryset, read with async iteration."""
+    return [row async for row in qs.values_list(*WEATHER_FIELDS)]
+
+async def weather_list_keyset(request, limit):
+    after_id, count_mode, error = parse_keyset_params(request)
+    if error:
+        return error
+
+    qs = Weather.objects.order_by("id")
+    if after_id is not None:
+        qs = qs.filter(id__gt=after_id)
+    body = keyset_page(request, await fetch_rows(qs[: limit + 1]), limit)
+
+    if count_mode == "exact":
+        body["count"] = await Weather.objects.acount()
+    elif count_mode == "approx":
+        body["count"] = await sync_to_async(approximate_count)(Weather)
+    return fast_json_response(body)
+
+@require_http_methods(["GET"])
+@cached_weather_response
+async def weather_list(request):
+    limit, offset, error = parse_list_params(request)
+    if error:
+        return error
+
+    # keyset pagination when a cursor is given (an empty cursor is the first page)
+    if "cursor" in request.GET:
+        return await weather_list_keyset(request, limit)
+
+    qs = Weather.objects.order_by("id")
+    total_count = await qs.acount()
+    results, _ = serialize_weather_rows(await fetch_rows(qs[offset : offset + limit]))
+    return fast_json_response({"count": total_count, "results": results})
+
+@require_http_methods(["GET"])
+@cached_weather_response
+async def weather_detail(request, id):
+    include, error = parse_include(request)
+    if error:
+        return error
+
+    rows, synced_at = serialize_weather_rows(await fetch_rows(Weather.objects.filter(id=id)))
+    if not rows:
+        return JsonResponse({"detail": "Not Found"}, status = 404)
+
+    body = rows[0]
+    if "raw_payload" in include:
+        payload = await WeatherPayload.objects.filter(weather_id=id).afirst()
+        body["raw_payload"] = payload.raw_payload if payload else None
+    return set_last_modified(fast_json_response(body), synced_at)
+
+@csrf_protect
+@require_http_methods(["POST"])
+async def sync_weather(request):
+    # the trigger only talks to Redis and the broker, so it need not share
+    # the ORM's thread
+    task_id, started = await sync_to_async(start_sync_all_cities, thread_sensitive=False)(
+        force=parse_force(request),
+    )
+    return sync_started_response(task_id, started)
+
+@require_http_methods(["GET"])
+async def weather_feed(request):
+    """
+    Server-Sent Events stream of changed snapshots (see weather.feed).
+    Reconnecting EventSource clients send Last-Event-ID and get what they
+    missed first. Needs ASGI: under WSGI every open stream would hold a
+    worker thread.
+    """
+    if not isinstance(request, ASGIRequest):
+        return JsonResponse({"detail": "The change feed needs an ASGI server"}, status = 501)
+    response = StreamingHttpResponse(
+        feed_events(request.headers.get("Last-Event-ID")),
+        content_type="text/event-stream",
+    )
+    response["Cache-Control"] = "no-cache"
+    # stop nginx from buffering the stream
+    response["X-Accel-Buffering"] = "no"
+    return response
@@ -0,0 +1,132 @@
+import hashlib
+import logging
+import time
+from functools import wraps
+from asgiref.sync import iscoroutinefunction
+from django.conf import settings
+from django.core.cache import cache
+from django.http import HttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import parse_http_date_safe, quote_etag
+
+logger = logging.getLogger(__name__)
+
+VERSION_KEY = "weather:version"
+
+
+def _fresh_version():
+    # a missing version key (eviction, flush) must never reuse an old namespace
+    return time.time_ns() // 1000
+
+
+def get_weather_version():
+    """Current version of the weather data, part of every cached response key."""
+    version = cache.get(VERSION_KEY)
+    if version is None:
+        cache.add(VERSION_KEY, _fresh_version(), timeout=None)
+        version = cache.get(VERSION_KEY)
+    return version
+
+
+def bump_weather_version():
+    """
+    Invalidate every cached weather response. Called after sync writes; cache
+    errors are logged rather than failing the write.
+    """
+    try:
+        cache.incr(VERSION_KEY)
+    except ValueError:
+        cache.add(VERSION_KEY, _fresh_version(), timeout=None)
+    except Exception:
+        logger.exception("Could not bump weather cache version")
+
+
+def _response_key(request, version):
+    url_hash = hashlib.md5(request.build_absolute_uri().encode()).hexdigest()
+    return "weather:response:%s:%s" % (version, url_hash)
+
+
+def _cache_entry(response):
+    return {
+        "content": response.content,
+        "content_type": response["Content-Type"],
+        "etag": quote_etag(hashlib.md5(response.content).hexdigest()),
+        "last_modified": response.get("Last-Modified"),
+    }
+
+
+def _cached_response(request, entry):
+    response = HttpResponse(entry["content"], content_type=entry["content_type"])
+    response["ETag"] = entry["etag"]
+    if entry["last_modified"]:
+        response["Last-Modified"] = entry["last_modified"]
+    return get_conditional_response(
+        request,
+        etag=entry["etag"],
+        last_modified=parse_http_date_safe(entry["last_modified"]) if entry["last_modified"] else None,
+        response=response,
+    )
+
+
+async def aget_weather_version():
+    """Async get_weather_version, for async views."""
+    version = await cache.aget(VERSION_KEY)
+    if version is None:
+        await cache.aadd(VERSION_KEY, _fresh_version(), timeout=None)
+        version = await cache.aget(VERSION_KEY)
+    return version
+
+
+def cached_weather_response(view):
+    """
+    Cache successful GET responses of a weather read view until the next sync
+    write bumps the data version (or WEATHER_RESPONSE_CACHE_TTL expires), and
+    answer If-None-Match / If-Modified-Since with 304 Not Modified.
+    Single-row views set Last-Modified from synced_at; list pages set none, as
+    rows outside the page change it too. The ETag is a hash of the body.
+    Works on sync and async views alike.
+    """
+    if iscoroutinefunction(view):
+        @wraps(view)
+        async def async_wrapper(request, *args, **kwargs):
+            try:
+                key = _response_key(request, await aget_weather_version())
+                entry = await cache.aget(key)
+            except Exception:
+                logger.exception("Weather response cache unavailable")
+                return await view(request, *args, **kwargs)
+
+            if entry is None:
+                response = await view(request, *args, **kwargs)
+                if response.status_code != 200:
+                    return response
+                entry = _cache_entry(response)
+                try:
+                    await cache.aset(key, entry, settings.WEATHER_RESPONSE_CACHE_TTL)
+                except Exception:
+                    logger.exception("Weather response cache unavailable")
+            return _cached_response(request, entry)
+
+        return async_wrapper
+
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        try:
+            key = _response_key(request, get_weather_version())
+            entry = cache.get(key)
+        except Exception:
+            logger.exception("Weather response cache unavailable")
+            return view(request, *args, **kwargs)
+
+        if entry is None:
+            response = view(request, *args, **kwargs)
+            if response.status_code != 200:
+                return response
+            entry = _cache_entry(response)
+            try:
+                cache.set(key, entry, settings.WEATHER_RESPONSE_CACHE_TTL)
+            except Exception:
+                logger.exception("Weather response cache unavailable")
+        return _cached_response(request, entry)
+
+    return wrapper
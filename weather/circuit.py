@@ -0,0 +1,115 @@
+import logging
+import time
+from django.conf import settings
+from django.core.cache import cache
+
+logger = logging.getLogger(__name__)
+
+
+class CircuitOpen(Exception):
+    """The upstream is considered down; the request was not sent."""
+    def __init__(self, retry_after):
+        super().__init__("circuit open, retry in %.1fs" % retry_after)
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker for one upstream, with its state in the shared cache so
+    every worker sees the same circuit.
+
+    closed: requests go through; WEATHER_CIRCUIT_FAILURE_THRESHOLD failures
+        within WEATHER_CIRCUIT_FAILURE_WINDOW seconds open the circuit.
+    open: requests fail fast with CircuitOpen for WEATHER_CIRCUIT_OPEN_SECONDS.
+    half-open: one caller (cache.add wins) sends a probe; its success closes
+        the circuit, its failure opens it again. Everyone else still fails fast,
+        and outcomes of requests that are not the probe (e.g. sent before the
+        circuit opened) leave an open circuit alone. A probe that says nothing
+        about the upstream (never sent, or throttled) is released for the
+        next caller.
+
+    Cache errors are logged and treated as a closed circuit.
+    """
+    def __init__(self, name):
+        self.state_key = "weather:circuit:%s" % name
+        self.failures_key = "weather:circuit:%s:failures" % name
+        self.probe_key = "weather:circuit:%s:probe" % name
+
+    def before_request(self):
+        """
+        Raise CircuitOpen unless a request may be sent now. Returns True when
+        the request is the half-open probe, to be passed back with its outcome.
+        """
+        try:
+            opened_until = cache.get(self.state_key)
+            if opened_until is None:
+                return False
+            remaining = opened_until - time.time()
+            if remaining > 0:
+                raise CircuitOpen(remaining)
+            if not cache.add(self.probe_key, 1, timeout=settings.WEATHER_CIRCUIT_PROBE_TIMEOUT):
+                raise CircuitOpen(settings.WEATHER_CIRCUIT_PROBE_TIMEOUT)
+            logger.info("Circuit %s half-open, sending probe", self.state_key)
+            return True
+        except CircuitOpen:
+            raise
+        except Exception:
+            logger.exception("Circuit breaker state unavailable")
+            return False
+
+    def open_for(self):
+        """Seconds until the circuit lets a request through again (0 if closed)."""
+        try:
+            opened_until = cache.get(self.state_key)
+        except Exception:
+            logger.exception("Circuit breaker state unavailable")
+            return 0
+        return max(0, opened_until - time.time()) if opened_until is not None else 0
+
+    def record_success(self, probe=False):
+        """Only the half-open probe (before_request returned True) closes the circuit."""
+        if not probe:
+            return
+        try:
+            cache.delete_many([self.state_key, self.failures_key, self.probe_key])
+            logger.info("Circuit %s closed", self.state_key)
+        except Exception:
+            logger.exception("Circuit breaker state unavailable")
+
+    def release_probe(self, probe):
+        """
+        Give back the half-open probe slot won by before_request without an
+        outcome, so the next caller probes instead of failing fast until
+        WEATHER_CIRCUIT_PROBE_TIMEOUT.
+        """
+        if not probe:
+            return
+        try:
+            cache.delete(self.probe_key)
+        except Exception:
+            logger.exception("Circuit breaker state unavailable")
+
+    def record_failure(self, probe=False):
+        try:
+            if probe:
+                self._open()
+                return
+            if cache.get(self.state_key) is not None:
+                # sent before the circuit opened; the probe decides
+                return
+            cache.add(self.failures_key, 0, timeout=settings.WEATHER_CIRCUIT_FAILURE_WINDOW)
+            if cache.incr(self.failures_key) >= settings.WEATHER_CIRCUIT_FAILURE_THRESHOLD:
+                self._open()
+        except ValueError:
+            # the failure window expired between add() and incr()
+            pass
+        except Exception:
+            logger.exception("Circuit breaker state unavailable")
+
+    def _open(self):
+        cache.set(self.state_key, time.time() + settings.WEATHER_CIRCUIT_OPEN_SECONDS, timeout=None)
+        cache.delete_many([self.failures_key, self.probe_key])
+        logger.warning("Circuit %s opened for %ss", self.state_key, settings.WEATHER_CIRCUIT_OPEN_SECONDS)
+
+
+open_meteo_circuit = CircuitBreaker("open-meteo")
@@ -0,0 +1,212 @@
+import asyncio
+import logging
+import math
+import time
+from django.conf import settings
+from django.core.cache import cache
+from .metrics import COALESCED_FETCHES_TOTAL
+
+logger = logging.getLogger(__name__)
+
+# Open-Meteo snaps coordinates to its model grid, so cities closer together
+# than a grid cell get the same data. With WEATHER_FETCH_GRID_DEGREES set,
+# coordinates are rounded to that grid before fetching: each distinct point is
+# fetched once and its payload fanned out to every city on it, and payloads
+# are shared between workers through the cache for WEATHER_GRID_CACHE_TTL.
+# A worker about to fetch a point marks it in flight (cache.add); concurrent
+# workers needing the same point wait for its payload instead of fetching it
+# again, for up to WEATHER_FETCH_INFLIGHT_WAIT seconds.
+
+INFLIGHT_POLL_SECONDS = 0.05
+
+
+def fetch_point(city_data):
+    """The (latitude, longitude) to request for a city."""
+    step = settings.WEATHER_FETCH_GRID_DEGREES
+    latitude, longitude = city_data["latitude"], city_data["longitude"]
+    if not step:
+        return latitude, longitude
+    return round(round(latitude / step) * step, 6), round(round(longitude / step) * step, 6)
+
+
+def _cache_key(point):
+    return "weather:grid:%s:%s,%s" % (settings.WEATHER_FETCH_GRID_DEGREES, point[0], point[1])
+
+
+def _inflight_key(point):
+    return "weather:grid-inflight:%s:%s,%s" % (settings.WEATHER_FETCH_GRID_DEGREES, point[0], point[1])
+
+
+def _inflight_timeout():
+    return math.ceil(settings.WEATHER_FETCH_INFLIGHT_WAIT)
+
+
+def get_cached_payloads(points):
+    """Payloads other workers fetched recently, as {point: payload}."""
+    if not settings.WEATHER_FETCH_GRID_DEGREES:
+        return {}
+    keys = {_cache_key(p): p for p in points}
+    try:
+        found = cache.get_many(keys)
+    except Exception:
+        logger.exception("Grid payload cache unavailable")
+        return {}
+    return {keys[key]: payload for key, payload in found.items()}
+
+
+def cache_payloads(payloads):
+    """Share freshly fetched {point: payload} with other workers."""
+    if not settings.WEATHER_FETCH_GRID_DEGREES or not payloads:
+        return
+    try:
+        cache.set_many(
+            {_cache_key(p): payload for p, payload in payloads.items()},
+            settings.WEATHER_GRID_CACHE_TTL,
+        )
+    except Exception:
+        logger.exception("Grid payload cache unavailable")
+
+
+def claim_fetches(points):
+    """
+    Mark `points` as being fetched by this worker. Returns the set claimed;
+    the others are in flight in another worker. Everything is claimed when
+    coalescing is off or the cache is unavailable.
+    """
+    if not settings.WEATHER_FETCH_GRID_DEGREES:
+        return set(points)
+    try:
+        return {p for p in points if cache.add(_inflight_key(p), 1, _inflight_timeout())}
+    except Exception:
+        logger.exception("Grid payload cache unavailable")
+        return set(points)
+
+
+def release_fetches(points):
+    """Clear the in-flight marks of claim_fetches, fetched or not."""
+    if not settings.WEATHER_FETCH_GRID_DEGREES or not points:
+        return
+    try:
+        cache.delete_many([_inflight_key(p) for p in points])
+    except Exception:
+        logger.exception("Grid payload cache unavailable")
+
+
+def wait_for_payloads(points):
+    """
+    Wait for the payloads of `points` other workers are fetching, until they
+    are cached, their fetch ends without one, or WEATHER_FETCH_INFLIGHT_WAIT
+    has passed. Returns {point: payload} of those that arrived.
+    """
+    found = {}
+    waiting = set(points)
+    deadline = time.monotonic() + settings.WEATHER_FETCH_INFLIGHT_WAIT
+    while waiting and time.monotonic() < deadline:
+        time.sleep(INFLIGHT_POLL_SECONDS)
+        found.update(get_cached_payloads(waiting))
+        waiting -= found.keys()
+        try:
+            inflight = cache.get_many([_inflight_key(p) for p in waiting])
+        except Exception:
+            logger.exception("Grid payload cache unavailable")
+            break
+        waiting = {p for p in waiting if _inflight_key(p) in inflight}
+    return found
+
+
+def fetch_coalesced(points, fetch):
+    """
+    Payloads for `points` as {point: payload}, each distinct point requested
+    once across workers: cached payloads are reused, points another worker is
+    fetching are waited for, and the rest go to `fetch(points)`, which returns
+    {point: payload} (and raises for the whole request). Fetched payloads are
+    cached for other workers.
+    """
+    payloads = get_cached_payloads(set(points))
+    cached = sum(1 for p in points if p in payloads)
+    missing = list(dict.fromkeys(p for p in points if p not in payloads))
+    requested = 0
+
+    claimed = claim_fetches(missing)
+    try:
+        mine = [p for p in missing if p in claimed]
+        if mine:
+            fetched = fetch(mine)
+            requested += len(mine)
+            cache_payloads(fetched)
+            payloads.update(fetched)
+    finally:
+        release_fetches(claimed)
+
+    others = [p for p in missing if p not in claimed]
+    if others:
+        payloads.update(wait_for_payloads(others))
+        # the other worker failed or is too slow: fetch them after all
+        leftovers = [p for p in others if p not in payloads]
+        if leftovers:
+            fetched = fetch(leftovers)
+            requested += len(leftovers)
+            cache_payloads(fetched)
+            payloads.update(fetched)
+
+    if cached:
+        COALESCED_FETCHES_TOTAL.labels("cache").inc(cached)
+    if len(points) - cached > requested:
+        COALESCED_FETCHES_TOTAL.labels("shared").inc(len(points) - cached - requested)
+    return payloads
+
+
+async def aget_cached_payload(point):
+    if not settings.WEATHER_FETCH_GRID_DEGREES:
+        return None
+    try:
+        return await cache.aget(_cache_key(point))
+    except Exception:
+        logger.exception("Grid payload cache unavailable")
+        return None
+
+
+async def acache_payload(point, payload):
+    if not settings.WEATHER_FETCH_GRID_DEGREES:
+        return
+    try:
+        await cache.aset(_cache_key(point), payload, settings.WEATHER_GRID_CACHE_TTL)
+    except Exception:
+        logger.exception("Grid payload cache unavailable")
+
+
+async def aclaim_fetch(point):
+    """Async claim_fetches for one point."""
+    if not settings.WEATHER_FETCH_GRID_DEGREES:
+        return True
+    try:
+        return await cache.aadd(_inflight_key(point), 1, _inflight_timeout())
+    except Exception:
+        logger.exception("Grid payload cache unavailable")
+        return True
+
+
+async def arelease_fetch(point):
+    if not settings.WEATHER_FETCH_GRID_DEGREES:
+        return
+    try:
+        await cache.adelete(_inflight_key(point))
+    except Exception:
+        logger.exception("Grid payload cache unavailable")
+
+
+async def await_payload(point):
+    """Async wait_for_payloads for one point: the payload, or None."""
+    deadline = time.monotonic() + settings.WEATHER_FETCH_INFLIGHT_WAIT
+    while time.monotonic() < deadline:
+        await asyncio.sleep(INFLIGHT_POLL_SECONDS)
+        payload = await aget_cached_payload(point)
+        if payload is not None:
+            return payload
+        try:
+            if not await cache.ahas_key(_inflight_key(point)):
+                return None
+        except Exception:
+            logger.exception("Grid payload cache unavailable")
+            return None
+    return None
@@ -1,6 +0,0 @@
-CITIES = [
-    {"city_name": "Paris", "latitude": 48.8566, "longitude": 2.3522},
-    {"city_name": "London", "latitude": 51.5074, "longitude": -0.1278},
-    {"city_name": "New York", "latitude": 40.7128, "longitude": -74.0060},
-    {"city_name": "Tokyo", "latitude": 35.6762, "longitude": 139.6503},
-]
@@ -0,0 +1,192 @@
+import asyncio
+import json
+import logging
+import re
+import redis.asyncio
+from django.conf import settings
+from redis.exceptions import RedisError
+from .redis_client import get_redis
+from .serializers import serialize_weather
+
+logger = logging.getLogger(__name__)
+
+# Change feed: the sync write path appends every changed snapshot to a
+# bounded Redis stream (whose entry ids are the SSE event ids) and publishes
+# it on a pub/sub channel as "<id> <json>". Live clients follow the channel
+# through one subscription per process (FeedHub); reconnecting ones replay
+# the stream after their Last-Event-ID first.
+FEED_STREAM = "weather:feed"
+FEED_CHANNEL = "weather:feed"
+
+# KEYS: stream. ARGV: channel, max stream length, then one JSON snapshot per event.
+PUBLISH_SCRIPT = """
+local channel, maxlen = ARGV[1], ARGV[2]
+for i = 3, #ARGV do
+    local id = redis.call('XADD', KEYS[1], 'MAXLEN', '~', maxlen, '*', 'data', ARGV[i])
+    redis.call('PUBLISH', channel, id .. ' ' .. ARGV[i])
+end
+return #ARGV - 2
+"""
+
+EVENT_ID_RE = re.compile(r"^\d+-\d+$")
+# how long EventSource clients wait before reconnecting
+RECONNECT_MS = 5000
+
+
+def publish_changes(weathers):
+    """
+    Publish saved Weather snapshots to the change feed. Called after the
+    write commits; Redis errors are logged and never fail a sync.
+    """
+    if not settings.WEATHER_FEED_ENABLED or not weathers:
+        return
+    snapshots = [json.dumps(serialize_weather(w)) for w in weathers]
+    try:
+        get_redis().eval(PUBLISH_SCRIPT, 1, FEED_STREAM, FEED_CHANNEL, settings.WEATHER_FEED_MAXLEN, *snapshots)
+    except RedisError:
+        logger.exception("Could not publish %d snapshots to the change feed", len(snapshots))
+
+
+def event_id_key(event_id):
+    """Sort key of a stream entry id ("<ms>-<seq>")."""
+    ms, seq = event_id.split("-")
+    return int(ms), int(seq)
+
+
+def format_event(event_id, data, event=None):
+    lines = ["id: %s" % event_id]
+    if event:
+        lines.append("event: %s" % event)
+    lines.append("data: %s" % data)
+    return "\n".join(lines) + "\n\n"
+
+
+class FeedHub:
+    """
+    The change feed subscription of one process (and event loop), shared by
+    all its open streams: a reader task fans every message out to a bounded
+    asyncio.Queue per client, so open streams do not cost a Redis connection
+    each. A client that falls WEATHER_FEED_CLIENT_BUFFER events behind, or
+    every client when the subscription is lost, gets None and is
+    disconnected; EventSource reconnects and replays what it missed.
+    """
+    def __init__(self):
+        self.loop = asyncio.get_running_loop()
+        # also serves the replays, from its connection pool
+        self.client = redis.asyncio.Redis.from_url(settings.REDIS_URL)
+        self.queues = set()
+        self.reader = None
+        self.lock = asyncio.Lock()
+
+    async def subscribe(self):
+        """A queue receiving (event_id, data) for every event published from now on."""
+        queue = asyncio.Queue(maxsize=settings.WEATHER_FEED_CLIENT_BUFFER)
+        async with self.lock:
+            if self.reader is None:
+                pubsub = self.client.pubsub()
+                await pubsub.subscribe(FEED_CHANNEL)
+                self.reader = asyncio.create_task(self.read(pubsub))
+            self.queues.add(queue)
+        return queue
+
+    async def unsubscribe(self, queue):
+        async with self.lock:
+            self.queues.discard(queue)
+            # the last stream closed: drop the subscription until the next one
+            if not self.queues and self.reader is not None:
+                self.reader.cancel()
+                self.reader = None
+
+    async def read(self, pubsub):
+        try:
+            async for message in pubsub.listen():
+                if message["type"] != "message":
+                    continue
+                event = tuple(message["data"].decode().split(" ", 1))
+                for queue in list(self.queues):
+                    self.deliver(queue, event)
+        except RedisError:
+            logger.exception("Change feed subscription lost")
+            self.reader = None
+            for queue in list(self.queues):
+                self.deliver(queue, None)
+        finally:
+            await pubsub.aclose()
+
+    @staticmethod
+    def deliver(queue, event):
+        try:
+            queue.put_nowait(event)
+        except asyncio.QueueFull:
+            # too slow to keep up: drop its backlog and disconnect it
+            while not queue.empty():
+                queue.get_nowait()
+            queue.put_nowait(None)
+
+
+_hub = None
+
+
+def get_hub():
+    """The FeedHub of the running event loop."""
+    global _hub
+    if _hub is None or _hub.loop is not asyncio.get_running_loop():
+        _hub = FeedHub()
+    return _hub
+
+
+async def replay(client, last_event_id):
+    """
+    Events after `last_event_id` still in the stream, as (id, data). If the
+    stream was trimmed past it, yields a single "reset" event instead, telling
+    the client to reload the full list.
+    """
+    oldest = await client.xrange(FEED_STREAM, count=1)
+    if oldest and event_id_key(oldest[0][0].decode()) > event_id_key(last_event_id):
+        if not await client.xrange(FEED_STREAM, min=last_event_id, max=last_event_id):
+            yield oldest[0][0].decode(), None
+            return
+    entries = await client.xrange(FEED_STREAM, min="(" + last_event_id, count=settings.WEATHER_FEED_MAXLEN)
+    for entry_id, fields in entries:
+        yield entry_id.decode(), fields[b"data"].decode()
+
+
+async def feed_events(last_event_id=None):
+    """
+    Server-Sent Events for the change feed: replayed events after
+    `last_event_id`, then live ones, with a comment line every
+    WEATHER_FEED_KEEPALIVE seconds so proxies keep the connection open.
+    Ends when the client falls behind or the subscription is lost.
+    """
+    if last_event_id is not None and not EVENT_ID_RE.match(last_event_id):
+        last_event_id = None
+    hub = get_hub()
+    # subscribe before replaying, so nothing published in between is lost
+    queue = await hub.subscribe()
+    try:
+        yield "retry: %d\n\n" % RECONNECT_MS
+
+        if last_event_id is not None:
+            async for event_id, data in replay(hub.client, last_event_id):
+                if data is None:
+                    yield format_event(event_id, "{}", event="reset")
+                else:
+                    yield format_event(event_id, data)
+                last_event_id = event_id
+
+        while True:
+            try:
+                event = await asyncio.wait_for(queue.get(), settings.WEATHER_FEED_KEEPALIVE)
+            except asyncio.TimeoutError:
+                yield ": keepalive\n\n"
+                continue
+            if event is None:
+                return
+            event_id, data = event
+            # already sent by the replay
+            if last_event_id is not None and event_id_key(event_id) <= event_id_key(last_event_id):
+                continue
+            yield format_event(event_id, data)
+            last_event_id = event_id
+    finally:
+        await hub.unsubscribe(queue)
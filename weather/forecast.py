@@ -0,0 +1,134 @@
+import hashlib
+import logging
+import warnings
+from datetime import timedelta
+import numpy as np
+from django.conf import settings
+from .models import HourlyForecast
+from .utils import parse_upstream_time
+
+logger = logging.getLogger(__name__)
+
+# Hourly forecasts are stored as (variables x hours) float32 matrices, four
+# bytes a value. Reads decode every requested city with np.frombuffer onto
+# one shared hourly time axis, so slicing a window and downsampling it are a
+# few array operations whatever the number of cities: forecasts of one sync
+# share start, hours and variables, and are decoded and sliced together.
+DTYPE = np.dtype("<f4")
+HOUR = timedelta(hours=1)
+
+# downsampling functions accepted by forecast_window; all-NaN buckets stay NaN
+AGGREGATES = {
+    "mean": np.nanmean,
+    "min": np.nanmin,
+    "max": np.nanmax,
+}
+
+
+def pack_hourly(data):
+    """
+    (start, hours, variables, packed bytes) for the WEATHER_HOURLY_VARIABLES
+    present in the "hourly" block of an Open-Meteo payload, or None when it
+    has none. Raises ValueError when the arrays do not match the time axis.
+    """
+    hourly = data.get("hourly") or {}
+    times = hourly.get("time") or []
+    variables = [name for name in settings.WEATHER_HOURLY_VARIABLES if name in hourly]
+    if not times or not variables:
+        return None
+    matrix = np.array(
+        [[np.nan if value is None else value for value in hourly[name]] for name in variables],
+        dtype=DTYPE,
+    )
+    if matrix.ndim != 2 or matrix.shape[1] != len(times):
+        raise ValueError("hourly arrays do not match the %d hourly times" % len(times))
+    return parse_upstream_time(times[0]), len(times), variables, matrix.tobytes()
+
+
+def forecast_hash(start, variables, data):
+    """128-bit hex digest of a packed forecast."""
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(("%s|%s|" % (start.isoformat(), ",".join(variables))).encode())
+    digest.update(data)
+    return digest.hexdigest()
+
+
+def save_forecasts(weathers, payloads):
+    """
+    Upsert the packed hourly forecast of each saved Weather row that has a
+    valid one, unless it is identical to the stored one.
+    `payloads` maps city_name -> payload. Returns the number of rows written.
+    """
+    stored = dict(
+        HourlyForecast.objects.filter(weather_id__in=[w.pk for w in weathers])
+        .values_list("weather_id", "content_hash")
+    )
+    rows = []
+    for w in weathers:
+        try:
+            packed = pack_hourly(payloads[w.city_name])
+        except (TypeError, ValueError):
+            # the current weather is still saved
+            logger.warning("Invalid hourly forecast city=%s", w.city_name, exc_info=True)
+            continue
+        if packed is None:
+            continue
+        start, hours, variables, data = packed
+        digest = forecast_hash(start, variables, data)
+        if stored.get(w.pk) != digest:
+            rows.append(HourlyForecast(
+                weather_id=w.pk, start=start, hours=hours, variables=",".join(variables), data=data,
+                content_hash=digest,
+            ))
+    HourlyForecast.objects.bulk_create(
+        rows,
+        update_conflicts=True,
+        unique_fields=["weather"],
+        update_fields=["start", "hours", "variables", "data", "content_hash"],
+    )
+    return len(rows)
+
+
+def unpack(forecast):
+    """The (variables x hours) float32 matrix of an HourlyForecast."""
+    return np.frombuffer(forecast.data, dtype=DTYPE).reshape(-1, forecast.hours)
+
+
+def forecast_window(forecasts, variables, start, hours, step=1, aggregate="mean"):
+    """
+    Values of `variables` for every forecast over `hours` hours from `start`
+    (a whole hour), downsampled to buckets of `step` hours with `aggregate`.
+    Hours a forecast does not cover are NaN. Returns {variable: array of
+    shape (len(forecasts), hours // step)}.
+    Forecasts sharing (start, hours, variables) are decoded as one
+    (forecasts x variables x hours) array and sliced with one indexing
+    operation; a forecast that shares them with no other is a group of one.
+    """
+    buckets = hours // step
+    window = {name: np.full((len(forecasts), buckets * step), np.nan, dtype=DTYPE) for name in variables}
+    groups = {}
+    for i, forecast in enumerate(forecasts):
+        groups.setdefault((forecast.start, forecast.hours, forecast.variables), []).append(i)
+
+    for (forecast_start, forecast_hours, stored), rows in groups.items():
+        names = stored.split(",")
+        present = [name for name in variables if name in names]
+        # overlap of the forecasts' hours with the window, in window positions
+        offset = int((forecast_start - start) / HOUR)
+        first, last = max(0, offset), min(buckets * step, offset + forecast_hours)
+        if first >= last or not present:
+            continue
+        cube = np.frombuffer(b"".join(forecasts[i].data for i in rows), dtype=DTYPE)
+        cube = cube.reshape(len(rows), len(names), forecast_hours)
+        values = cube[:, [names.index(name) for name in present], first - offset:last - offset]
+        for j, name in enumerate(present):
+            window[name][rows, first:last] = values[:, j]
+
+    reduce = AGGREGATES[aggregate]
+    with warnings.catch_warnings():
+        # all-NaN buckets (hours no forecast covers) are expected
+        warnings.simplefilter("ignore", RuntimeWarning)
+        return {
+            name: reduce(values.reshape(len(forecasts), buckets, step), axis=2)
+            for name, values in window.items()
+        }
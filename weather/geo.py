@@ -0,0 +1,66 @@
+import math
+
+EARTH_RADIUS_KM = 6371.0088
+# half the circumference: no two points on the globe are further apart
+MAX_DISTANCE_KM = math.pi * EARTH_RADIUS_KM
+
+# Weather.grid_cell numbers 1x1 degree cells row by row from the south pole,
+# so the cells of one latitude row are a contiguous integer range.
+GRID_COLUMNS = 360
+GRID_ROWS = 180
+
+
+def grid_cell(latitude, longitude):
+    """Index of the 1x1 degree cell containing a coordinate."""
+    row = min(int(math.floor(latitude + 90)), GRID_ROWS - 1)
+    column = int(math.floor(longitude + 180)) % GRID_COLUMNS
+    return row * GRID_COLUMNS + column
+
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    """Great-circle distance between two coordinates in kilometres."""
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    dphi = phi2 - phi1
+    dlambda = math.radians(lon2 - lon1)
+    a = math.sin(dphi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(dlambda / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+
+def _column_ranges(longitude, dlon):
+    if dlon >= 180:
+        return [(0, GRID_COLUMNS - 1)]
+    first = int(math.floor(longitude - dlon + 180))
+    last = int(math.floor(longitude + dlon + 180))
+    # the box crosses the antimeridian
+    if first < 0:
+        return [(first + GRID_COLUMNS, GRID_COLUMNS - 1), (0, last)]
+    if last >= GRID_COLUMNS:
+        return [(first, GRID_COLUMNS - 1), (0, last - GRID_COLUMNS)]
+    return [(first, last)]
+
+
+def grid_cell_ranges(latitude, longitude, radius_km):
+    """
+    (first, last) grid_cell ranges covering every point within radius_km of a
+    coordinate: the bounding box of the circle, one range per latitude row
+    (two where the box crosses the antimeridian).
+    """
+    angular = radius_km / EARTH_RADIUS_KM
+    dlat = math.degrees(angular)
+    lat_min, lat_max = latitude - dlat, latitude + dlat
+
+    if lat_min <= -90 or lat_max >= 90:
+        # the circle contains a pole, so it spans every longitude
+        dlon = 180
+    else:
+        ratio = math.sin(angular) / math.cos(math.radians(latitude))
+        dlon = 180 if ratio >= 1 else math.degrees(math.asin(ratio))
+
+    first_row = max(int(math.floor(lat_min + 90)), 0)
+    last_row = min(int(math.floor(lat_max + 90)), GRID_ROWS - 1)
+    columns = _column_ranges(longitude, dlon)
+    return [
+        (row * GRID_COLUMNS + first, row * GRID_COLUMNS + last)
+        for row in range(first_row, last_row + 1)
+        for first, last in columns
+    ]
@@ -0,0 +1,148 @@
+import logging
+import re
+from datetime import datetime, timedelta, timezone as dt_timezone
+from django.db import connection, transaction
+from django.db.models import Avg, Count, Max, Min
+from django.db.models.functions import TruncDay, TruncHour, TruncWeek
+from django.utils import timezone
+from .models import Observation
+
+logger = logging.getLogger(__name__)
+
+OBSERVATION_TABLE = "weather_observation"
+DEFAULT_PARTITION = "weather_observation_default"
+PARTITION_NAME_RE = re.compile(r"^weather_observation_p(\d{8})$")
+
+# downsampling buckets accepted by observation_series
+BUCKETS = {
+    "hour": TruncHour,
+    "day": TruncDay,
+    "week": TruncWeek,
+}
+# upper bound on rows returned for bucket=raw
+MAX_RAW_OBSERVATIONS = 10000
+
+SERIES_FIELDS = ("temperature", "windspeed")
+
+
+def partition_name(day):
+    return "weather_observation_p%s" % day.strftime("%Y%m%d")
+
+
+def _day_bounds(day):
+    start = datetime(day.year, day.month, day.day, tzinfo=dt_timezone.utc)
+    return start, start + timedelta(days=1)
+
+
+def record_observations(weathers):
+    """Append one history row per saved Weather snapshot."""
+    Observation.objects.bulk_create([
+        Observation(
+            city_name=w.city_name,
+            temperature=w.temperature,
+            windspeed=w.windspeed,
+            winddirection=w.winddirection,
+            weathercode=w.weathercode,
+            time=w.time,
+            synced_at=w.synced_at,
+        )
+        for w in weathers
+    ])
+
+
+def ensure_observation_partitions(days_ahead, today=None):
+    """
+    Make sure daily partitions exist from `today` through `days_ahead` days
+    later. Rows that already landed in the default partition for a new day are
+    moved into it. Returns the names of the partitions created.
+    """
+    today = today or timezone.now().date()
+    created = []
+    for offset in range(days_ahead + 1):
+        day = today + timedelta(days=offset)
+        name = partition_name(day)
+        start, end = _day_bounds(day)
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute("SELECT to_regclass(%s)", [name])
+            if cursor.fetchone()[0] is not None:
+                continue
+            # bounds are generated here, never user input
+            bounds = "FROM ('%s') TO ('%s')" % (start.isoformat(), end.isoformat())
+            cursor.execute("CREATE TABLE %s (LIKE %s INCLUDING DEFAULTS)" % (name, OBSERVATION_TABLE))
+            cursor.execute(
+                "WITH moved AS (DELETE FROM %s WHERE synced_at >= %%s AND synced_at < %%s RETURNING *) "
+                "INSERT INTO %s SELECT * FROM moved" % (DEFAULT_PARTITION, name),
+                [start, end],
+            )
+            cursor.execute("ALTER TABLE %s ATTACH PARTITION %s FOR VALUES %s" % (OBSERVATION_TABLE, name, bounds))
+        logger.info("Created observation partition %s", name)
+        created.append(name)
+    return created
+
+
+def drop_expired_observation_partitions(retention_days, today=None):
+    """
+    Drop daily partitions that end before the retention cutoff. Dropping a
+    partition is a catalog operation, with no row-by-row DELETE or vacuum.
+    Returns the names of the partitions dropped.
+    """
+    today = today or timezone.now().date()
+    cutoff = today - timedelta(days=retention_days)
+    dropped = []
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT c.relname FROM pg_inherits i "
+            "JOIN pg_class c ON c.oid = i.inhrelid "
+            "WHERE i.inhparent = %s::regclass",
+            [OBSERVATION_TABLE],
+        )
+        names = [row[0] for row in cursor.fetchall()]
+
+        for name in sorted(names):
+            match = PARTITION_NAME_RE.match(name)
+            if not match:
+                continue
+            day = datetime.strptime(match.group(1), "%Y%m%d").date()
+            if day < cutoff:
+                cursor.execute("DROP TABLE %s" % name)
+                logger.info("Dropped observation partition %s", name)
+                dropped.append(name)
+
+        # anything that fell into the default partition ages out the slow way
+        cursor.execute(
+            "DELETE FROM %s WHERE synced_at < %%s" % DEFAULT_PARTITION,
+            [_day_bounds(cutoff)[0]],
+        )
+    return dropped
+
+
+def observation_series(city_name, start, end, bucket):
+    """
+    Observations for a city with start <= synced_at < end. With bucket="raw"
+    every row is returned (up to MAX_RAW_OBSERVATIONS); otherwise rows are
+    downsampled server-side to min/max/avg per hour, day or week.
+    """
+    qs = Observation.objects.filter(city_name=city_name, synced_at__gte=start, synced_at__lt=end)
+
+    if bucket == "raw":
+        rows = qs.order_by("synced_at").values(
+            "synced_at", "time", "temperature", "windspeed", "winddirection", "weathercode",
+        )[:MAX_RAW_OBSERVATIONS]
+        return [
+            dict(row, synced_at=row["synced_at"].isoformat(), time=row["time"].isoformat() if row["time"] else None)
+            for row in rows
+        ]
+
+    aggregates = {"count": Count("id")}
+    for field in SERIES_FIELDS:
+        aggregates["%s_min" % field] = Min(field)
+        aggregates["%s_max" % field] = Max(field)
+        aggregates["%s_avg" % field] = Avg(field)
+
+    rows = (
+        qs.annotate(bucket=BUCKETS[bucket]("synced_at"))
+        .values("bucket")
+        .annotate(**aggregates)
+        .order_by("bucket")
+    )
+    return [dict(row, bucket=row["bucket"].isoformat()) for row in rows]
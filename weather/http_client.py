@@ -0,0 +1,65 @@
+import os
+import httpx
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+
+_session = None
+_session_pid = None
+
+
+def build_http_session():
+    """
+    Build a requests.Session with a keep-alive connection pool for Open-Meteo.
+    Retries are left to the Celery tasks, so the adapter never retries itself.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=settings.OPEN_METEO_POOL_CONNECTIONS,
+        pool_maxsize=settings.OPEN_METEO_POOL_MAXSIZE,
+        max_retries=0,
+    )
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.headers.update({
+        "Accept-Encoding": "gzip, deflate",
+        "Connection": "keep-alive",
+    })
+    return session
+
+
+def get_http_session():
+    """
+    Return the session shared by every Open-Meteo call in this process.
+    Pooled sockets must not be shared across fork(), so a prefork worker
+    child builds its own session on first use.
+    """
+    global _session, _session_pid
+    pid = os.getpid()
+    if _session is None or _session_pid != pid:
+        _session = build_http_session()
+        _session_pid = pid
+    return _session
+
+
+def get_http_timeout():
+    """(connect, read) timeout in seconds for Open-Meteo requests."""
+    return (settings.OPEN_METEO_CONNECT_TIMEOUT, settings.OPEN_METEO_READ_TIMEOUT)
+
+
+def build_async_client(max_connections):
+    """
+    Build an httpx.AsyncClient for the asyncio sync engine, with the same
+    timeouts and gzip negotiation as the per-process requests session.
+    """
+    return httpx.AsyncClient(
+        limits=httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_connections,
+        ),
+        timeout=httpx.Timeout(
+            settings.OPEN_METEO_READ_TIMEOUT,
+            connect=settings.OPEN_METEO_CONNECT_TIMEOUT,
+        ),
+        headers={"Accept-Encoding": "gzip, deflate"},
+    )
@@ -0,0 +1,43 @@
+import csv
+from datetime import timedelta
+from django.core.management.base import BaseCommand, CommandError
+from weather.models import City
+from weather.utils import chunked
+
+
+class Command(BaseCommand):
+    help = (
+        "Load cities from a CSV file with name,latitude,longitude and an optional "
+        "refresh_interval (seconds) column. Existing cities are updated by name."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("path", help="CSV file with a header row.")
+        parser.add_argument("--batch-size", type=int, default=1000)
+
+    def rows(self, reader):
+        for line, row in enumerate(reader, start=2):
+            try:
+                city = City(
+                    name=row["name"].strip(),
+                    latitude=float(row["latitude"]),
+                    longitude=float(row["longitude"]),
+                )
+                if row.get("refresh_interval"):
+                    city.refresh_interval = timedelta(seconds=int(row["refresh_interval"]))
+            except (KeyError, TypeError, ValueError) as e:
+                raise CommandError("Invalid row on line %d: %s" % (line, e))
+            yield city
+
+    def handle(self, *args, **options):
+        total = 0
+        with open(options["path"], newline="", encoding="utf-8") as f:
+            for batch in chunked(self.rows(csv.DictReader(f)), options["batch_size"]):
+                City.objects.bulk_create(
+                    batch,
+                    update_conflicts=True,
+                    unique_fields=["name"],
+                    update_fields=["latitude", "longitude", "refresh_interval"],
+                )
+                total += len(batch)
+        self.stdout.write(self.style.SUCCESS("Imported %d cities" % total))
@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand
+from weather.async_sync import run_async_sync
+from weather.models import City
+
+
+class Command(BaseCommand):
+    help = "Sync every enabled city from this process using the asyncio sync engine."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--concurrency",
+            type=int,
+            default=None,
+            help="Maximum requests in flight (default: WEATHER_ASYNC_CONCURRENCY).",
+        )
+        parser.add_argument(
+            "--force",
+            action="store_true",
+            help="Also refetch cities whose snapshot is still fresh.",
+        )
+
+    def handle(self, *args, **options):
+        cities = City.objects.enabled()
+        if not options["force"]:
+            cities = cities.stale()
+        results = run_async_sync(cities.order_by("id").sync_payloads(), options["concurrency"])
+        succeeded = sum(results.values())
+        self.stdout.write(
+            self.style.SUCCESS(
+                "Synced %d cities: %d ok, %d failed"
+                % (len(results), succeeded, len(results) - succeeded)
+            )
+        )
@@ -0,0 +1,185 @@
+import os
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.db import connection
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+
+# With PROMETHEUS_MULTIPROC_DIR set (required for prefork Celery workers and
+# multi-process web servers), every process writes its samples to files in
+# that directory and /metrics aggregates them; the directory must be emptied
+# before the processes start. Without it, metrics are per process.
+
+UPSTREAM_REQUEST_SECONDS = Histogram(
+    "weather_upstream_request_seconds",
+    "Open-Meteo request latency.",
+    ["outcome"],
+)
+PARSE_SECONDS = Histogram(
+    "weather_parse_seconds",
+    "Time spent decoding and parsing Open-Meteo payloads, per response or chunk.",
+    ["mode"],
+    buckets=(0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25),
+)
+DB_WRITE_SECONDS = Histogram(
+    "weather_db_write_seconds",
+    "Time spent writing synced snapshots to the database, per transaction.",
+    ["mode"],
+)
+CITY_SYNC_TOTAL = Counter(
+    "weather_city_sync_total",
+    "Per-city sync outcomes.",
+    ["outcome"],
+)
+SNAPSHOT_WRITES_TOTAL = Counter(
+    "weather_snapshot_writes_total",
+    "Synced snapshots, by whether they changed (and were written) or not.",
+    ["result"],
+)
+TASK_RETRIES_TOTAL = Counter(
+    "weather_task_retries_total",
+    "Sync task retries and deferrals.",
+    ["task", "reason"],
+)
+COALESCED_FETCHES_TOTAL = Counter(
+    "weather_coalesced_fetches_total",
+    "City payloads served without their own Open-Meteo fetch.",
+    ["source"],
+)
+VIEW_SECONDS = Histogram(
+    "weather_view_seconds",
+    "API view latency (time to first byte for streaming responses).",
+    ["view", "method", "status"],
+)
+VIEW_QUERIES = Histogram(
+    "weather_view_queries",
+    "Database queries per API request.",
+    ["view"],
+    buckets=(0, 1, 2, 3, 5, 10, 20, 50, 100),
+)
+
+
+def upstream_outcome(status):
+    """Label for an Open-Meteo response status (None for a network error)."""
+    if status is None:
+        return "network_error"
+    if status == 429:
+        return "throttled"
+    if status >= 500:
+        return "server_error"
+    if status >= 400:
+        return "client_error"
+    return "ok"
+
+
+@contextmanager
+def timed(histogram):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        histogram.observe(time.perf_counter() - started)
+
+
+def metrics_registry():
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return registry
+    return REGISTRY
+
+
+def render_metrics():
+    """(body, content_type) of the Prometheus text exposition."""
+    return generate_latest(metrics_registry()), CONTENT_TYPE_LATEST
+
+
+def mark_process_dead(pid):
+    """Drop the live gauges of an exited worker process (multiprocess mode)."""
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        multiprocess.mark_process_dead(pid)
+
+
+# Queries are counted per request through a context variable, which
+# sync_to_async carries into the thread the async ORM runs its queries on.
+_request_queries = ContextVar("weather_request_queries", default=None)
+
+
+class QueryCounter:
+    def __init__(self):
+        self.count = 0
+
+
+def count_query(execute, sql, params, many, context):
+    counter = _request_queries.get()
+    if counter is not None:
+        counter.count += 1
+    return execute(sql, params, many, context)
+
+
+def install_query_counter(conn):
+    if count_query not in conn.execute_wrappers:
+        conn.execute_wrappers.append(count_query)
+
+
+@receiver(connection_created)
+def _install_query_counter(sender, connection, **kwargs):
+    install_query_counter(connection)
+
+
+class ViewMetricsMiddleware:
+    """
+    Record latency and query count of every request routed to the weather
+    views (sync or async, so async views are not forced onto a thread).
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        # connections opened before this module was imported missed the signal
+        install_query_counter(connection)
+        counter = QueryCounter()
+        token = _request_queries.set(counter)
+        started = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            _request_queries.reset(token)
+        self.observe(request, response, time.perf_counter() - started, counter.count)
+        return response
+
+    async def __acall__(self, request):
+        counter = QueryCounter()
+        token = _request_queries.set(counter)
+        started = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            _request_queries.reset(token)
+        self.observe(request, response, time.perf_counter() - started, counter.count)
+        return response
+
+    def observe(self, request, response, elapsed, queries):
+        match = getattr(request, "resolver_match", None)
+        if match is not None and match.func.__module__ in ("weather.views", "weather.async_views"):
+            view = match.func.__name__
+            VIEW_SECONDS.labels(view, request.method, response.status_code).observe(elapsed)
+            VIEW_QUERIES.labels(view).observe(queries)
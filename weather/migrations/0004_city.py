@@ -0,0 +1,46 @@
+# Generated by Django 5.2.10 on 2026-10-17 02:17
+
+import datetime
+from django.db import migrations, models
+
+# the hard-coded list the sync used before cities moved to the database
+INITIAL_CITIES = [
+    ("Paris", 48.8566, 2.3522),
+    ("London", 51.5074, -0.1278),
+    ("New York", 40.7128, -74.0060),
+    ("Tokyo", 35.6762, 139.6503),
+]
+
+
+def seed_cities(apps, schema_editor):
+    City = apps.get_model("weather", "City")
+    City.objects.bulk_create(
+        [City(name=name, latitude=lat, longitude=lon) for name, lat, lon in INITIAL_CITIES],
+        ignore_conflicts=True,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('weather', '0003_alter_weather_time_alter_weather_weathercode'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='City',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100, unique=True)),
+                ('latitude', models.FloatField()),
+                ('longitude', models.FloatField()),
+                ('enabled', models.BooleanField(default=True)),
+                ('refresh_interval', models.DurationField(default=datetime.timedelta(seconds=3600))),
+            ],
+            options={
+                'verbose_name_plural': 'cities',
+                'indexes': [models.Index(condition=models.Q(('enabled', True)), fields=['id'], name='weather_city_enabled_id_idx')],
+            },
+        ),
+        migrations.RunPython(seed_cities, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,50 @@
+# Generated by Django 5.2.10 on 2026-10-17 02:20
+
+from django.db import migrations, models
+
+# Range-partitioned by synced_at. Daily partitions are created ahead of time by
+# weather.history.ensure_observation_partitions; the default partition only
+# catches rows that arrive before their partition exists.
+CREATE_OBSERVATION_TABLE = """
+CREATE TABLE weather_observation (
+    id bigserial NOT NULL,
+    city_name varchar(100) NOT NULL,
+    temperature double precision NULL,
+    windspeed double precision NULL,
+    winddirection double precision NULL,
+    weathercode integer NULL,
+    time timestamp with time zone NULL,
+    synced_at timestamp with time zone NOT NULL,
+    PRIMARY KEY (id, synced_at)
+) PARTITION BY RANGE (synced_at);
+CREATE TABLE weather_observation_default PARTITION OF weather_observation DEFAULT;
+CREATE INDEX weather_observation_city_synced_idx ON weather_observation (city_name, synced_at);
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('weather', '0004_city'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Observation',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('city_name', models.CharField(max_length=100)),
+                ('temperature', models.FloatField(blank=True, null=True)),
+                ('windspeed', models.FloatField(blank=True, null=True)),
+                ('winddirection', models.FloatField(blank=True, null=True)),
+                ('weathercode', models.IntegerField(blank=True, null=True)),
+                ('time', models.DateTimeField(blank=True, null=True)),
+                ('synced_at', models.DateTimeField()),
+            ],
+            options={
+                'db_table': 'weather_observation',
+                'managed': False,
+            },
+        ),
+        migrations.RunSQL(CREATE_OBSERVATION_TABLE, "DROP TABLE weather_observation;"),
+    ]
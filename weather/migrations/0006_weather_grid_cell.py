@@ -0,0 +1,29 @@
+# Generated by Django 5.2.10 on 2026-10-17 02:21
+
+from django.db import migrations, models
+
+from weather.geo import grid_cell
+
+
+def backfill_grid_cell(apps, schema_editor):
+    Weather = apps.get_model("weather", "Weather")
+    rows = list(Weather.objects.only("id", "latitude", "longitude"))
+    for w in rows:
+        w.grid_cell = grid_cell(w.latitude, w.longitude)
+    Weather.objects.bulk_update(rows, ["grid_cell"], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('weather', '0005_observation'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='weather',
+            name='grid_cell',
+            field=models.IntegerField(blank=True, db_index=True, null=True),
+        ),
+        migrations.RunPython(backfill_grid_cell, migrations.RunPython.noop),
+    ]
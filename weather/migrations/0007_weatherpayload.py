@@ -0,0 +1,52 @@
+# Generated by Django 5.2.10 on 2026-10-17 02:27
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+from weather.utils import compress_payload, decompress_payload
+
+
+def move_payloads(apps, schema_editor):
+    Weather = apps.get_model("weather", "Weather")
+    WeatherPayload = apps.get_model("weather", "WeatherPayload")
+    rows = (
+        Weather.objects.filter(raw_payload__isnull=False)
+        .values_list("id", "raw_payload")
+        .iterator(chunk_size=1000)
+    )
+    batch = []
+    for weather_id, data in rows:
+        batch.append(WeatherPayload(weather_id=weather_id, data=compress_payload(data)))
+        if len(batch) >= 1000:
+            WeatherPayload.objects.bulk_create(batch)
+            batch = []
+    WeatherPayload.objects.bulk_create(batch)
+
+
+def restore_payloads(apps, schema_editor):
+    Weather = apps.get_model("weather", "Weather")
+    WeatherPayload = apps.get_model("weather", "WeatherPayload")
+    for payload in WeatherPayload.objects.iterator(chunk_size=1000):
+        Weather.objects.filter(id=payload.weather_id).update(raw_payload=decompress_payload(payload.data))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('weather', '0006_weather_grid_cell'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='WeatherPayload',
+            fields=[
+                ('weather', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='payload', serialize=False, to='weather.weather')),
+                ('data', models.BinaryField()),
+            ],
+        ),
+        migrations.RunPython(move_payloads, restore_payloads),
+        migrations.RemoveField(
+            model_name='weather',
+            name='raw_payload',
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 5.2.10 on 2026-10-17 02:35
+
+import django.utils.timezone
+from django.db import migrations, models
+from django.db.models import F, OuterRef, Subquery
+
+
+def schedule_synced_cities(apps, schema_editor):
+    # cities with a snapshot are next due one refresh interval after it
+    City = apps.get_model("weather", "City")
+    Weather = apps.get_model("weather", "Weather")
+    synced_at = Weather.objects.filter(city_name=OuterRef("name"), synced_at__isnull=False).values("synced_at")
+    City.objects.filter(name__in=Weather.objects.filter(synced_at__isnull=False).values("city_name")).update(
+        next_sync_at=Subquery(synced_at[:1]) + F("refresh_interval"),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('weather', '0007_weatherpayload'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='city',
+            name='next_sync_at',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.RunPython(schedule_synced_cities, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='city',
+            index=models.Index(condition=models.Q(('enabled', True)), fields=['next_sync_at', 'id'], name='weather_city_due_idx'),
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 5.2.10 on 2026-10-17 02:45
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('weather', '0010_weather_content_hash'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='HourlyForecast',
+            fields=[
+                ('weather', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='forecast', serialize=False, to='weather.weather')),
+                ('start', models.DateTimeField()),
+                ('hours', models.PositiveSmallIntegerField()),
+                ('variables', models.CharField(max_length=255)),
+                ('data', models.BinaryField()),
+            ],
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.10 on 2026-10-17 02:59
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('weather', '0011_hourlyforecast'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='hourlyforecast',
+            name='content_hash',
+            field=models.CharField(blank=True, default='', max_length=32),
+        ),
+    ]
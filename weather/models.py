@@ -1,4 +1,72 @@
+from datetime import timedelta
+from django.conf import settings
 from django.db import models
+from django.db.models import Exists, F, OuterRef, Q
+from django.utils import timezone
+from .geo import grid_cell
+from .utils import decompress_payload
+
+
+class CityQuerySet(models.QuerySet):
+    def enabled(self):
+        return self.filter(enabled=True)
+
+    def stale(self, now=None):
+        """Cities whose Weather snapshot is missing or no longer fresh."""
+        fresh = Weather.objects.fresh(now).filter(city_name=OuterRef("name"))
+        return self.filter(~Exists(fresh))
+
+    def due(self, now=None):
+        """
+        Cities whose next refresh is due, most overdue first, in the order
+        the scheduler claims them.
+        """
+        return self.filter(next_sync_at__lte=now or timezone.now()).order_by("next_sync_at", "id")
+
+    def sync_payloads(self):
+        """City dicts in the shape the sync functions expect."""
+        return self.values("latitude", "longitude", city_name=F("name"))
+
+
+class City(models.Model):
+    """A location the sync keeps a Weather snapshot for."""
+    name = models.CharField(max_length=100, unique=True)
+    latitude = models.FloatField()
+    longitude = models.FloatField()
+    enabled = models.BooleanField(default=True)
+    refresh_interval = models.DurationField(default=timedelta(hours=1))
+    # when the scheduler should refresh the city next: synced_at +
+    # refresh_interval after a successful sync; new cities are due at once
+    next_sync_at = models.DateTimeField(default=timezone.now)
+
+    objects = CityQuerySet.as_manager()
+
+    class Meta:
+        verbose_name_plural = "cities"
+        indexes = [
+            # the coordinator walks enabled cities in id order
+            models.Index(fields=["id"], condition=Q(enabled=True), name="weather_city_enabled_id_idx"),
+            # the scheduler claims enabled cities in next_sync_at order
+            models.Index(fields=["next_sync_at", "id"], condition=Q(enabled=True), name="weather_city_due_idx"),
+        ]
+
+    def __str__(self):
+        return self.name
+
+
+class WeatherQuerySet(models.QuerySet):
+    def fresh(self, now=None):
+        """
+        Snapshots not worth refetching yet: synced within
+        WEATHER_SYNC_FRESHNESS_TTL, or whose upstream reading cannot have
+        advanced (time + WEATHER_UPSTREAM_INTERVAL is still in the future).
+        """
+        now = now or timezone.now()
+        return self.filter(
+            Q(synced_at__gt=now - timedelta(seconds=settings.WEATHER_SYNC_FRESHNESS_TTL))
+            | Q(time__gt=now - timedelta(seconds=settings.WEATHER_UPSTREAM_INTERVAL))
+        )
+
 
 class Weather(models.Model):
     city_name = models.CharField(max_length=100, unique=True)
@@ -10,8 +78,14 @@ class Weather(models.Model):
     weathercode = models.IntegerField(null=True, blank=True)
     time = models.DateTimeField(null=True, blank=True)
 
-    raw_payload = models.JSONField(null=True, blank=True)
     synced_at = models.DateTimeField(null=True, blank=True)
+    # digest of the synced values (everything but synced_at), so a sync can
+    # tell an unchanged snapshot apart without comparing columns
+    content_hash = models.CharField(max_length=32, blank=True, default="")
+    # 1x1 degree cell of (latitude, longitude), see weather.geo
+    grid_cell = models.IntegerField(null=True, blank=True, db_index=True)
+
+    objects = WeatherQuerySet.as_manager()
 
     class Meta:
         indexes = [
@@ -22,3 +96,113 @@ class Weather(models.Model):
 
     def __str__(self):
         return self.city_name
+
+    def save(self, *args, **kwargs):
+        self.grid_cell = grid_cell(self.latitude, self.longitude)
+        update_fields = kwargs.get("update_fields")
+        if update_fields is not None and {"latitude", "longitude"} & set(update_fields):
+            kwargs["update_fields"] = {*update_fields, "grid_cell"}
+        super().save(*args, **kwargs)
+
+
+class WeatherPayload(models.Model):
+    """
+    Full Open-Meteo response behind a Weather snapshot, zlib-compressed in its
+    own table so the weather rows every read scans stay small. Only loaded
+    when a client asks for it.
+    """
+    weather = models.OneToOneField(Weather, on_delete=models.CASCADE, primary_key=True, related_name="payload")
+    data = models.BinaryField()
+
+    def __str__(self):
+        return "payload of %s" % self.weather_id
+
+    @property
+    def raw_payload(self):
+        return decompress_payload(self.data)
+
+
+class HourlyForecast(models.Model):
+    """
+    Hourly forecast behind a Weather snapshot, packed as one little-endian
+    float32 array per variable (NaN for missing hours) rather than rows or
+    JSON lists, so many cities decode straight into NumPy. See weather.forecast.
+    """
+    weather = models.OneToOneField(Weather, on_delete=models.CASCADE, primary_key=True, related_name="forecast")
+    # first hour of the arrays (UTC); the following ones are an hour apart
+    start = models.DateTimeField()
+    hours = models.PositiveSmallIntegerField()
+    # comma-separated Open-Meteo variable names, in array order
+    variables = models.CharField(max_length=255)
+    data = models.BinaryField()
+    # digest of start, variables and data, to skip rewriting an unchanged forecast
+    content_hash = models.CharField(max_length=32, blank=True, default="")
+
+    def __str__(self):
+        return "forecast of %s" % self.weather_id
+
+
+class Observation(models.Model):
+    """
+    Append-only history of synced snapshots, one row per city per sync.
+    The table is range-partitioned by synced_at in Postgres (one partition per
+    day, managed by weather.history), so it is created by raw SQL in the
+    migrations rather than by Django.
+    """
+    id = models.BigAutoField(primary_key=True)
+    city_name = models.CharField(max_length=100)
+    temperature = models.FloatField(null=True, blank=True)
+    windspeed = models.FloatField(null=True, blank=True)
+    winddirection = models.FloatField(null=True, blank=True)
+    weathercode = models.IntegerField(null=True, blank=True)
+    time = models.DateTimeField(null=True, blank=True)
+    synced_at = models.DateTimeField()
+
+    class Meta:
+        managed = False
+        db_table = "weather_observation"
+
+    def __str__(self):
+        return "%s @ %s" % (self.city_name, self.synced_at)
+
+
+class SyncRun(models.Model):
+    """
+    One full sync started by sync_all_cities_task, keyed by the coordinator's
+    task id. Progress is counted in Redis while the run is going (see
+    weather.runs); the totals and per-city outcomes are written here once,
+    when the last city has reported.
+    """
+    STATUS_RUNNING = "running"
+    STATUS_FINISHED = "finished"
+
+    id = models.CharField(max_length=64, primary_key=True)
+    force = models.BooleanField(default=False)
+    status = models.CharField(max_length=16, default=STATUS_RUNNING)
+    started_at = models.DateTimeField(default=timezone.now)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    cities = models.PositiveIntegerField(default=0)
+    succeeded = models.PositiveIntegerField(default=0)
+    failed = models.PositiveIntegerField(default=0)
+    client_error = models.PositiveIntegerField(default=0)
+    retries = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        indexes = [models.Index(fields=["started_at"])]
+
+    def __str__(self):
+        return "sync run %s (%s)" % (self.id, self.status)
+
+
+class SyncRunCity(models.Model):
+    """Outcome of one city in a SyncRun."""
+    run = models.ForeignKey(SyncRun, on_delete=models.CASCADE, related_name="outcomes")
+    city_name = models.CharField(max_length=100)
+    # success, client_error (4xx, not retried) or failed (out of retries)
+    outcome = models.CharField(max_length=16)
+    # seconds spent in the attempt that settled the outcome
+    duration = models.FloatField(null=True, blank=True)
+    retries = models.PositiveSmallIntegerField(default=0)
+
+    def __str__(self):
+        return "%s: %s" % (self.city_name, self.outcome)
@@ -0,0 +1,184 @@
+import logging
+import time
+from email.utils import parsedate_to_datetime
+from django.conf import settings
+from redis.exceptions import RedisError
+from .redis_client import get_redis
+
+logger = logging.getLogger(__name__)
+
+# Token bucket shared by every worker. State lives in one Redis hash and the
+# clock is Redis' own, so workers with skewed clocks still agree.
+# Returns "0" when `cost` tokens were taken, else the seconds to wait.
+# A cost above the burst goes through once the bucket is full and leaves it
+# in debt, so a big batch is still charged in full, over several refills.
+ACQUIRE_SCRIPT = """
+local key = KEYS[1]
+local default_rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local cost = tonumber(ARGV[3])
+local needed = math.min(cost, burst)
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+
+local state = redis.call('HMGET', key, 'tokens', 'ts', 'rate', 'blocked_until')
+local rate = tonumber(state[3]) or default_rate
+local blocked_until = tonumber(state[4]) or 0
+if blocked_until > now then
+    return tostring(blocked_until - now)
+end
+
+local tokens = tonumber(state[1]) or burst
+local ts = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - ts) * rate)
+
+local wait = 0
+if tokens >= needed then
+    tokens = tokens - cost
+else
+    wait = (needed - tokens) / rate
+end
+redis.call('HSET', key, 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('EXPIRE', key, 3600)
+return tostring(wait)
+"""
+
+# AIMD: each success adds increase/rate (about `increase` req/s per second at
+# full speed), and a congestion event (throttle, error or slow response)
+# multiplies the rate by `decrease`, once: reports of requests that started
+# before the last decrease, or within `interval` seconds of it, belong to the
+# same event. A Retry-After blocks the whole bucket until it has passed.
+FEEDBACK_SCRIPT = """
+local key = KEYS[1]
+local congested = ARGV[1] == '1'
+local default_rate = tonumber(ARGV[2])
+local min_rate = tonumber(ARGV[3])
+local max_rate = tonumber(ARGV[4])
+local increase = tonumber(ARGV[5])
+local decrease = tonumber(ARGV[6])
+local retry_after = tonumber(ARGV[7])
+local latency = tonumber(ARGV[8])
+local interval = tonumber(ARGV[9])
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+
+local state = redis.call('HMGET', key, 'rate', 'last_decrease')
+local rate = tonumber(state[1]) or default_rate
+local last_decrease = tonumber(state[2]) or 0
+if congested then
+    if now - latency >= last_decrease and now - last_decrease >= interval then
+        rate = math.max(min_rate, rate * decrease)
+        redis.call('HSET', key, 'last_decrease', tostring(now))
+    end
+else
+    rate = math.min(max_rate, rate + increase / rate)
+end
+redis.call('HSET', key, 'rate', tostring(rate))
+if retry_after > 0 then
+    redis.call('HSET', key, 'blocked_until', tostring(now + retry_after))
+end
+redis.call('EXPIRE', key, 3600)
+return tostring(rate)
+"""
+
+
+class RateLimitExceeded(Exception):
+    """No token became available within the allowed wait."""
+    def __init__(self, retry_after):
+        super().__init__("rate limited, retry in %.1fs" % retry_after)
+        self.retry_after = retry_after
+
+
+def parse_retry_after(value):
+    """Seconds from a Retry-After header (delta-seconds or HTTP date), or 0."""
+    if not value:
+        return 0
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return 0
+
+
+class RateLimiter:
+    """
+    Cluster-wide adaptive rate limiter for one upstream. Callers take tokens
+    before each request and report every outcome so the shared rate follows
+    what the upstream can take. Redis errors are logged and never block a sync.
+    """
+    def __init__(self, name):
+        self.key = "weather:ratelimit:%s" % name
+
+    @property
+    def enabled(self):
+        return settings.WEATHER_RATE_LIMIT_ENABLED
+
+    def try_acquire(self, cost=1):
+        """Take `cost` tokens if possible. Returns 0, or the seconds to wait."""
+        if not self.enabled:
+            return 0
+        try:
+            wait = get_redis().eval(
+                ACQUIRE_SCRIPT, 1, self.key,
+                settings.WEATHER_RATE_LIMIT, settings.WEATHER_RATE_LIMIT_BURST, cost,
+            )
+        except RedisError:
+            logger.exception("Rate limiter unavailable, not throttling")
+            return 0
+        return float(wait)
+
+    def acquire(self, cost=1, max_wait=None):
+        """
+        Block until `cost` tokens are taken. Raises RateLimitExceeded when that
+        would take longer than `max_wait` seconds (WEATHER_RATE_LIMIT_MAX_WAIT).
+        """
+        max_wait = settings.WEATHER_RATE_LIMIT_MAX_WAIT if max_wait is None else max_wait
+        deadline = time.monotonic() + max_wait
+        while True:
+            wait = self.try_acquire(cost)
+            if not wait:
+                return
+            if time.monotonic() + wait > deadline:
+                raise RateLimitExceeded(wait)
+            time.sleep(wait)
+
+    def record(self, status, latency, retry_after=0):
+        """
+        Feed back one response (status None for a network error) so the rate
+        adapts: throttled, 5xx, failed or slower than
+        WEATHER_RATE_LIMIT_SLOW_SECONDS responses count as congestion. A burst
+        of them lowers the rate once per WEATHER_RATE_LIMIT_DECREASE_INTERVAL.
+        """
+        if not self.enabled:
+            return
+        congested = (
+            status is None
+            or status == 429
+            or status >= 500
+            or latency > settings.WEATHER_RATE_LIMIT_SLOW_SECONDS
+        )
+        try:
+            get_redis().eval(
+                FEEDBACK_SCRIPT, 1, self.key,
+                "1" if congested else "0",
+                settings.WEATHER_RATE_LIMIT,
+                settings.WEATHER_RATE_LIMIT_MIN,
+                settings.WEATHER_RATE_LIMIT_MAX,
+                settings.WEATHER_RATE_LIMIT_INCREASE,
+                settings.WEATHER_RATE_LIMIT_DECREASE,
+                retry_after or 0,
+                latency,
+                settings.WEATHER_RATE_LIMIT_DECREASE_INTERVAL,
+            )
+        except RedisError:
+            logger.exception("Rate limiter unavailable, outcome not recorded")
+
+    def current_rate(self):
+        rate = get_redis().hget(self.key, "rate")
+        return float(rate) if rate is not None else settings.WEATHER_RATE_LIMIT
+
+
+open_meteo_limiter = RateLimiter("open-meteo")
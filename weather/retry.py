@@ -0,0 +1,24 @@
+from celery.utils.time import get_exponential_backoff_interval
+
+# Retry policy shared by the Celery sync tasks and the asyncio sync engine:
+# exponential backoff with full jitter, capped at 10 minutes, 5 retries.
+SYNC_MAX_RETRIES = 5
+SYNC_RETRY_BACKOFF = 1
+SYNC_RETRY_BACKOFF_MAX = 600
+
+
+def is_retryable_status(status):
+    """Check if an HTTP status should be retried (5xx and 429 yes, other 4xx no)."""
+    if status is not None and 400 <= status < 500 and status != 429:
+        return False
+    return True
+
+
+def retry_countdown(retries):
+    """Seconds to wait before retry number `retries` + 1."""
+    return get_exponential_backoff_interval(
+        factor=SYNC_RETRY_BACKOFF,
+        retries=retries,
+        maximum=SYNC_RETRY_BACKOFF_MAX,
+        full_jitter=True,
+    )
@@ -0,0 +1,162 @@
+import json
+import logging
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from redis.exceptions import RedisError
+from .models import SyncRun, SyncRunCity
+from .redis_client import get_redis
+
+logger = logging.getLogger(__name__)
+
+# A running SyncRun is tracked in two Redis keys instead of one Celery result
+# per task: a hash of counters (shards, shards_done, cities, succeeded,
+# failed, client_error, retries) and a list of per-city outcome entries.
+# The coordinator sets `shards` once every shard is dispatched; each shard
+# adds its cities and marks itself done before dispatching them, so the run
+# is complete when all shards are done and every counted city has an
+# outcome. The caller that completes it is told so exactly once.
+
+# per-city outcome (as in weather_city_sync_total) -> SyncRun counter
+OUTCOMES = {"success": "succeeded", "failed": "failed", "client_error": "client_error"}
+
+# KEYS: run hash, outcome list. ARGV: ttl, number of counters, then
+# counter/increment pairs, then outcome entries.
+# Returns -1 for an unknown (expired) run, 1 when this call completed the run, else 0.
+RECORD_SCRIPT = """
+local run, outcomes = KEYS[1], KEYS[2]
+if redis.call('EXISTS', run) == 0 then
+    return -1
+end
+local n = tonumber(ARGV[2])
+for i = 0, n - 1 do
+    redis.call('HINCRBY', run, ARGV[3 + 2 * i], ARGV[4 + 2 * i])
+end
+for i = 3 + 2 * n, #ARGV do
+    redis.call('RPUSH', outcomes, ARGV[i])
+end
+redis.call('EXPIRE', run, ARGV[1])
+redis.call('EXPIRE', outcomes, ARGV[1])
+
+local c = redis.call('HMGET', run, 'shards', 'shards_done', 'cities', 'succeeded', 'failed', 'client_error')
+local shards = tonumber(c[1])
+if not shards or (tonumber(c[2]) or 0) < shards then
+    return 0
+end
+local settled = (tonumber(c[4]) or 0) + (tonumber(c[5]) or 0) + (tonumber(c[6]) or 0)
+if settled >= (tonumber(c[3]) or 0) and redis.call('HSETNX', run, 'finalized', 1) == 1 then
+    return 1
+end
+return 0
+"""
+
+
+def _keys(run_id):
+    return "weather:run:%s" % run_id, "weather:run:%s:outcomes" % run_id
+
+
+def start_run(run_id, force=False):
+    """Create the SyncRun row and its Redis counters (idempotent on redelivery)."""
+    SyncRun.objects.get_or_create(id=run_id, defaults={"force": force})
+    run_key, _ = _keys(run_id)
+    try:
+        get_redis().hsetnx(run_key, "shards_done", 0)
+        get_redis().expire(run_key, settings.WEATHER_SYNC_RUN_TTL)
+    except RedisError:
+        logger.exception("Run tracking unavailable for run %s", run_id)
+
+
+def record(run_id, outcomes=(), **counters):
+    """
+    Add to a run's counters and append per-city outcomes, given as
+    (city_name, outcome, duration, retries) with outcome a key of OUTCOMES.
+    Returns True when this call completed the run, so the caller finalizes it.
+    Redis errors are logged: tracking never fails a sync.
+    """
+    counters = dict(counters)
+    entries = []
+    for city_name, outcome, duration, retries in outcomes:
+        counters[OUTCOMES[outcome]] = counters.get(OUTCOMES[outcome], 0) + 1
+        counters["retries"] = counters.get("retries", 0) + retries
+        entries.append(json.dumps({
+            "city_name": city_name,
+            "outcome": outcome,
+            "duration": round(duration, 3) if duration is not None else None,
+            "retries": retries,
+        }))
+
+    args = [settings.WEATHER_SYNC_RUN_TTL, len(counters)]
+    for name, value in counters.items():
+        args += [name, value]
+    try:
+        completed = get_redis().eval(RECORD_SCRIPT, 2, *_keys(run_id), *args, *entries)
+    except RedisError:
+        logger.exception("Run tracking unavailable for run %s", run_id)
+        return False
+    if completed == -1:
+        logger.warning("Sync run %s is not tracked (expired?)", run_id)
+    return completed == 1
+
+
+def progress(run_id):
+    """Live counters of a running run, or None if Redis has none."""
+    run_key, _ = _keys(run_id)
+    try:
+        state = get_redis().hgetall(run_key)
+    except RedisError:
+        logger.exception("Run tracking unavailable for run %s", run_id)
+        return None
+    if not state:
+        return None
+    state = {key.decode(): int(value) for key, value in state.items()}
+    return {
+        "shards": state.get("shards"),
+        "shards_done": state.get("shards_done", 0),
+        "cities": state.get("cities", 0),
+        **{name: state.get(name, 0) for name in (*OUTCOMES.values(), "retries")},
+    }
+
+
+def finalize(run_id):
+    """
+    Write a completed run's totals and per-city outcomes to the database in
+    one transaction, then drop its Redis keys.
+    """
+    run_key, outcomes_key = _keys(run_id)
+    pipe = get_redis().pipeline()
+    pipe.hgetall(run_key)
+    pipe.lrange(outcomes_key, 0, -1)
+    state, entries = pipe.execute()
+    state = {key.decode(): int(value) for key, value in state.items()}
+
+    rows = [SyncRunCity(run_id=run_id, **json.loads(entry)) for entry in entries]
+    with transaction.atomic():
+        SyncRunCity.objects.bulk_create(rows, batch_size=settings.WEATHER_DB_BATCH_SIZE)
+        SyncRun.objects.filter(id=run_id).update(
+            status=SyncRun.STATUS_FINISHED,
+            finished_at=timezone.now(),
+            cities=state.get("cities", 0),
+            **{name: state.get(name, 0) for name in (*OUTCOMES.values(), "retries")},
+        )
+    get_redis().delete(run_key, outcomes_key)
+    logger.info("Sync run %s finished: %d cities", run_id, state.get("cities", 0))
+
+
+def summary(run):
+    """Status body for a SyncRun, with live counters while it is running."""
+    body = {
+        "id": run.id,
+        "status": run.status,
+        "force": run.force,
+        "started_at": run.started_at.isoformat(),
+        "finished_at": run.finished_at.isoformat() if run.finished_at else None,
+        "cities": run.cities,
+        **{name: getattr(run, name) for name in (*OUTCOMES.values(), "retries")},
+    }
+    if run.status == SyncRun.STATUS_RUNNING:
+        live = progress(run.id) or {}
+        body.update(live)
+        body["pending"] = max(0, body["cities"] - sum(body[name] for name in OUTCOMES.values()))
+    else:
+        body["pending"] = 0
+    return body
@@ -0,0 +1,39 @@
+# JSON shape of Weather rows, shared by the API views and the change feed.
+
+# the columns serialize_weather reads; list and detail queries load only these
+WEATHER_FIELDS = (
+    "id", "city_name", "latitude", "longitude", "temperature",
+    "windspeed", "winddirection", "weathercode", "time", "synced_at",
+)
+
+def serialize_weather(w):
+    return {
+        "id": w.id,
+        "city_name": w.city_name,
+        "latitude": w.latitude,
+        "longitude": w.longitude,
+        "temperature": w.temperature,
+        "windspeed": w.windspeed,
+        "winddirection": w.winddirection,
+        "weathercode": w.weathercode,
+        "time": w.time.isoformat() if w.time else None,
+        "synced_at": w.synced_at.isoformat() if w.synced_at else None,
+    }
+
+def serialize_weather_rows(rows):
+    """
+    serialize_weather without model instances: takes WEATHER_FIELDS tuples
+    (qs.values_list(*WEATHER_FIELDS)) and formats the datetimes directly.
+    Returns (dicts, newest synced_at or None).
+    """
+    results = []
+    newest = None
+    for row in rows:
+        time, synced_at = row[8], row[9]
+        if synced_at is not None and (newest is None or synced_at > newest):
+            newest = synced_at
+        item = dict(zip(WEATHER_FIELDS[:8], row))
+        item["time"] = time.isoformat() if time else None
+        item["synced_at"] = synced_at.isoformat() if synced_at else None
+        results.append(item)
+    return results, newest
@@ -1,65 +1,182 @@
-import requests
 import logging
-from datetime import datetime, timezone as dt_timezone
+import time
+from django.conf import settings
+from django.db import DatabaseError, transaction
+from django.db.models import F, Q
 from django.utils import timezone
 from requests.exceptions import RequestException, HTTPError
-from .models import Weather
+from .aggregates import record_snapshots
+from .cache import bump_weather_version
+from .circuit import open_meteo_circuit
+from .coalesce import fetch_coalesced, fetch_point
+from .feed import publish_changes
+from .forecast import save_forecasts
+from .geo import MAX_DISTANCE_KM, grid_cell, grid_cell_ranges, haversine_km
+from .history import record_observations
+from .metrics import (
+    CITY_SYNC_TOTAL,
+    DB_WRITE_SECONDS,
+    PARSE_SECONDS,
+    SNAPSHOT_WRITES_TOTAL,
+    UPSTREAM_REQUEST_SECONDS,
+    timed,
+    upstream_outcome,
+)
+from .http_client import get_http_session, get_http_timeout
+from .models import City, Weather, WeatherPayload
+from .ratelimit import open_meteo_limiter, parse_retry_after
+from .retry import is_retryable_status
+from .utils import chunked, compress_payload, content_hash, parse_upstream_time
 
 logger = logging.getLogger(__name__)
 
-OPEN_METEO_URL = "https://api.open-meteo.com/v1/forecast"
+OPEN_METEO_URL = settings.OPEN_METEO_URL
+
+# payload keys of the hourly forecast, left out of the stored raw payload
+HOURLY_KEYS = ("hourly", "hourly_units")
+
+# columns rewritten when an existing city row is upserted
+WEATHER_UPDATE_FIELDS = [
+    "latitude",
+    "longitude",
+    "temperature",
+    "windspeed",
+    "winddirection",
+    "weathercode",
+    "time",
+    "synced_at",
+    "grid_cell",
+    "content_hash",
+]
+
+# first radius tried by nearest_weather before widening the search
+NEAREST_INITIAL_RADIUS_KM = 50
+
+
+def parse_current_weather(city_data, data):
+    """
+    Build the Weather field values for a city from an Open-Meteo payload.
+    The payload itself is stored separately, see save_payloads.
+    """
+    cw = data.get("current_weather") or {}
+
+    # parse and make time timezone-aware
+    time_str = cw.get("time")
+    time_aware = parse_upstream_time(time_str) if time_str else None
+
+    values = {
+        "latitude": city_data["latitude"],
+        "longitude": city_data["longitude"],
+        "temperature": cw.get("temperature"),
+        "windspeed": cw.get("windspeed"),
+        "winddirection": cw.get("winddirection"),
+        "weathercode": cw.get("weathercode"),
+        "time": time_aware,
+    }
+    return {
+        **values,
+        "synced_at": timezone.now(),
+        "grid_cell": grid_cell(city_data["latitude"], city_data["longitude"]),
+        "content_hash": content_hash(values),
+    }
+
+
+def open_meteo_params(latitude, longitude):
+    """
+    Query parameters of an Open-Meteo request: current weather, plus the
+    WEATHER_HOURLY_VARIABLES forecast when any are configured. Coordinates
+    may be comma-separated lists for a batch request.
+    """
+    params = {"latitude": latitude, "longitude": longitude, "current_weather": "true"}
+    if settings.WEATHER_HOURLY_VARIABLES:
+        params["hourly"] = ",".join(settings.WEATHER_HOURLY_VARIABLES)
+        params["forecast_days"] = settings.WEATHER_FORECAST_DAYS
+    return params
+
+
+def record_open_meteo_response(status, latency, retry_after=0, probe=False):
+    """
+    Report one Open-Meteo outcome (status None for a network error) to the
+    rate limiter, the circuit breaker and the metrics. `probe` is what the
+    circuit's before_request returned for the request. A 429 says nothing
+    about the upstream being up, so a throttled probe leaves the circuit
+    half-open for the next one.
+    """
+    UPSTREAM_REQUEST_SECONDS.labels(upstream_outcome(status)).observe(latency)
+    open_meteo_limiter.record(status, latency, retry_after)
+    if status is None or status >= 500:
+        open_meteo_circuit.record_failure(probe)
+    elif status == 429:
+        open_meteo_circuit.release_probe(probe)
+    else:
+        open_meteo_circuit.record_success(probe)
+
+
+def fetch_open_meteo(params, cost=1):
+    """
+    GET Open-Meteo through the circuit breaker and the cluster-wide rate
+    limiter, and report the outcome back to both (status, latency,
+    Retry-After). `cost` is the number of locations in the request. Raises
+    CircuitOpen while the upstream is considered down, RateLimitExceeded when
+    no token is available within WEATHER_RATE_LIMIT_MAX_WAIT, and HTTPError /
+    RequestException like requests.
+    """
+    probe = open_meteo_circuit.before_request()
+    try:
+        open_meteo_limiter.acquire(cost)
+    except Exception:
+        # nothing was sent, let the next caller probe
+        open_meteo_circuit.release_probe(probe)
+        raise
+    started = time.monotonic()
+    try:
+        resp = get_http_session().get(OPEN_METEO_URL, params=params, timeout=get_http_timeout())
+    except RequestException:
+        record_open_meteo_response(None, time.monotonic() - started, probe=probe)
+        raise
+    record_open_meteo_response(
+        resp.status_code,
+        time.monotonic() - started,
+        parse_retry_after(resp.headers.get("Retry-After")) if resp.status_code in (429, 503) else 0,
+        probe,
+    )
+    resp.raise_for_status()
+    return resp
+
 
 def sync_single_city(city_data):
     """
     Fetch current weather for a single city and update/insert into db.
-    Raises HTTPError for 5xx responses and RequestException for network errors.
-    Logs and returns False for 4xx responses (no retry).
+    Raises HTTPError for 5xx and 429 responses, RequestException for network
+    errors, RateLimitExceeded when the shared rate limit is exhausted and
+    CircuitOpen while Open-Meteo is considered down.
+    Logs and returns False for other 4xx responses (no retry).
     Returns True on success.
     """
     city_name = city_data["city_name"]
-    params = {
-        "latitude": city_data["latitude"],
-        "longitude": city_data["longitude"],
-        "current_weather": "true",
-    }
-    
+    point = fetch_point(city_data)
+
+    def fetch(points):
+        resp = fetch_open_meteo(open_meteo_params(*points[0]))
+        with timed(PARSE_SECONDS.labels("single")):
+            return {points[0]: resp.json()}
+
     logger.info("Syncing city: %s", city_name)
     try:
-        resp = requests.get(OPEN_METEO_URL, params=params, timeout=10)
-        resp.raise_for_status()
-        data = resp.json()
-        
-        cw = data.get("current_weather") or {}
-        
-        # parse and make time timezone-aware
-        time_str = cw.get("time")
-        time_aware = None
-        if time_str:
-            dt = datetime.fromisoformat(time_str.replace("Z", "+00:00"))
-            if timezone.is_naive(dt):
-                dt = timezone.make_aware(dt, timezone=dt_timezone.utc)
-            time_aware = dt
-
-        
-        Weather.objects.update_or_create(
-            city_name=city_name,
-            defaults={
-                "latitude": city_data["latitude"],
-                "longitude": city_data["longitude"],
-                "temperature": cw.get("temperature"),
-                "windspeed": cw.get("windspeed"),
-                "winddirection": cw.get("winddirection"),
-                "weathercode": cw.get("weathercode"),
-                "time": time_aware,
-                "raw_payload": data,
-                "synced_at": timezone.now(),
-            },
-        )
-        logger.info("Synced %s successfully", city_name)
+        data = fetch_coalesced([point], fetch)[point]
+        defaults = parse_current_weather(city_data, data)
+
+        with timed(DB_WRITE_SECONDS.labels("single")), transaction.atomic():
+            written = _upsert_weather([Weather(city_name=city_name, **defaults)], {city_name: data})
+        if written or settings.WEATHER_TOUCH_UNCHANGED:
+            bump_weather_version()
+        CITY_SYNC_TOTAL.labels("success").inc()
+        logger.info("Synced %s successfully%s", city_name, "" if written else " (unchanged)")
         return True
     except HTTPError as e:
         status = getattr(e.response, "status_code", None)
-        if status is not None and 400 <= status < 500:
+        if not is_retryable_status(status):
+            CITY_SYNC_TOTAL.labels("client_error").inc()
             logger.warning("Client error (no retry) city=%s status=%s", city_name, status)
             return False
         else:
@@ -67,4 +184,222 @@ def sync_single_city(city_data):
             raise
     except RequestException:
         logger.exception("Network error (retry) city=%s", city_name)
-        raise
\ No newline at end of file
+        raise
+
+
+def fetch_cities_batch(cities):
+    """
+    Fetch current weather for several cities with one Open-Meteo request
+    (a second one for points another worker failed to fetch in time).
+    Open-Meteo accepts comma-separated coordinates and answers with a list of
+    payloads in the same order. Cities sharing a fetch point are requested
+    once, and points other workers fetched recently, or are fetching right
+    now, are taken from the cache (see fetch_coalesced).
+    Raises HTTPError (4xx and 5xx) and RequestException like requests does,
+    CircuitOpen / RateLimitExceeded like fetch_open_meteo, and ValueError if the response
+    does not line up with the requested points.
+    """
+    def fetch(missing):
+        params = open_meteo_params(
+            ",".join(str(p[0]) for p in missing),
+            ",".join(str(p[1]) for p in missing),
+        )
+        resp = fetch_open_meteo(params, cost=len(missing))
+        with timed(PARSE_SECONDS.labels("bulk")):
+            data = resp.json()
+
+        # a single location comes back as an object rather than a list
+        if isinstance(data, dict):
+            data = [data]
+        if not isinstance(data, list) or len(data) != len(missing):
+            raise ValueError(
+                "Open-Meteo returned %s results for %d locations"
+                % (len(data) if isinstance(data, list) else "invalid", len(missing))
+            )
+        return dict(zip(missing, data))
+
+    points = [fetch_point(c) for c in cities]
+    payloads = fetch_coalesced(points, fetch)
+    return [payloads[p] for p in points]
+
+
+def sync_city_batch(cities):
+    """
+    Fetch a chunk of cities in one request and update/insert each into db.
+    Errors from the request itself are raised for the whole chunk so the
+    caller can decide how to retry. Returns a dict of city_name -> True/False.
+    """
+    logger.info("Syncing batch of %d cities", len(cities))
+    payloads = fetch_cities_batch(cities)
+
+    results = save_weather_bulk(zip(cities, payloads))
+
+    logger.info(
+        "Synced batch: %d ok, %d failed",
+        sum(results.values()), len(results) - sum(results.values()),
+    )
+    return results
+
+
+def save_payloads(weathers, payloads):
+    """
+    Upsert the compressed raw Open-Meteo payload of each saved Weather row,
+    without the hourly forecast (stored packed, see save_forecasts).
+    `payloads` maps city_name -> payload.
+    """
+    WeatherPayload.objects.bulk_create(
+        [
+            WeatherPayload(weather_id=w.pk, data=compress_payload({
+                key: value for key, value in payloads[w.city_name].items() if key not in HOURLY_KEYS
+            }))
+            for w in weathers
+        ],
+        update_conflicts=True,
+        unique_fields=["weather"],
+        update_fields=["data"],
+    )
+
+
+def schedule_next_sync(city_names, synced_at):
+    """Make synced cities due again one refresh_interval after synced_at."""
+    City.objects.filter(name__in=city_names).update(next_sync_at=synced_at + F("refresh_interval"))
+
+
+def _upsert_weather(rows, payloads):
+    """
+    Write the snapshots whose content_hash differs from the stored one (with
+    their payloads and an observation each); once committed, they are
+    published to the change feed and folded into the aggregates. Unchanged rows are not
+    rewritten: only their synced_at is bumped, or nothing at all with
+    WEATHER_TOUCH_UNCHANGED off. Hourly forecasts are compared and saved
+    separately (see save_forecasts). Every city gets its next sync scheduled.
+    Returns the number of rows written.
+    """
+    stored = {
+        city_name: (pk, digest)
+        for city_name, pk, digest in Weather.objects.filter(city_name__in=[w.city_name for w in rows])
+        .values_list("city_name", "id", "content_hash")
+    }
+    changed = [w for w in rows if stored.get(w.city_name, (None, None))[1] != w.content_hash]
+    unchanged = [w.city_name for w in rows if stored.get(w.city_name, (None, None))[1] == w.content_hash]
+    synced_at = min(w.synced_at for w in rows)
+
+    if changed:
+        # ids come back from INSERT ... ON CONFLICT ... RETURNING for the payloads
+        Weather.objects.bulk_create(
+            changed,
+            update_conflicts=True,
+            unique_fields=["city_name"],
+            update_fields=WEATHER_UPDATE_FIELDS,
+        )
+        save_payloads(changed, payloads)
+        record_observations(changed)
+        transaction.on_commit(lambda: publish_changes(changed))
+        transaction.on_commit(lambda: record_snapshots(changed))
+    if unchanged and settings.WEATHER_TOUCH_UNCHANGED:
+        Weather.objects.filter(city_name__in=unchanged).update(synced_at=synced_at)
+    # forecasts move on their own, whether the current weather changed or not
+    for w in rows:
+        if w.pk is None:
+            w.pk = stored[w.city_name][0]
+    save_forecasts(rows, payloads)
+    schedule_next_sync([w.city_name for w in rows], synced_at)
+
+    SNAPSHOT_WRITES_TOTAL.labels("changed").inc(len(changed))
+    SNAPSHOT_WRITES_TOTAL.labels("unchanged").inc(len(unchanged))
+    return len(changed)
+
+
+def save_weather_bulk(items, batch_size=None):
+    """
+    Upsert many city snapshots and their raw payloads with INSERT ... ON
+    CONFLICT DO UPDATE and append them to the observation history in the same transaction.
+    Snapshots identical to the stored ones are skipped, see _upsert_weather.
+    `items` is an iterable of (city_data, payload) pairs, flushed in batches of
+    `batch_size` rows (WEATHER_DB_BATCH_SIZE by default). If the database
+    rejects a batch, its rows are retried one by one so a bad row only fails
+    itself. Returns a dict of city_name -> True/False.
+    """
+    batch_size = batch_size or settings.WEATHER_DB_BATCH_SIZE
+    results = {}
+    written = 0
+
+    for chunk in chunked(items, batch_size):
+        # one row per city: ON CONFLICT cannot touch the same row twice
+        rows = {}
+        payloads = {}
+        with timed(PARSE_SECONDS.labels("bulk")):
+            for city_data, data in chunk:
+                city_name = city_data["city_name"]
+                try:
+                    rows[city_name] = Weather(city_name=city_name, **parse_current_weather(city_data, data))
+                    payloads[city_name] = data
+                except (AttributeError, TypeError, ValueError):
+                    logger.exception("Invalid payload city=%s", city_name)
+                    rows.pop(city_name, None)
+                    results[city_name] = False
+        if not rows:
+            continue
+
+        try:
+            with timed(DB_WRITE_SECONDS.labels("bulk")), transaction.atomic():
+                chunk_written = _upsert_weather(list(rows.values()), payloads)
+        except DatabaseError:
+            logger.exception("Bulk upsert of %d rows failed, retrying row by row", len(rows))
+            for city_name, row in rows.items():
+                try:
+                    with timed(DB_WRITE_SECONDS.labels("row")), transaction.atomic():
+                        written += _upsert_weather([row], payloads)
+                    results[city_name] = True
+                except DatabaseError:
+                    logger.exception("Upsert failed city=%s", city_name)
+                    results[city_name] = False
+        else:
+            written += chunk_written
+            results.update(dict.fromkeys(rows, True))
+
+    succeeded = sum(results.values())
+    CITY_SYNC_TOTAL.labels("success").inc(succeeded)
+    CITY_SYNC_TOTAL.labels("failed").inc(len(results) - succeeded)
+    if written or (succeeded and settings.WEATHER_TOUCH_UNCHANGED):
+        bump_weather_version()
+    logger.info("Saved %d snapshots: %d changed, %d unchanged", succeeded, written, succeeded - written)
+    return results
+
+
+def weather_within(latitude, longitude, radius_km, limit=None):
+    """
+    Weather rows within radius_km of a coordinate as (distance_km, weather)
+    pairs, nearest first. Candidates come from grid_cell index range scans
+    over the circle's bounding box and are then filtered by exact distance.
+    """
+    qs = Weather.objects.all()
+    if radius_km < MAX_DISTANCE_KM:
+        cells = Q()
+        for first, last in grid_cell_ranges(latitude, longitude, radius_km):
+            cells |= Q(grid_cell__range=(first, last))
+        qs = qs.filter(cells)
+
+    matches = []
+    for w in qs.iterator():
+        distance = haversine_km(latitude, longitude, w.latitude, w.longitude)
+        if distance <= radius_km:
+            matches.append((distance, w))
+    matches.sort(key=lambda m: m[0])
+    return matches[:limit] if limit else matches
+
+
+def nearest_weather(latitude, longitude, k, max_radius_km=MAX_DISTANCE_KM):
+    """
+    The k Weather rows nearest to a coordinate (optionally no further than
+    max_radius_km). Starts with a small radius and widens it until k rows are
+    found, so dense areas only scan a handful of grid cells.
+    """
+    # bounds the widening to a few passes
+    max_radius_km = min(max_radius_km, MAX_DISTANCE_KM)
+    radius = min(NEAREST_INITIAL_RADIUS_KM, max_radius_km)
+    while True:
+        matches = weather_within(latitude, longitude, radius, k)
+        if len(matches) >= k or radius >= max_radius_km:
+            return matches
+        radius = min(radius * 4, max_radius_km)
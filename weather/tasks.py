@@ -1,57 +1,414 @@
 import logging
+import random
+import time
+from datetime import timedelta
 from celery import shared_task, group
+from celery.exceptions import Ignore
+from celery.utils import uuid
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
 from requests.exceptions import RequestException, HTTPError
-from .services import sync_single_city
-from .constants import CITIES
+from . import runs
+from .aggregates import rebuild_aggregates
+from .async_sync import run_async_sync
+from .services import sync_single_city, sync_city_batch
+from .history import drop_expired_observation_partitions, ensure_observation_partitions
+from .circuit import CircuitOpen, open_meteo_circuit
+from .metrics import CITY_SYNC_TOTAL, TASK_RETRIES_TOTAL, upstream_outcome
+from .models import City
+from .ratelimit import RateLimitExceeded, parse_retry_after
+from .retry import SYNC_MAX_RETRIES, is_retryable_status, retry_countdown
+from .utils import chunked
 
 logger = logging.getLogger(__name__)
 
 def should_retry_http_error(exc):
     """Check if HTTPError should be retried (5xx yes, 4xx no)."""
     if isinstance(exc, HTTPError):
-        status = getattr(exc.response, "status_code", None)
-        if status is not None and 400 <= status < 500:
-            return False
+        return is_retryable_status(getattr(exc.response, "status_code", None))
     return True
 
-@shared_task(bind=True, retry_backoff=True, retry_jitter=True, retry_kwargs={"max_retries": 5})
-def sync_city_task(self, city_data):
+def task_label(task):
+    return task.name.rsplit(".", 1)[-1]
+
+def retry_sync_task(task, exc):
+    """
+    Schedule a retry using the shared backoff policy from weather.retry, or
+    later if the upstream asked for it with Retry-After.
+    """
+    countdown = retry_countdown(task.request.retries)
+    response = getattr(exc, "response", None)
+    if response is not None:
+        countdown = max(countdown, parse_retry_after(response.headers.get("Retry-After")))
+
+    reason = upstream_outcome(response.status_code if response is not None else None)
+    TASK_RETRIES_TOTAL.labels(task_label(task), reason).inc()
+    if task.request.retries >= SYNC_MAX_RETRIES:
+        CITY_SYNC_TOTAL.labels("failed").inc()
+    return task.retry(exc=exc, countdown=countdown, max_retries=SYNC_MAX_RETRIES)
+
+def out_of_deferrals(deferrals):
+    return deferrals >= settings.WEATHER_SYNC_MAX_DEFERRALS
+
+def defer_sync_task(task, exc):
+    """
+    Re-send a task the shared rate limiter had no token for, or that found the
+    circuit open, with its `deferrals` kwarg incremented. Deferring is not a
+    failure: unlike task.retry() this leaves request.retries, and so the
+    SYNC_MAX_RETRIES budget, untouched. Callers cap deferrals at
+    WEATHER_SYNC_MAX_DEFERRALS themselves; the jitter keeps deferred tasks
+    from coming back all at once. Returns the exception to raise.
+    """
+    if task.request.called_directly:
+        return exc
+    countdown = exc.retry_after + random.uniform(0, exc.retry_after)
+    TASK_RETRIES_TOTAL.labels(task_label(task), "deferred").inc()
+    kwargs = dict(task.request.kwargs, deferrals=task.request.kwargs.get("deferrals", 0) + 1)
+    signature = task.signature_from_request(kwargs=kwargs, countdown=countdown, retries=task.request.retries)
+    if task.request.is_eager:
+        signature.apply()
+    else:
+        signature.apply_async()
+    # the re-sent message carries on, this one is done
+    return Ignore()
+
+def track_run(run_id, outcomes=(), **counters):
     """
-    Sync weather for a single city with automatic retry on network errors and 5xx.
-    Does NOT retry on 4xx client errors.
+    Report progress to the SyncRun `run_id` (no-op without one, e.g. for
+    scheduler ticks). The call that completes the run writes it to the
+    database and releases the single-flight sync lock.
+    """
+    if run_id is None:
+        return
+    if not runs.record(run_id, outcomes, **counters):
+        return
+    try:
+        runs.finalize(run_id)
+    except Exception:
+        logger.exception("Could not finalize sync run %s", run_id)
+    finally:
+        release_sync_lock(run_id)
+
+def report_city(task, run_id, city_name, outcome, started):
+    track_run(run_id, [(city_name, outcome, time.monotonic() - started, task.request.retries)])
+
+@shared_task(bind=True, ignore_result=True, retry_backoff=True, retry_jitter=True, retry_kwargs={"max_retries": 5})
+def sync_city_task(self, city_data, run_id=None, deferrals=0):
+    """
+    Sync weather for a single city with automatic retry on network errors, 5xx
+    and 429. Does NOT retry on other 4xx client errors. Deferred while rate
+    limited or the circuit is open, and failed after WEATHER_SYNC_MAX_DEFERRALS.
+    The outcome is reported to the SyncRun `run_id`, if given, instead of
+    being stored as a task result; unexpected errors are reported as failed
+    and re-raised.
     """
     city_name = city_data["city_name"]
     logger.info("City sync task started: %s", city_name)
-    
+    started = time.monotonic()
+
     try:
         result = sync_single_city(city_data)
         if result:
             logger.info("City sync task completed: %s", city_name)
+            report_city(self, run_id, city_name, "success", started)
             return {"city": city_name, "status": "success"}
         else:
             logger.warning("City sync task failed (4xx): %s", city_name)
+            report_city(self, run_id, city_name, "client_error", started)
             return {"city": city_name, "status": "failed_4xx"}
     except HTTPError as e:
         if not should_retry_http_error(e):
             logger.warning("City sync task failed (4xx, no retry): %s", city_name)
+            report_city(self, run_id, city_name, "client_error", started)
             return {"city": city_name, "status": "failed_4xx"}
         logger.exception("City sync task failed (5xx, retrying): %s", city_name)
-        raise self.retry(exc=e)
+        if self.request.retries >= SYNC_MAX_RETRIES:
+            report_city(self, run_id, city_name, "failed", started)
+        raise retry_sync_task(self, e)
     except RequestException as e:
         logger.exception("City sync task failed (network, retrying): %s", city_name)
-        raise self.retry(exc=e)
+        if self.request.retries >= SYNC_MAX_RETRIES:
+            report_city(self, run_id, city_name, "failed", started)
+        raise retry_sync_task(self, e)
+    except (RateLimitExceeded, CircuitOpen) as e:
+        if out_of_deferrals(deferrals):
+            logger.error("City sync task failed after %d deferrals (%s): %s", deferrals, e, city_name)
+            CITY_SYNC_TOTAL.labels("failed").inc()
+            report_city(self, run_id, city_name, "failed", started)
+            return {"city": city_name, "status": "failed"}
+        logger.info("City sync task deferred (%s): %s", e, city_name)
+        raise defer_sync_task(self, e)
+    except Exception:
+        # not retried: without an outcome the run would never complete
+        logger.exception("City sync task failed (unexpected error): %s", city_name)
+        CITY_SYNC_TOTAL.labels("failed").inc()
+        report_city(self, run_id, city_name, "failed", started)
+        raise
+
+def run_kwargs(run_id):
+    return {"run_id": run_id} if run_id else {}
+
+def fall_back_to_city_tasks(cities, run_id=None):
+    """Dispatch one sync_city_task per city so each gets its own retry/4xx handling."""
+    group_result = group(sync_city_task.s(city, **run_kwargs(run_id)) for city in cities).apply_async()
+    return {"task_type": "fallback_group", "group_id": group_result.id, "subtasks": len(cities)}
+
+@shared_task(bind=True, ignore_result=True, retry_backoff=True, retry_jitter=True, retry_kwargs={"max_retries": 5})
+def sync_city_batch_task(self, cities, run_id=None, deferrals=0):
+    """
+    Sync a chunk of cities with a single Open-Meteo request.
+    Retries the whole chunk on network errors, 5xx and 429, and defers it
+    while the shared rate limit is exhausted or the circuit is open (every
+    city fails after WEATHER_SYNC_MAX_DEFERRALS). On another 4xx, an unusable
+    response, an unexpected error, or once the chunk is out of retries, falls
+    back to per-city tasks so a single bad city cannot fail the others.
+    Outcomes are reported to the SyncRun `run_id`, if given.
+    """
+    logger.info("City batch sync task started: %d cities", len(cities))
+    started = time.monotonic()
+
+    try:
+        results = sync_city_batch(cities)
+    except HTTPError as e:
+        if not should_retry_http_error(e):
+            logger.warning("City batch sync task failed (4xx), falling back to per-city tasks")
+            return fall_back_to_city_tasks(cities, run_id)
+        if self.request.retries >= SYNC_MAX_RETRIES:
+            logger.warning("City batch sync task out of retries, falling back to per-city tasks")
+            return fall_back_to_city_tasks(cities, run_id)
+        logger.exception("City batch sync task failed (5xx, retrying)")
+        raise retry_sync_task(self, e)
+    except RequestException as e:
+        if self.request.retries >= SYNC_MAX_RETRIES:
+            logger.warning("City batch sync task out of retries, falling back to per-city tasks")
+            return fall_back_to_city_tasks(cities, run_id)
+        logger.exception("City batch sync task failed (network, retrying)")
+        raise retry_sync_task(self, e)
+    except (RateLimitExceeded, CircuitOpen) as e:
+        if out_of_deferrals(deferrals):
+            logger.error("City batch sync task failed after %d deferrals (%s)", deferrals, e)
+            CITY_SYNC_TOTAL.labels("failed").inc(len(cities))
+            duration = time.monotonic() - started
+            track_run(run_id, [(c["city_name"], "failed", duration, self.request.retries) for c in cities])
+            return {"cities": len(cities), "succeeded": 0, "failed": len(cities)}
+        logger.info("City batch sync task deferred (%s)", e)
+        raise defer_sync_task(self, e)
+    except ValueError:
+        logger.exception("City batch sync task got an unusable response, falling back to per-city tasks")
+        return fall_back_to_city_tasks(cities, run_id)
+    except Exception:
+        logger.exception("City batch sync task failed (unexpected error), falling back to per-city tasks")
+        return fall_back_to_city_tasks(cities, run_id)
+
+    succeeded = sum(results.values())
+    logger.info("City batch sync task completed: %d ok, %d failed", succeeded, len(results) - succeeded)
+    duration = time.monotonic() - started
+    track_run(run_id, [
+        (city_name, "success" if ok else "failed", duration, self.request.retries)
+        for city_name, ok in results.items()
+    ])
+    return {"cities": len(results), "succeeded": succeeded, "failed": len(results) - succeeded}
+
+def dispatch_city_syncs(cities, label, run_id=None):
+    """
+    Dispatch sync tasks for a list of city dicts using Celery group().
+    With WEATHER_SYNC_BATCH_SIZE > 1 each task fetches a chunk of cities in a
+    single request, otherwise each city gets its own task.
+    """
+    batch_size = settings.WEATHER_SYNC_BATCH_SIZE
+    kwargs = run_kwargs(run_id)
+    if batch_size > 1:
+        chunks = list(chunked(cities, batch_size))
+        group_result = group(sync_city_batch_task.s(chunk, **kwargs) for chunk in chunks).apply_async()
+        logger.info("Dispatched %d batch sync tasks for %s (group_id = %s)", len(chunks), label, group_result.id)
+        return {"task_type": "batched_group", "group_id": group_result.id, "subtasks": len(chunks), "cities": len(cities)}
+
+    group_result = group(sync_city_task.s(city, **kwargs) for city in cities).apply_async()
+    logger.info("Dispatched %d city sync tasks for %s (group_id = %s)", len(cities), label, group_result.id)
+    return {"task_type": "group", "group_id": group_result.id, "subtasks": len(cities)}
+
+@shared_task(bind=True, ignore_result=True)
+def sync_city_shard_task(self, first_id, last_id, force=False, run_id=None, deferrals=0):
+    """
+    Sync the enabled cities whose ids fall in [first_id, last_id] with
+    dispatch_city_syncs. Cities with a fresh snapshot are skipped unless `force` is set.
+    While the Open-Meteo circuit is open the whole shard is deferred instead;
+    after WEATHER_SYNC_MAX_DEFERRALS it is dispatched anyway, so its cities
+    are still synced, or reported failed, one by one.
+    """
+    wait = open_meteo_circuit.open_for()
+    if wait and not out_of_deferrals(deferrals):
+        logger.info("Circuit open, deferring shard %s-%s by %.0fs", first_id, last_id, wait)
+        raise defer_sync_task(self, CircuitOpen(wait))
+
+    cities = City.objects.enabled().filter(id__range=(first_id, last_id))
+    if not force:
+        cities = cities.stale()
+    cities = list(cities.order_by("id").sync_payloads())
+
+    # counted before dispatching, so the run cannot look complete while
+    # this shard's cities are still on their way
+    track_run(run_id, cities=len(cities), shards_done=1)
+    return dispatch_city_syncs(cities, "shard %s-%s" % (first_id, last_id), run_id)
+
+@shared_task(bind=True)
+def sync_all_cities_task(self, force=False):
+    """
+    Coordinator task that streams enabled city ids with a server-side cursor
+    and dispatches one sync_city_shard_task per WEATHER_SYNC_SHARD_SIZE cities.
+    Shard messages only carry an id range, so neither the coordinator nor the
+    broker ever holds the whole city list.
+    Cities with a fresh snapshot are skipped unless `force` is set.
+    The run is tracked as a SyncRun under this task's id (see weather.runs).
+    """
+    run_id = self.request.id
+    if run_id:
+        runs.start_run(run_id, force)
+    shard_size = settings.WEATHER_SYNC_SHARD_SIZE
+    cities = City.objects.enabled()
+    if not force:
+        cities = cities.stale()
+    ids = (
+        cities
+        .order_by("id")
+        .values_list("id", flat=True)
+        .iterator(chunk_size=shard_size)
+    )
+
+    shards = cities = 0
+    for shard in chunked(ids, shard_size):
+        sync_city_shard_task.delay(shard[0], shard[-1], force=force, **run_kwargs(run_id))
+        shards += 1
+        cities += len(shard)
+    track_run(run_id, shards=shards)
+
+    logger.info("Dispatched %d shard tasks for %d cities", shards, cities)
+    return {"task_type": "sharded", "shards": shards, "cities": cities}
+
+@shared_task
+def sync_all_cities_async_task(concurrency=None, force=False):
+    """
+    Alternative coordinator that syncs every city from a single task using the
+    asyncio engine (weather.async_sync) instead of one Celery task per city.
+    Retries happen in-process with the same backoff policy as sync_city_task.
+    Cities with a fresh snapshot are skipped unless `force` is set.
+    """
+    logger.info("Starting async city sync")
+
+    cities = City.objects.enabled()
+    if not force:
+        cities = cities.stale()
+    results = run_async_sync(cities.order_by("id").sync_payloads(), concurrency)
+
+    succeeded = sum(results.values())
+    logger.info("Async city sync completed: %d ok, %d failed", succeeded, len(results) - succeeded)
+    return {"task_type": "async", "cities": len(results), "succeeded": succeeded, "failed": len(results) - succeeded}
+
+@shared_task
+def maintain_observation_partitions_task():
+    """Create the upcoming daily history partitions and drop expired ones."""
+    created = ensure_observation_partitions(settings.WEATHER_HISTORY_PARTITIONS_AHEAD)
+    dropped = drop_expired_observation_partitions(settings.WEATHER_HISTORY_RETENTION_DAYS)
+    logger.info("Observation partitions: %d created, %d dropped", len(created), len(dropped))
+    return {"created": created, "dropped": dropped}
 
 @shared_task
-def sync_all_cities_task():
+def recompute_weather_aggregates_task():
+    """
+    Rebuild the incrementally maintained aggregates from the database,
+    correcting drift of the running sums and dropping removed cities.
     """
-    Coordinator task that spawns concurrent per-city sync tasks using Celery group().
-    Returns the group result for tracking.
+    try:
+        return {"cities": rebuild_aggregates()}
+    finally:
+        cache.delete(AGGREGATES_REBUILD_KEY)
+
+AGGREGATES_REBUILD_KEY = "weather:agg:rebuild-queued"
+# longest a queued rebuild keeps others from being queued
+AGGREGATES_REBUILD_LOCK_TTL = 600
+
+def request_aggregates_rebuild():
+    """
+    Queue recompute_weather_aggregates_task unless a rebuild is already on
+    its way, for readers that found no aggregates. Broker errors are logged.
+    """
+    if not cache.add(AGGREGATES_REBUILD_KEY, 1, timeout=AGGREGATES_REBUILD_LOCK_TTL):
+        return
+    try:
+        recompute_weather_aggregates_task.delay()
+    except Exception:
+        cache.delete(AGGREGATES_REBUILD_KEY)
+        logger.exception("Could not queue the aggregates rebuild")
+
+@shared_task(ignore_result=True)
+def schedule_due_cities_task():
+    """
+    Scheduler tick, run by Celery beat every WEATHER_SCHEDULER_TICK seconds.
+    Claims the most overdue enabled cities (by next_sync_at), at most
+    WEATHER_SCHEDULER_BUDGET per tick, and dispatches their syncs, so the
+    upstream sees a steady trickle instead of one spike per full sync.
+    Claimed cities are leased for WEATHER_SCHEDULER_LEASE seconds: a
+    successful save then moves next_sync_at out by the city's
+    refresh_interval, a failed one leaves it due again after the lease.
     """
-    logger.info("Starting concurrent city sync for %d cities", len(CITIES))
-    
-    job = group(sync_city_task.s(city) for city in CITIES)
-    group_result = job.apply_async()
-    
-    logger.info("Dispatched %d concurrent city sync tasks (group_id = %s)", len(CITIES), group_result.id)
-    return {"task_type": "group", "group_id": group_result.id, "subtasks": len(CITIES)}
+    budget = settings.WEATHER_SCHEDULER_BUDGET
+    if budget <= 0:
+        return {"task_type": "scheduled", "cities": 0}
+    if open_meteo_circuit.open_for():
+        logger.info("Circuit open, skipping scheduler tick")
+        return {"task_type": "scheduled", "cities": 0}
+
+    now = timezone.now()
+    with transaction.atomic():
+        # skip_locked: an overlapping tick claims the next cities instead of waiting
+        rows = list(
+            City.objects.enabled().due(now)
+            .select_for_update(skip_locked=True)
+            .values("id", "latitude", "longitude", city_name=F("name"))[:budget]
+        )
+        City.objects.filter(id__in=[row.pop("id") for row in rows]).update(
+            next_sync_at=now + timedelta(seconds=settings.WEATHER_SCHEDULER_LEASE),
+        )
+
+    if not rows:
+        return {"task_type": "scheduled", "cities": 0}
+    return dispatch_city_syncs(rows, "scheduler tick")
+
+SYNC_LOCK_KEY = "weather:sync:in-flight"
+
+def start_sync_all_cities(force=False):
+    """
+    Single-flight trigger for sync_all_cities_task. The first caller takes a
+    Redis lock holding the new task id for WEATHER_SYNC_LOCK_TTL seconds and
+    starts the run; callers arriving meanwhile join it and get the same id.
+    Returns (task_id, started).
+    """
+    for _ in range(2):
+        task_id = uuid()
+        if cache.add(SYNC_LOCK_KEY, task_id, timeout=settings.WEATHER_SYNC_LOCK_TTL):
+            try:
+                sync_all_cities_task.apply_async(kwargs={"force": force}, task_id=task_id)
+            except Exception:
+                cache.delete(SYNC_LOCK_KEY)
+                raise
+            logger.info("Started city sync run %s", task_id)
+            return task_id, True
+
+        in_flight = cache.get(SYNC_LOCK_KEY)
+        # None: the lock expired between add() and get(), try to take it again
+        if in_flight is not None:
+            logger.info("Joined in-flight city sync run %s", in_flight)
+            return in_flight, False
+    raise RuntimeError("could not acquire or join the sync lock")
+
+def in_flight_sync_run():
+    """Id of the run holding the single-flight lock, if any."""
+    return cache.get(SYNC_LOCK_KEY)
 
+def release_sync_lock(run_id):
+    """Let the next trigger start a new run once `run_id` has finished."""
+    if in_flight_sync_run() == run_id:
+        cache.delete(SYNC_LOCK_KEY)
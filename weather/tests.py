@@ -1,13 +1,115 @@
-from django.test import TestCase, Client
-from unittest.mock import patch
+import asyncio
+import csv
+import json
+import threading
+import time
+import warnings
+from datetime import date, datetime, timedelta, timezone as dt_timezone
+from unittest import addModuleCleanup
+from unittest.mock import Mock, patch
+
+import httpx
+import numpy as np
+from asgiref.sync import sync_to_async
+from celery.utils import uuid
+from django.core.cache import cache
+from django.db import connection
+from django.http import JsonResponse
+from django.test import (
+    AsyncClient,
+    AsyncRequestFactory,
+    Client,
+    override_settings,
+    RequestFactory,
+    TestCase,
+    TransactionTestCase,
+)
 from django.utils import timezone
-from .models import Weather
+from django.utils.http import http_date
+from prometheus_client import REGISTRY
+from redis.exceptions import RedisError
+from requests import Response
+from requests.exceptions import HTTPError, RequestException
+
+from . import aggregates, async_views, http_client, runs, views
+from .aggregates import read_aggregates, rebuild_aggregates
+from .async_sync import acquire_request_slot, run_async_sync
+from .cache import bump_weather_version
+from .circuit import CircuitBreaker, CircuitOpen, open_meteo_circuit
+from .feed import feed_events, publish_changes
+from .forecast import forecast_window, HOUR, pack_hourly, unpack
+from .geo import grid_cell
+from .history import drop_expired_observation_partitions, ensure_observation_partitions
+from .http_client import get_http_session
+from .models import City, HourlyForecast, Observation, SyncRun, Weather, WeatherPayload
+from .ratelimit import parse_retry_after, RateLimiter, RateLimitExceeded
+from .redis_client import get_redis
+from .retry import is_retryable_status
+from .services import (
+    fetch_open_meteo,
+    OPEN_METEO_URL,
+    record_open_meteo_response,
+    save_weather_bulk,
+    sync_city_batch,
+    sync_single_city,
+)
+from .tasks import (
+    recompute_weather_aggregates_task,
+    schedule_due_cities_task,
+    sync_all_cities_task,
+    sync_city_batch_task,
+    sync_city_shard_task,
+    sync_city_task,
+    SYNC_LOCK_KEY,
+    track_run,
+)
+from .serializers import serialize_weather
+from .utils import compress_payload
 
 # Create your tests here.
 
+# keep tests independent of a running Redis and of each other's cached responses
+LOCMEM_CACHES = {"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
+
+
+def setUpModule():
+    # keep test snapshots off the change feed and the aggregates of the Redis
+    # at REDIS_URL; their own tests use key names of their own
+    feed_off = override_settings(WEATHER_FEED_ENABLED=False)
+    feed_off.enable()
+    addModuleCleanup(feed_off.disable)
+    aggregates_prefix = patch("weather.aggregates.PREFIX", "test-weather:agg")
+    aggregates_prefix.start()
+    addModuleCleanup(aggregates_prefix.stop)
+
+
+class RedisTestMixin:
+    """For tests that need a real Redis: skipped when none is reachable."""
+    def setUp(self):
+        super().setUp()
+        try:
+            get_redis().ping()
+        except RedisError:
+            self.skipTest("Redis is not available")
+
+    def redis_name(self, label, *targets):
+        """
+        Unique name for this test's Redis keys, patched into the `targets`
+        (dotted paths); every key containing it is deleted afterwards.
+        """
+        name = "test-%s-%s" % (label, uuid())
+        for target in targets:
+            patcher = patch(target, name)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.addCleanup(lambda: [get_redis().delete(key) for key in get_redis().scan_iter("*%s*" % name)])
+        return name
+
+@override_settings(CACHES=LOCMEM_CACHES, WEATHER_RATE_LIMIT_ENABLED=False)
 class WeatherAPITests(TestCase):
     def setUp(self):
         self.client = Client()
+        cache.clear()
     
     def test_weather_list_empty(self):
         resp = self.client.get("/api/weather/")
@@ -126,19 +228,25 @@ class WeatherAPITests(TestCase):
         resp = self.client.get("/api/weather/999999/")
         self.assertEqual(resp.status_code, 404)
     
-    @patch("weather.tasks.sync_all_cities_task.delay")
-    def test_sync_endpoint_returns_task_id(self, mock_delay):
-        # fake celery AsyncResult-like object
-        class DummyTask:
-            id = "test-task-id"
-        
-        mock_delay.return_value = DummyTask()
-        
+    @patch("weather.tasks.uuid", return_value="test-task-id")
+    @patch("weather.tasks.sync_all_cities_task.apply_async")
+    def test_sync_endpoint_returns_task_id(self, mock_apply_async, mock_uuid):
         resp = self.client.post("/api/sync/")
         self.assertEqual(resp.status_code, 200)
         data = resp.json()
         self.assertEqual(data["status"], "started")
         self.assertEqual(data["task_id"], "test-task-id")
+        mock_apply_async.assert_called_once_with(kwargs={"force": False}, task_id="test-task-id")
+
+    @patch("weather.tasks.sync_all_cities_task.apply_async")
+    def test_concurrent_sync_triggers_join_the_run_in_flight(self, mock_apply_async):
+        first = self.client.post("/api/sync/").json()
+        second = self.client.post("/api/sync/").json()
+
+        self.assertEqual(first["status"], "started")
+        self.assertEqual(second["status"], "in_progress")
+        self.assertEqual(second["task_id"], first["task_id"])
+        mock_apply_async.assert_called_once()
     
     def test_sync_endpoint_requires_csrf(self):
         csrf_client = Client(enforce_csrf_checks=True)
@@ -157,12 +265,41 @@ class WeatherAPITests(TestCase):
         body = resp.json()
         self.assertEqual(body["id"], w.id)
         self.assertEqual(body["city_name"], "Test City")
-    
-    @patch("weather.services.requests.get")
-    def test_sync_single_city_mocked_api(self, mock_get):
-        from weather.services import sync_single_city, OPEN_METEO_URL
+        self.assertNotIn("raw_payload", body)
+
+    def test_fast_serialization_is_byte_identical_to_json_response(self):
+        now = timezone.now()
+        Weather.objects.create(
+            city_name="São Paulo", latitude=-23.55, longitude=-46.63, temperature=21.3,
+            windspeed=7.2, winddirection=135, weathercode=2, time=now, synced_at=now,
+        )
+        Weather.objects.create(city_name="Empty", latitude=0.0, longitude=0.0)
+        rows = list(Weather.objects.order_by("id"))
+
+        resp = self.client.get("/api/weather/?limit=10")
+        expected = JsonResponse({"count": 2, "results": [serialize_weather(w) for w in rows]})
+        self.assertEqual(resp.content, expected.content)
+        self.assertEqual(resp["Content-Type"], expected["Content-Type"])
+
+        resp = self.client.get(f"/api/weather/{rows[0].id}/")
+        self.assertEqual(resp.content, JsonResponse(serialize_weather(rows[0])).content)
+
+    def test_weather_detail_includes_raw_payload_on_request(self):
+        w = Weather.objects.create(city_name="Test City", latitude=1.0, longitude=2.0)
+        WeatherPayload.objects.create(weather=w, data=compress_payload({"current_weather": {"temperature": 3.0}}))
+
+        resp = self.client.get(f"/api/weather/{w.id}/?include=raw_payload")
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.json()["raw_payload"], {"current_weather": {"temperature": 3.0}})
 
+        resp = self.client.get(f"/api/weather/{w.id}/?include=everything")
+        self.assertEqual(resp.status_code, 400)
+    
+    @patch("weather.services.get_http_session")
+    def test_sync_single_city_mocked_api(self, mock_session):
+        mock_get = mock_session.return_value.get
         mock_response = mock_get.return_value
+        mock_response.status_code = 200
         mock_response.raise_for_status.return_value = None
         mock_response.json.return_value = {
             "current_weather": {
@@ -181,8 +318,14 @@ class WeatherAPITests(TestCase):
 
         mock_get.assert_called_once_with(
             OPEN_METEO_URL,
-            params={"latitude": 51.5074, "longitude": -0.1278, "current_weather": "true"},
-            timeout=10,
+            params={
+                "latitude": 51.5074,
+                "longitude": -0.1278,
+                "current_weather": "true",
+                "hourly": "temperature_2m,windspeed_10m",
+                "forecast_days": 7,
+            },
+            timeout=(3.05, 10.0),
         )
 
         weather = Weather.objects.get(city_name="London")
@@ -194,4 +337,1351 @@ class WeatherAPITests(TestCase):
         # time parsed + timezone-aware
         self.assertIsNotNone(weather.time)
         self.assertTrue(timezone.is_aware(weather.time))
-        self.assertEqual(weather.time.isoformat(), "2026-01-20T12:00:00+00:00")
\ No newline at end of file
+        self.assertEqual(weather.time.isoformat(), "2026-01-20T12:00:00+00:00")
+
+@override_settings(CACHES=LOCMEM_CACHES, WEATHER_RATE_LIMIT_ENABLED=False)
+class WeatherBatchSyncTests(TestCase):
+    cities = [
+        {"city_name": "Paris", "latitude": 48.8566, "longitude": 2.3522},
+        {"city_name": "London", "latitude": 51.5074, "longitude": -0.1278},
+    ]
+
+    @patch("weather.services.get_http_session")
+    def test_sync_city_batch_splits_response_per_city(self, mock_session):
+        mock_get = mock_session.return_value.get
+        mock_response = mock_get.return_value
+        mock_response.status_code = 200
+        mock_response.raise_for_status.return_value = None
+        mock_response.json.return_value = [
+            {"current_weather": {"temperature": 3.1, "weathercode": 3, "time": "2026-01-20T12:00"}},
+            {"current_weather": {"temperature": 7.4, "weathercode": 1, "time": "2026-01-20T12:00"}},
+        ]
+
+        results = sync_city_batch(self.cities)
+        self.assertEqual(results, {"Paris": True, "London": True})
+
+        mock_get.assert_called_once_with(
+            OPEN_METEO_URL,
+            params={
+                "latitude": "48.8566,51.5074",
+                "longitude": "2.3522,-0.1278",
+                "current_weather": "true",
+                "hourly": "temperature_2m,windspeed_10m",
+                "forecast_days": 7,
+            },
+            timeout=(3.05, 10.0),
+        )
+        self.assertEqual(Weather.objects.get(city_name="Paris").temperature, 3.1)
+        self.assertEqual(Weather.objects.get(city_name="London").temperature, 7.4)
+
+    @patch("weather.services.get_http_session")
+    def test_sync_city_batch_rejects_mismatched_response(self, mock_session):
+        mock_get = mock_session.return_value.get
+        mock_get.return_value.status_code = 200
+        mock_get.return_value.raise_for_status.return_value = None
+        mock_get.return_value.json.return_value = [{"current_weather": {}}]
+
+        with self.assertRaises(ValueError):
+            sync_city_batch(self.cities)
+        self.assertEqual(Weather.objects.count(), 0)
+
+    @override_settings(WEATHER_FETCH_GRID_DEGREES=0.1)
+    @patch("weather.services.get_http_session")
+    def test_sync_city_batch_coalesces_grid_cells(self, mock_session):
+        cache.clear()
+        mock_get = mock_session.return_value.get
+        mock_get.return_value.status_code = 200
+        mock_get.return_value.raise_for_status.return_value = None
+        mock_get.return_value.json.return_value = [
+            {"current_weather": {"temperature": 3.1, "time": "2026-01-20T12:00"}},
+            {"current_weather": {"temperature": 7.4, "time": "2026-01-20T12:00"}},
+        ]
+
+        results = sync_city_batch(self.cities + [
+            {"city_name": "Marais", "latitude": 48.859, "longitude": 2.362},
+        ])
+        self.assertEqual(results, {"Paris": True, "London": True, "Marais": True})
+        mock_get.assert_called_once_with(
+            OPEN_METEO_URL,
+            params={
+                "latitude": "48.9,51.5",
+                "longitude": "2.4,-0.1",
+                "current_weather": "true",
+                "hourly": "temperature_2m,windspeed_10m",
+                "forecast_days": 7,
+            },
+            timeout=(3.05, 10.0),
+        )
+        marais = Weather.objects.get(city_name="Marais")
+        self.assertEqual(marais.temperature, 3.1)
+        self.assertEqual(marais.latitude, 48.859)
+
+        # another worker syncing a city in the same cell reuses the cached payload
+        self.assertEqual(
+            sync_city_batch([{"city_name": "Bastille", "latitude": 48.8532, "longitude": 2.3691}]),
+            {"Bastille": True},
+        )
+        self.assertEqual(mock_get.call_count, 1)
+        self.assertEqual(Weather.objects.get(city_name="Bastille").temperature, 3.1)
+
+    @patch("weather.tasks.fall_back_to_city_tasks")
+    @patch("weather.tasks.sync_city_batch")
+    def test_sync_city_batch_task_falls_back_on_4xx(self, mock_batch, mock_fallback):
+        response = Response()
+        response.status_code = 400
+        mock_batch.side_effect = HTTPError(response=response)
+        mock_fallback.return_value = {"task_type": "fallback_group"}
+
+        result = sync_city_batch_task.apply(args=[self.cities]).get()
+        self.assertEqual(result, {"task_type": "fallback_group"})
+        mock_fallback.assert_called_once_with(self.cities, None)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class WeatherBulkSaveTests(TestCase):
+    def test_save_weather_bulk_upserts_and_reports_per_city(self):
+        Weather.objects.create(city_name="Paris", latitude=0.0, longitude=0.0, temperature=1.0)
+
+        items = [
+            ({"city_name": "Paris", "latitude": 48.8566, "longitude": 2.3522},
+             {"current_weather": {"temperature": 3.1, "time": "2026-01-20T12:00"}}),
+            ({"city_name": "London", "latitude": 51.5074, "longitude": -0.1278},
+             {"current_weather": {"temperature": 7.4, "time": "2026-01-20T12:00"}}),
+            ({"city_name": "Tokyo", "latitude": 35.6762, "longitude": 139.6503},
+             {"current_weather": {"time": "not-a-time"}}),
+        ]
+
+        results = save_weather_bulk(items, batch_size=2)
+        self.assertEqual(results, {"Paris": True, "London": True, "Tokyo": False})
+
+        self.assertEqual(Weather.objects.count(), 2)
+        paris = Weather.objects.get(city_name="Paris")
+        self.assertEqual(paris.temperature, 3.1)
+        self.assertEqual(paris.latitude, 48.8566)
+        self.assertIsNotNone(paris.synced_at)
+
+    def test_save_weather_bulk_stores_compressed_payloads(self):
+        city = {"city_name": "Paris", "latitude": 48.8566, "longitude": 2.3522}
+        save_weather_bulk([(city, {"current_weather": {"temperature": 1.0}})])
+        save_weather_bulk([(city, {"current_weather": {"temperature": 2.0}})])
+
+        payload = WeatherPayload.objects.get(weather__city_name="Paris")
+        self.assertEqual(payload.raw_payload, {"current_weather": {"temperature": 2.0}})
+        self.assertEqual(WeatherPayload.objects.count(), 1)
+
+    def test_unchanged_snapshot_only_bumps_synced_at(self):
+        city = {"city_name": "Paris", "latitude": 48.8566, "longitude": 2.3522}
+        first = {"generationtime_ms": 0.1, "current_weather": {"temperature": 1.0, "time": "2026-01-20T12:00"}}
+        again = {"generationtime_ms": 0.2, "current_weather": {"temperature": 1.0, "time": "2026-01-20T12:00"}}
+
+        save_weather_bulk([(city, first)])
+        synced_at = Weather.objects.get(city_name="Paris").synced_at
+        self.assertEqual(save_weather_bulk([(city, again)]), {"Paris": True})
+
+        self.assertGreater(Weather.objects.get(city_name="Paris").synced_at, synced_at)
+        self.assertEqual(Observation.objects.filter(city_name="Paris").count(), 1)
+        self.assertEqual(WeatherPayload.objects.get(weather__city_name="Paris").raw_payload, first)
+
+        with override_settings(WEATHER_TOUCH_UNCHANGED=False):
+            synced_at = Weather.objects.get(city_name="Paris").synced_at
+            save_weather_bulk([(city, again)])
+            self.assertEqual(Weather.objects.get(city_name="Paris").synced_at, synced_at)
+
+
+
+class HTTPClientTests(TestCase):
+    def test_session_is_reused_within_a_process(self):
+        session = get_http_session()
+        self.assertIs(get_http_session(), session)
+        self.assertEqual(session.headers["Accept-Encoding"], "gzip, deflate")
+        self.assertEqual(session.get_adapter("https://api.open-meteo.com")._pool_maxsize, 10)
+
+    def test_forked_process_gets_its_own_session(self):
+        session = http_client.get_http_session()
+        with patch("weather.http_client.os.getpid", return_value=-1):
+            self.assertIsNot(http_client.get_http_session(), session)
+
+
+
+@override_settings(
+    CACHES=LOCMEM_CACHES,
+    WEATHER_RATE_LIMIT_ENABLED=False,
+    WEATHER_FETCH_GRID_DEGREES=0.1,
+    WEATHER_SYNC_BATCH_SIZE=0,
+)
+class GridCoalescingTests(TransactionTestCase):
+    def setUp(self):
+        cache.clear()
+
+    @patch("weather.services.get_http_session")
+    def test_concurrent_city_tasks_share_one_fetch(self, mock_session):
+        fetching = threading.Event()
+
+        def get(url, params, timeout):
+            fetching.set()
+            time.sleep(0.3)
+            response = Mock(status_code=200, headers={})
+            response.json.return_value = {"current_weather": {"temperature": 5.0}}
+            return response
+
+        mock_session.return_value.get.side_effect = get
+        results = {}
+
+        def sync(city):
+            results[city["city_name"]] = sync_city_task.apply(args=[city]).result["status"]
+            connection.close()
+
+        # co-located cities in the same group of per-city tasks
+        first = threading.Thread(target=sync, args=[{"city_name": "Paris", "latitude": 48.8566, "longitude": 2.3522}])
+        first.start()
+        fetching.wait(5)
+        second = threading.Thread(target=sync, args=[{"city_name": "Marais", "latitude": 48.859, "longitude": 2.362}])
+        second.start()
+        first.join()
+        second.join()
+
+        self.assertEqual(results, {"Paris": "success", "Marais": "success"})
+        mock_session.return_value.get.assert_called_once()
+        self.assertEqual(Weather.objects.get(city_name="Marais").latitude, 48.859)
+
+    @override_settings(WEATHER_FETCH_INFLIGHT_WAIT=5)
+    @patch("weather.services.get_http_session")
+    def test_failed_fetch_is_not_waited_for(self, mock_session):
+        cache.add("weather:grid-inflight:0.1:48.9,2.4", 1)
+        threading.Timer(0.1, cache.delete, ["weather:grid-inflight:0.1:48.9,2.4"]).start()
+        mock_session.return_value.get.return_value = Mock(status_code=200, headers={})
+        mock_session.return_value.get.return_value.json.return_value = {"current_weather": {"temperature": 5.0}}
+
+        started = time.monotonic()
+        self.assertTrue(sync_single_city({"city_name": "Paris", "latitude": 48.8566, "longitude": 2.3522}))
+        self.assertLess(time.monotonic() - started, 2)
+        mock_session.return_value.get.assert_called_once()
+
+
+@override_settings(CACHES=LOCMEM_CACHES, WEATHER_RATE_LIMIT_ENABLED=False)
+class AsyncSyncEngineTests(TransactionTestCase):
+    cities = [
+        {"city_name": "Paris", "latitude": 48.8566, "longitude": 2.3522},
+        {"city_name": "London", "latitude": 51.5074, "longitude": -0.1278},
+        {"city_name": "Nowhere", "latitude": 999.0, "longitude": 999.0},
+    ]
+
+    def run_with_transport(self, handler):
+        def build_client(max_connections):
+            return httpx.AsyncClient(transport=httpx.MockTransport(handler))
+
+        with patch("weather.async_sync.build_async_client", build_client), \
+                patch("weather.async_sync.retry_countdown", return_value=0):
+            return run_async_sync(self.cities, concurrency=2)
+
+    def test_sync_cities_async_retries_5xx_and_skips_4xx(self):
+        calls = {}
+
+        def handler(request):
+            latitude = request.url.params["latitude"]
+            calls[latitude] = calls.get(latitude, 0) + 1
+            if latitude == "999.0":
+                return httpx.Response(400, json={"error": True})
+            if latitude == "48.8566" and calls[latitude] == 1:
+                return httpx.Response(503)
+            return httpx.Response(200, json={"current_weather": {"temperature": 5.0}})
+
+        results = self.run_with_transport(handler)
+
+        self.assertEqual(results, {"Paris": True, "London": True, "Nowhere": False})
+        self.assertEqual(calls, {"48.8566": 2, "51.5074": 1, "999.0": 1})
+        self.assertEqual(Weather.objects.count(), 2)
+        self.assertEqual(Weather.objects.get(city_name="Paris").temperature, 5.0)
+
+    def test_sync_cities_async_retries_429(self):
+        calls = {}
+
+        def handler(request):
+            latitude = request.url.params["latitude"]
+            calls[latitude] = calls.get(latitude, 0) + 1
+            if calls[latitude] == 1:
+                return httpx.Response(429, headers={"Retry-After": "0"})
+            return httpx.Response(200, json={"current_weather": {"temperature": 5.0}})
+
+        results = self.run_with_transport(handler)
+
+        self.assertEqual(results, {"Paris": True, "London": True, "Nowhere": True})
+        self.assertEqual(calls, {"48.8566": 2, "51.5074": 2, "999.0": 2})
+
+    @override_settings(WEATHER_FETCH_GRID_DEGREES=0.1)
+    def test_sync_cities_async_coalesces_grid_cells(self):
+        cache.clear()
+        calls = []
+
+        def handler(request):
+            calls.append(request.url.params["latitude"])
+            return httpx.Response(200, json={"current_weather": {"temperature": 5.0}})
+
+        self.cities = [
+            {"city_name": "Paris", "latitude": 48.8566, "longitude": 2.3522},
+            {"city_name": "Marais", "latitude": 48.859, "longitude": 2.362},
+            {"city_name": "London", "latitude": 51.5074, "longitude": -0.1278},
+        ]
+        results = self.run_with_transport(handler)
+
+        self.assertEqual(results, {"Paris": True, "Marais": True, "London": True})
+        self.assertEqual(sorted(calls), ["48.9", "51.5"])
+        self.assertEqual(Weather.objects.get(city_name="Marais").latitude, 48.859)
+
+
+@override_settings(
+    CACHES=LOCMEM_CACHES,
+    WEATHER_CIRCUIT_FAILURE_THRESHOLD=2,
+    WEATHER_CIRCUIT_OPEN_SECONDS=60,
+)
+class CircuitBreakerTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.circuit = CircuitBreaker("test")
+
+    def test_failures_open_the_circuit(self):
+        self.circuit.record_failure()
+        self.circuit.before_request()
+        self.circuit.record_failure()
+
+        with self.assertRaises(CircuitOpen) as ctx:
+            self.circuit.before_request()
+        self.assertGreater(ctx.exception.retry_after, 59)
+        self.assertGreater(self.circuit.open_for(), 59)
+
+    def test_half_open_allows_a_single_probe(self):
+        self.circuit.record_failure()
+        self.circuit.record_failure()
+
+        with patch("weather.circuit.time.time", return_value=time.time() + 61):
+            probe = self.circuit.before_request()
+            self.assertTrue(probe)
+            with self.assertRaises(CircuitOpen):
+                self.circuit.before_request()
+
+            self.circuit.record_success(probe)
+            self.assertFalse(self.circuit.before_request())
+            self.assertEqual(self.circuit.open_for(), 0)
+
+    def test_only_the_probe_closes_the_circuit(self):
+        self.circuit.record_failure()
+        self.circuit.record_failure()
+
+        # a request sent before the circuit opened
+        self.circuit.record_success()
+        self.circuit.record_failure()
+        self.assertGreater(self.circuit.open_for(), 59)
+
+    @patch("weather.services.open_meteo_limiter")
+    def test_throttled_probe_leaves_the_circuit_half_open(self, mock_limiter):
+        with override_settings(WEATHER_CIRCUIT_FAILURE_THRESHOLD=1):
+            open_meteo_circuit.record_failure()
+
+        with patch("weather.circuit.time.time", return_value=time.time() + 61):
+            record_open_meteo_response(429, 0.1, probe=open_meteo_circuit.before_request())
+            self.assertEqual(open_meteo_circuit.open_for(), 0)
+
+            # the next caller probes again
+            record_open_meteo_response(200, 0.1, probe=open_meteo_circuit.before_request())
+            self.assertFalse(open_meteo_circuit.before_request())
+
+    @patch("weather.services.get_http_session")
+    @patch("weather.services.open_meteo_limiter.acquire", side_effect=RateLimitExceeded(5))
+    def test_probe_refused_by_the_rate_limiter_is_released(self, mock_acquire, mock_session):
+        with override_settings(WEATHER_CIRCUIT_FAILURE_THRESHOLD=1):
+            open_meteo_circuit.record_failure()
+
+        with patch("weather.circuit.time.time", return_value=time.time() + 61):
+            with self.assertRaises(RateLimitExceeded):
+                fetch_open_meteo({})
+            mock_session.return_value.get.assert_not_called()
+            self.assertTrue(open_meteo_circuit.before_request())
+
+    @patch("weather.async_sync.asyncio.sleep")
+    @patch("weather.async_sync.open_meteo_limiter.try_acquire", side_effect=[0.5, 0])
+    async def test_async_probe_is_not_held_while_waiting_for_a_token(self, mock_try_acquire, mock_sleep):
+        with override_settings(WEATHER_CIRCUIT_FAILURE_THRESHOLD=1):
+            open_meteo_circuit.record_failure()
+        mock_sleep.side_effect = lambda wait: self.assertIsNone(cache.get(open_meteo_circuit.probe_key))
+
+        with patch("weather.circuit.time.time", return_value=time.time() + 61):
+            self.assertTrue(await acquire_request_slot())
+        mock_sleep.assert_called_once_with(0.5)
+
+    def test_failed_probe_reopens_the_circuit(self):
+        self.circuit.record_failure()
+        self.circuit.record_failure()
+
+        later = time.time() + 61
+        with patch("weather.circuit.time.time", return_value=later):
+            self.circuit.record_failure(self.circuit.before_request())
+            with self.assertRaises(CircuitOpen):
+                self.circuit.before_request()
+            self.assertGreater(self.circuit.open_for(), 59)
+
+    @override_settings(WEATHER_SYNC_MAX_DEFERRALS=2)
+    @patch("weather.tasks.dispatch_city_syncs")
+    def test_shard_is_dispatched_once_out_of_deferrals(self, mock_dispatch):
+        with override_settings(WEATHER_CIRCUIT_FAILURE_THRESHOLD=1):
+            open_meteo_circuit.record_failure()
+        City.objects.all().delete()
+        City.objects.create(name="Paris", latitude=48.8566, longitude=2.3522)
+
+        result = sync_city_shard_task.apply(args=[0, 2 ** 31])
+        self.assertEqual(result.state, "IGNORED")
+        # dispatched on the third attempt, to be synced or failed city by city
+        mock_dispatch.assert_called_once()
+        self.assertEqual([c["city_name"] for c in mock_dispatch.call_args.args[0]], ["Paris"])
+
+    @patch("weather.services.get_http_session")
+    def test_sync_single_city_fails_fast_while_open(self, mock_session):
+        with override_settings(WEATHER_CIRCUIT_FAILURE_THRESHOLD=1):
+            open_meteo_circuit.record_failure()
+
+        with self.assertRaises(CircuitOpen):
+            sync_single_city({"city_name": "Paris", "latitude": 48.8566, "longitude": 2.3522})
+        mock_session.return_value.get.assert_not_called()
+
+
+class RateLimiterTests(RedisTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.limiter = RateLimiter(self.redis_name("ratelimit"))
+
+    def test_parse_retry_after(self):
+        self.assertEqual(parse_retry_after("120"), 120.0)
+        self.assertEqual(parse_retry_after(None), 0)
+        self.assertEqual(parse_retry_after("garbage"), 0)
+        self.assertEqual(parse_retry_after("Wed, 21 Oct 2015 07:28:00 GMT"), 0)
+
+    def test_429_is_retryable(self):
+        self.assertTrue(is_retryable_status(429))
+        self.assertFalse(is_retryable_status(404))
+
+    @override_settings(WEATHER_RATE_LIMIT=1, WEATHER_RATE_LIMIT_BURST=2)
+    def test_bucket_allows_burst_then_asks_to_wait(self):
+        self.assertEqual(self.limiter.try_acquire(), 0)
+        self.assertEqual(self.limiter.try_acquire(), 0)
+        self.assertGreater(self.limiter.try_acquire(), 0.5)
+        with self.assertRaises(RateLimitExceeded):
+            self.limiter.acquire(max_wait=0)
+
+    @override_settings(
+        WEATHER_RATE_LIMIT=10,
+        WEATHER_RATE_LIMIT_MIN=1,
+        WEATHER_RATE_LIMIT_DECREASE=0.5,
+        WEATHER_RATE_LIMIT_DECREASE_INTERVAL=0.05,
+        WEATHER_RATE_LIMIT_SLOW_SECONDS=0.1,
+    )
+    def test_rate_adapts_to_responses(self):
+        self.limiter.record(200, 0.01)
+        self.assertAlmostEqual(self.limiter.current_rate(), 10.1)
+        self.limiter.record(503, 0.01)
+        self.assertAlmostEqual(self.limiter.current_rate(), 5.05)
+        time.sleep(0.2)
+        # sent before the decrease: part of the same congestion event
+        self.limiter.record(200, 60)
+        self.assertAlmostEqual(self.limiter.current_rate(), 5.05)
+        self.limiter.record(200, 0.15)
+        self.assertAlmostEqual(self.limiter.current_rate(), 2.525)
+
+    @override_settings(WEATHER_RATE_LIMIT=10, WEATHER_RATE_LIMIT_MIN=1, WEATHER_RATE_LIMIT_DECREASE=0.5)
+    def test_burst_of_throttles_halves_the_rate_once(self):
+        for _ in range(8):
+            self.limiter.record(429, 0.01)
+        self.assertAlmostEqual(self.limiter.current_rate(), 5.0)
+
+    @override_settings(WEATHER_RATE_LIMIT=1, WEATHER_RATE_LIMIT_BURST=2)
+    def test_cost_above_burst_is_charged_in_full(self):
+        self.assertEqual(self.limiter.try_acquire(5), 0)
+        # three tokens in debt, plus the one asked for
+        self.assertGreater(self.limiter.try_acquire(), 3.5)
+
+    def test_retry_after_blocks_the_bucket(self):
+        self.limiter.record(429, 0.1, retry_after=30)
+        self.assertGreater(self.limiter.try_acquire(), 29)
+
+
+
+@override_settings(CACHES=LOCMEM_CACHES, WEATHER_SYNC_MAX_DEFERRALS=5)
+class SyncDeferralTests(TestCase):
+    city = {"city_name": "Paris", "latitude": 48.8566, "longitude": 2.3522}
+
+    @patch("weather.tasks.sync_single_city")
+    def test_deferrals_do_not_use_up_retries(self, mock_sync):
+        retries = []
+
+        def rate_limited(city_data):
+            retries.append(sync_city_task.request.retries)
+            raise RateLimitExceeded(0)
+
+        mock_sync.side_effect = rate_limited
+        sync_city_task.apply(args=[self.city])
+
+        # the first attempt and five deferrals, none of them a retry
+        self.assertEqual(retries, [0] * 6)
+
+    @patch("weather.tasks.sync_single_city")
+    def test_deferral_keeps_retry_count(self, mock_sync):
+        retries = []
+
+        def flaky(city_data):
+            retries.append(sync_city_task.request.retries)
+            if len(retries) == 1:
+                raise RequestException("connection reset")
+            if len(retries) == 2:
+                raise CircuitOpen(0)
+            return True
+
+        mock_sync.side_effect = flaky
+        with patch("weather.tasks.retry_countdown", return_value=0):
+            sync_city_task.apply(args=[self.city])
+        self.assertEqual(retries, [0, 1, 1])
+
+    @patch("weather.tasks.sync_city_batch", side_effect=CircuitOpen(0))
+    def test_batch_fails_its_cities_after_max_deferrals(self, mock_batch):
+        result = sync_city_batch_task.apply(args=[[self.city]])
+        self.assertEqual(mock_batch.call_count, 6)
+
+        # a deferred message is done with, not failed
+        self.assertEqual(result.state, "IGNORED")
+
+
+class CityRegistryTests(TestCase):
+    def setUp(self):
+        City.objects.all().delete()
+
+    def test_stale_excludes_recently_synced_cities(self):
+        now = timezone.now()
+        for name in ("Fresh", "Upstream not advanced", "Stale", "Never synced"):
+            City.objects.create(name=name, latitude=0.0, longitude=0.0)
+        Weather.objects.create(city_name="Fresh", latitude=0.0, longitude=0.0, synced_at=now)
+        Weather.objects.create(
+            city_name="Upstream not advanced",
+            latitude=0.0,
+            longitude=0.0,
+            synced_at=now - timedelta(hours=1),
+            time=now - timedelta(minutes=5),
+        )
+        Weather.objects.create(
+            city_name="Stale",
+            latitude=0.0,
+            longitude=0.0,
+            synced_at=now - timedelta(hours=1),
+            time=now - timedelta(hours=1),
+        )
+
+        self.assertEqual(
+            sorted(City.objects.stale().values_list("name", flat=True)),
+            ["Never synced", "Stale"],
+        )
+
+    @patch("weather.tasks.sync_city_shard_task.delay")
+    def test_coordinator_dispatches_id_range_shards(self, mock_delay):
+        cities = [
+            City.objects.create(name=f"City {i}", latitude=float(i), longitude=float(i))
+            for i in range(5)
+        ]
+        City.objects.filter(pk=cities[2].pk).update(enabled=False)
+
+        with override_settings(WEATHER_SYNC_SHARD_SIZE=2):
+            result = sync_all_cities_task()
+
+        self.assertEqual(result, {"task_type": "sharded", "shards": 2, "cities": 4})
+        self.assertEqual(
+            [c.args for c in mock_delay.call_args_list],
+            [(cities[0].pk, cities[1].pk), (cities[3].pk, cities[4].pk)],
+        )
+
+    @patch("weather.tasks.sync_city_shard_task.delay")
+    def test_coordinator_skips_fresh_cities_unless_forced(self, mock_delay):
+        City.objects.create(name="Paris", latitude=48.8566, longitude=2.3522)
+        Weather.objects.create(city_name="Paris", latitude=48.8566, longitude=2.3522, synced_at=timezone.now())
+
+        self.assertEqual(sync_all_cities_task()["cities"], 0)
+        self.assertEqual(sync_all_cities_task(force=True)["cities"], 1)
+
+    @patch("weather.tasks.group")
+    def test_shard_task_syncs_enabled_cities_in_range(self, mock_group):
+        paris = City.objects.create(name="Paris", latitude=48.8566, longitude=2.3522)
+        City.objects.create(name="Off", latitude=0.0, longitude=0.0, enabled=False)
+        london = City.objects.create(name="London", latitude=51.5074, longitude=-0.1278)
+
+        sync_city_shard_task(paris.pk, london.pk)
+
+        signatures = list(mock_group.call_args.args[0])
+        self.assertEqual(
+            [sig.args[0] for sig in signatures],
+            [
+                {"city_name": "Paris", "latitude": 48.8566, "longitude": 2.3522},
+                {"city_name": "London", "latitude": 51.5074, "longitude": -0.1278},
+            ],
+        )
+
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class WeatherKeysetPaginationTests(TestCase):
+    def setUp(self):
+        self.client = Client()
+        cache.clear()
+        for i in range(5):
+            Weather.objects.create(city_name=f"City {i}", latitude=float(i), longitude=float(i))
+
+    def test_cursor_walks_every_row_once(self):
+        names = []
+        url = "/api/weather/?limit=2&cursor="
+        pages = 0
+        while url:
+            resp = self.client.get(url)
+            self.assertEqual(resp.status_code, 200)
+            data = resp.json()
+            self.assertNotIn("count", data)
+            names += [w["city_name"] for w in data["results"]]
+            url = data["next"]
+            pages += 1
+
+        self.assertEqual(pages, 3)
+        self.assertEqual(names, [f"City {i}" for i in range(5)])
+
+    def test_cursor_with_count(self):
+        resp = self.client.get("/api/weather/?cursor=&count=exact")
+        self.assertEqual(resp.json()["count"], 5)
+        self.assertIsNone(resp.json()["next"])
+
+        resp = self.client.get("/api/weather/?cursor=&count=approx")
+        self.assertEqual(resp.json()["count"], 5)
+
+    def test_invalid_cursor(self):
+        resp = self.client.get("/api/weather/?cursor=not-a-cursor")
+        self.assertEqual(resp.status_code, 400)
+        self.assertIn("error", resp.json())
+
+    def test_cursor_and_offset_are_exclusive(self):
+        resp = self.client.get("/api/weather/?cursor=&offset=2")
+        self.assertEqual(resp.status_code, 400)
+
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class WeatherResponseCacheTests(TestCase):
+    def setUp(self):
+        self.client = Client()
+        cache.clear()
+        self.weather = Weather.objects.create(
+            city_name="Paris",
+            latitude=48.8566,
+            longitude=2.3522,
+            temperature=3.0,
+            synced_at=timezone.now(),
+        )
+
+    def test_repeated_get_is_served_from_cache(self):
+        url = f"/api/weather/{self.weather.id}/"
+        first = self.client.get(url)
+        self.assertEqual(first.status_code, 200)
+        self.assertIn("ETag", first)
+        self.assertIn("Last-Modified", first)
+
+        with self.assertNumQueries(0):
+            second = self.client.get(url)
+        self.assertEqual(second.content, first.content)
+
+    def test_conditional_get_returns_304(self):
+        first = self.client.get("/api/weather/")
+        resp = self.client.get("/api/weather/", HTTP_IF_NONE_MATCH=first["ETag"])
+        self.assertEqual(resp.status_code, 304)
+        self.assertEqual(resp.content, b"")
+
+        detail = self.client.get(f"/api/weather/{self.weather.id}/")
+        resp = self.client.get(f"/api/weather/{self.weather.id}/", HTTP_IF_MODIFIED_SINCE=detail["Last-Modified"])
+        self.assertEqual(resp.status_code, 304)
+
+    def test_list_pages_are_not_validated_by_modification_date(self):
+        # a row added past the page changes its count without a newer synced_at
+        first = self.client.get("/api/weather/?limit=1")
+        empty = self.client.get("/api/weather/?offset=100")
+        self.assertNotIn("Last-Modified", first)
+        self.assertNotIn("Last-Modified", empty)
+
+        since = http_date(time.time() + 60)
+        Weather.objects.create(city_name="Lyon", latitude=45.76, longitude=4.84, temperature=9.0, synced_at=self.weather.synced_at)
+        bump_weather_version()
+        resp = self.client.get("/api/weather/?limit=1", HTTP_IF_MODIFIED_SINCE=since)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.json()["count"], 2)
+
+    def test_sync_write_invalidates_cached_responses(self):
+        url = f"/api/weather/{self.weather.id}/"
+        self.assertEqual(self.client.get(url).json()["temperature"], 3.0)
+
+        save_weather_bulk([
+            ({"city_name": "Paris", "latitude": 48.8566, "longitude": 2.3522},
+             {"current_weather": {"temperature": 9.0}}),
+        ])
+        self.assertEqual(self.client.get(url).json()["temperature"], 9.0)
+
+    def test_not_found_is_not_cached(self):
+        self.assertEqual(self.client.get("/api/weather/999999/").status_code, 404)
+        Weather.objects.create(id=999999, city_name="Late", latitude=0.0, longitude=0.0)
+        self.assertEqual(self.client.get("/api/weather/999999/").status_code, 200)
+
+
+
+class WeatherExportTests(TestCase):
+    def setUp(self):
+        self.client = Client()
+        Weather.objects.create(city_name="Paris", latitude=48.8566, longitude=2.3522, temperature=3.0)
+        Weather.objects.create(
+            city_name="London",
+            latitude=51.5074,
+            longitude=-0.1278,
+            synced_at=timezone.now(),
+        )
+
+    def test_export_ndjson(self):
+        resp = self.client.get("/api/weather/export/")
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp["Content-Type"], "application/x-ndjson")
+
+        lines = b"".join(resp.streaming_content).decode().splitlines()
+        rows = [json.loads(line) for line in lines]
+        self.assertEqual([r["city_name"] for r in rows], ["Paris", "London"])
+        self.assertEqual(rows[0]["temperature"], 3.0)
+        self.assertIsNone(rows[0]["synced_at"])
+        self.assertIsNotNone(rows[1]["synced_at"])
+
+    def test_export_csv(self):
+        resp = self.client.get("/api/weather/export/?format=csv")
+        self.assertEqual(resp.status_code, 200)
+
+        rows = list(csv.reader(b"".join(resp.streaming_content).decode().splitlines()))
+        self.assertEqual(rows[0][:2], ["id", "city_name"])
+        self.assertEqual([r[1] for r in rows[1:]], ["Paris", "London"])
+
+    def test_export_invalid_format(self):
+        resp = self.client.get("/api/weather/export/?format=xml")
+        self.assertEqual(resp.status_code, 400)
+
+    @patch("weather.views.EXPORT_CHUNK_SIZE", 1)
+    async def test_asgi_export_streams_one_chunk_at_a_time(self):
+        with warnings.catch_warnings():
+            # Django warns when it has to read a sync iterator to the end first
+            warnings.simplefilter("error")
+            resp = await AsyncClient().get("/api/weather/export/")
+            self.assertTrue(resp.is_async)
+            chunks = [chunk async for chunk in resp.streaming_content]
+            self.assertEqual([json.loads(chunk)["city_name"] for chunk in chunks], ["Paris", "London"])
+
+            resp = await AsyncClient().get("/api/weather/export/?format=csv")
+            chunks = [chunk async for chunk in resp.streaming_content]
+            self.assertEqual([row[1] for row in csv.reader(b"".join(chunks).decode().splitlines())],
+                             ["city_name", "Paris", "London"])
+            self.assertEqual(len(chunks), 3)
+
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class ObservationHistoryTests(TestCase):
+    def setUp(self):
+        self.client = Client()
+        cache.clear()
+
+    def sync_paris(self, temperature):
+        save_weather_bulk([
+            ({"city_name": "Paris", "latitude": 48.8566, "longitude": 2.3522},
+             {"current_weather": {"temperature": temperature, "windspeed": 5.0}}),
+        ])
+
+    def test_every_sync_appends_an_observation(self):
+        self.sync_paris(3.0)
+        self.sync_paris(5.0)
+
+        self.assertEqual(Weather.objects.count(), 1)
+        self.assertEqual(
+            list(Observation.objects.order_by("id").values_list("temperature", flat=True)),
+            [3.0, 5.0],
+        )
+
+    def test_history_endpoint_downsamples(self):
+        self.sync_paris(3.0)
+        self.sync_paris(5.0)
+        weather = Weather.objects.get(city_name="Paris")
+
+        resp = self.client.get(f"/api/weather/{weather.id}/history/?bucket=day")
+        self.assertEqual(resp.status_code, 200)
+        results = resp.json()["results"]
+        self.assertEqual(len(results), 1)
+        self.assertEqual(results[0]["count"], 2)
+        self.assertEqual(results[0]["temperature_min"], 3.0)
+        self.assertEqual(results[0]["temperature_max"], 5.0)
+        self.assertEqual(results[0]["temperature_avg"], 4.0)
+
+        resp = self.client.get(f"/api/weather/{weather.id}/history/?bucket=raw")
+        self.assertEqual([r["temperature"] for r in resp.json()["results"]], [3.0, 5.0])
+
+    def test_history_endpoint_validates_params(self):
+        weather = Weather.objects.create(city_name="Paris", latitude=0.0, longitude=0.0)
+        url = f"/api/weather/{weather.id}/history/"
+        self.assertEqual(self.client.get(url + "?bucket=minute").status_code, 400)
+        self.assertEqual(self.client.get(url + "?start=yesterday").status_code, 400)
+        self.assertEqual(
+            self.client.get(url + "?start=2026-01-02T00:00:00Z&end=2026-01-01T00:00:00Z").status_code,
+            400,
+        )
+        self.assertEqual(self.client.get("/api/weather/999999/history/").status_code, 404)
+
+    def test_partition_maintenance(self):
+        # a row that arrived before its partition existed sits in the default partition
+        Observation.objects.create(
+            city_name="Paris",
+            synced_at=datetime(2026, 1, 10, 12, tzinfo=dt_timezone.utc),
+        )
+
+        created = ensure_observation_partitions(1, today=date(2026, 1, 10))
+        self.assertEqual(created, ["weather_observation_p20260110", "weather_observation_p20260111"])
+        self.assertEqual(ensure_observation_partitions(1, today=date(2026, 1, 10)), [])
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT count(*) FROM weather_observation_p20260110")
+            self.assertEqual(cursor.fetchone()[0], 1)
+
+        dropped = drop_expired_observation_partitions(30, today=date(2026, 2, 10))
+        self.assertEqual(dropped, ["weather_observation_p20260110"])
+        self.assertEqual(Observation.objects.count(), 0)
+
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class WeatherNearestTests(TestCase):
+    def setUp(self):
+        self.client = Client()
+        cache.clear()
+        for name, lat, lon in [
+            ("Paris", 48.8566, 2.3522),
+            ("London", 51.5074, -0.1278),
+            ("New York", 40.7128, -74.0060),
+            ("Tokyo", 35.6762, 139.6503),
+            ("Fiji West", -17.0, 179.95),
+            ("Fiji East", -17.0, -179.95),
+        ]:
+            Weather.objects.create(city_name=name, latitude=lat, longitude=lon)
+
+    def test_grid_cell_is_set_on_save(self):
+        paris = Weather.objects.get(city_name="Paris")
+        self.assertEqual(paris.grid_cell, grid_cell(48.8566, 2.3522))
+
+        paris.latitude, paris.longitude = 40.4168, -3.7038
+        paris.save(update_fields=["latitude", "longitude"])
+        paris.refresh_from_db()
+        self.assertEqual(paris.grid_cell, grid_cell(40.4168, -3.7038))
+
+    def test_nearest_k(self):
+        resp = self.client.get("/api/weather/nearest/?lat=49.0&lon=2.0&k=2")
+        self.assertEqual(resp.status_code, 200)
+        results = resp.json()["results"]
+        self.assertEqual([r["city_name"] for r in results], ["Paris", "London"])
+        self.assertLess(results[0]["distance_km"], results[1]["distance_km"])
+
+    def test_nearest_within_radius(self):
+        resp = self.client.get("/api/weather/nearest/?lat=49.0&lon=2.0&radius_km=400&k=100")
+        self.assertEqual([r["city_name"] for r in resp.json()["results"]], ["Paris", "London"])
+
+        resp = self.client.get("/api/weather/nearest/?lat=0.0&lon=0.0&radius_km=100")
+        self.assertEqual(resp.json()["results"], [])
+
+    def test_nearest_across_antimeridian(self):
+        resp = self.client.get("/api/weather/nearest/?lat=-17.0&lon=179.99&radius_km=50")
+        self.assertEqual(
+            sorted(r["city_name"] for r in resp.json()["results"]),
+            ["Fiji East", "Fiji West"],
+        )
+
+    def test_nearest_validation(self):
+        self.assertEqual(self.client.get("/api/weather/nearest/?lat=1").status_code, 400)
+        self.assertEqual(self.client.get("/api/weather/nearest/?lat=x&lon=1").status_code, 400)
+        self.assertEqual(self.client.get("/api/weather/nearest/?lat=91&lon=1").status_code, 400)
+        self.assertEqual(self.client.get("/api/weather/nearest/?lat=1&lon=1&k=0").status_code, 400)
+        for radius in ("nan", "inf", "-inf"):
+            resp = self.client.get("/api/weather/nearest/?lat=0&lon=0&radius_km=%s" % radius)
+            self.assertEqual(resp.status_code, 400, radius)
+
+    def test_huge_radius_stops_widening_at_the_whole_earth(self):
+        with patch("weather.services.weather_within", return_value=[]) as mock_within:
+            resp = self.client.get("/api/weather/nearest/?lat=0&lon=0&k=100&radius_km=1e300")
+        self.assertEqual(resp.json()["results"], [])
+        # 50, 200, 800, 3200, 12800 km, then half the Earth's circumference
+        self.assertEqual(mock_within.call_count, 6)
+
+
+@override_settings(CACHES=LOCMEM_CACHES, WEATHER_RATE_LIMIT_ENABLED=False)
+class MetricsTests(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def sample(self, name, labels):
+        return REGISTRY.get_sample_value(name, labels) or 0
+
+    def test_views_record_latency_and_queries(self):
+        labels = {"view": "weather_list", "method": "GET", "status": "200"}
+        before = self.sample("weather_view_seconds_count", labels)
+
+        self.client.get("/api/weather/")
+
+        self.assertEqual(self.sample("weather_view_seconds_count", labels), before + 1)
+        resp = self.client.get("/metrics/")
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn(b'weather_view_queries_count{view="weather_list"}', resp.content)
+
+    @patch("weather.services.get_http_session")
+    def test_sync_single_city_records_stages(self, mock_session):
+        mock_response = mock_session.return_value.get.return_value
+        mock_response.status_code = 200
+        mock_response.json.return_value = {"current_weather": {"temperature": 1.0}}
+        before = {
+            "fetch": self.sample("weather_upstream_request_seconds_count", {"outcome": "ok"}),
+            "parse": self.sample("weather_parse_seconds_count", {"mode": "single"}),
+            "write": self.sample("weather_db_write_seconds_count", {"mode": "single"}),
+            "success": self.sample("weather_city_sync_total", {"outcome": "success"}),
+        }
+
+        sync_single_city({"city_name": "Paris", "latitude": 48.8566, "longitude": 2.3522})
+
+        self.assertEqual(self.sample("weather_upstream_request_seconds_count", {"outcome": "ok"}), before["fetch"] + 1)
+        self.assertEqual(self.sample("weather_parse_seconds_count", {"mode": "single"}), before["parse"] + 1)
+        self.assertEqual(self.sample("weather_db_write_seconds_count", {"mode": "single"}), before["write"] + 1)
+        self.assertEqual(self.sample("weather_city_sync_total", {"outcome": "success"}), before["success"] + 1)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class AsyncViewTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        now = timezone.now()
+        self.rows = [
+            Weather.objects.create(city_name=name, latitude=i, longitude=i, temperature=i, synced_at=now)
+            for i, name in enumerate(["Paris", "London", "Tokyo"])
+        ]
+
+    async def test_async_views_match_sync_views(self):
+        first = self.rows[0].id
+        for path, view, kwargs in [
+            ("/api/weather/?limit=2", "weather_list", {}),
+            ("/api/weather/?cursor=&limit=2&count=exact", "weather_list", {}),
+            ("/api/weather/?offset=5&cursor=", "weather_list", {}),
+            (f"/api/weather/{first}/", "weather_detail", {"id": first}),
+            ("/api/weather/999999/", "weather_detail", {"id": 999999}),
+        ]:
+            with self.subTest(path=path):
+                await sync_to_async(cache.clear)()
+                expected = await sync_to_async(getattr(views, view))(RequestFactory().get(path), **kwargs)
+                await sync_to_async(cache.clear)()
+                resp = await getattr(async_views, view)(AsyncRequestFactory().get(path), **kwargs)
+                self.assertEqual(resp.status_code, expected.status_code)
+                self.assertEqual(resp.content, expected.content)
+                self.assertEqual(resp.get("Last-Modified"), expected.get("Last-Modified"))
+
+    async def test_async_list_answers_304(self):
+        resp = await async_views.weather_list(AsyncRequestFactory().get("/api/weather/"))
+        self.assertEqual(resp.status_code, 200)
+        resp = await async_views.weather_list(
+            AsyncRequestFactory().get("/api/weather/", headers={"If-None-Match": resp["ETag"]}),
+        )
+        self.assertEqual(resp.status_code, 304)
+
+    @patch("weather.async_views.start_sync_all_cities", return_value=("abc", True))
+    async def test_async_sync_weather_enqueues(self, mock_start):
+        request = AsyncRequestFactory().post("/api/sync/?force=1")
+        request._dont_enforce_csrf_checks = True
+        resp = await async_views.sync_weather(request)
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.content, b'{"task_id": "abc", "status": "started"}')
+        mock_start.assert_called_once_with(force=True)
+
+
+@override_settings(CACHES=LOCMEM_CACHES, WEATHER_SCHEDULER_BUDGET=2, WEATHER_SCHEDULER_LEASE=600)
+class RefreshSchedulerTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        City.objects.all().delete()
+        now = timezone.now()
+        self.now = now
+        City.objects.create(name="Later", latitude=1, longitude=1, next_sync_at=now + timedelta(minutes=5))
+        City.objects.create(name="Overdue", latitude=2, longitude=2, next_sync_at=now - timedelta(hours=2))
+        City.objects.create(name="Due", latitude=3, longitude=3, next_sync_at=now - timedelta(minutes=1))
+        City.objects.create(name="Oldest", latitude=4, longitude=4, next_sync_at=now - timedelta(hours=3), enabled=False)
+        City.objects.create(name="Overdue too", latitude=5, longitude=5, next_sync_at=now - timedelta(hours=1))
+
+    @patch("weather.tasks.dispatch_city_syncs")
+    def test_tick_claims_most_overdue_cities_within_budget(self, mock_dispatch):
+        schedule_due_cities_task()
+
+        cities, label = mock_dispatch.call_args[0]
+        self.assertEqual([c["city_name"] for c in cities], ["Overdue", "Overdue too"])
+        self.assertEqual(set(cities[0]), {"city_name", "latitude", "longitude"})
+        leased = City.objects.get(name="Overdue").next_sync_at
+        self.assertGreater(leased, self.now + timedelta(seconds=590))
+
+        # the leased cities are not claimed again by the next tick
+        schedule_due_cities_task()
+        cities, _ = mock_dispatch.call_args[0]
+        self.assertEqual([c["city_name"] for c in cities], ["Due"])
+
+    def test_successful_save_schedules_next_refresh(self):
+        city = City.objects.get(name="Overdue")
+        city.refresh_interval = timedelta(minutes=30)
+        city.save()
+
+        save_weather_bulk([
+            ({"city_name": "Overdue", "latitude": 2, "longitude": 2}, {"current_weather": {"temperature": 1.0}}),
+        ])
+
+        synced_at = Weather.objects.get(city_name="Overdue").synced_at
+        self.assertEqual(City.objects.get(name="Overdue").next_sync_at, synced_at + timedelta(minutes=30))
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class SyncRunTests(RedisTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        City.objects.all().delete()
+        self.run_id = self.redis_name("run")
+
+    @patch("weather.tasks.group")
+    def test_run_is_written_once_every_city_reported(self, mock_group):
+        paris = City.objects.create(name="Paris", latitude=48.8566, longitude=2.3522)
+        london = City.objects.create(name="London", latitude=51.5074, longitude=-0.1278)
+        cache.set(SYNC_LOCK_KEY, self.run_id)
+        runs.start_run(self.run_id)
+
+        sync_city_shard_task(paris.pk, london.pk, run_id=self.run_id)
+        self.assertEqual(
+            [sig.kwargs for sig in mock_group.call_args.args[0]],
+            [{"run_id": self.run_id}, {"run_id": self.run_id}],
+        )
+        track_run(self.run_id, shards=1)
+
+        body = self.client.get("/api/sync/%s/" % self.run_id).json()
+        self.assertEqual(
+            (body["status"], body["cities"], body["pending"], body["shards_done"]),
+            ("running", 2, 2, 1),
+        )
+
+        with patch("weather.tasks.sync_single_city", return_value=True):
+            sync_city_task({"city_name": "Paris", "latitude": 48.8566, "longitude": 2.3522}, run_id=self.run_id)
+        self.assertEqual(self.client.get("/api/sync/%s/" % self.run_id).json()["pending"], 1)
+        with patch("weather.tasks.sync_single_city", return_value=False):
+            sync_city_task({"city_name": "London", "latitude": 51.5074, "longitude": -0.1278}, run_id=self.run_id)
+
+        run = SyncRun.objects.get(id=self.run_id)
+        self.assertEqual(run.status, "finished")
+        self.assertEqual((run.cities, run.succeeded, run.client_error, run.failed), (2, 1, 1, 0))
+        self.assertEqual(
+            sorted(run.outcomes.values_list("city_name", "outcome")),
+            [("London", "client_error"), ("Paris", "success")],
+        )
+        self.assertEqual(get_redis().exists("weather:run:%s" % self.run_id), 0)
+        # the single-flight lock is released, so the next trigger starts a new run
+        self.assertIsNone(cache.get(SYNC_LOCK_KEY))
+
+        body = self.client.get("/api/sync/%s/" % self.run_id).json()
+        self.assertEqual((body["status"], body["succeeded"], body["pending"]), ("finished", 1, 0))
+
+    @override_settings(WEATHER_SYNC_MAX_DEFERRALS=1)
+    def test_unexpected_errors_and_exhausted_deferrals_complete_the_run(self):
+        cache.set(SYNC_LOCK_KEY, self.run_id)
+        runs.start_run(self.run_id)
+        track_run(self.run_id, shards=1, shards_done=1, cities=2)
+
+        with patch("weather.tasks.sync_single_city", side_effect=TypeError("bad payload")):
+            result = sync_city_task.apply(args=[{"city_name": "Paris"}], kwargs={"run_id": self.run_id})
+        self.assertEqual(result.state, "FAILURE")
+        with patch("weather.tasks.sync_single_city", side_effect=RateLimitExceeded(0)):
+            sync_city_task.apply(args=[{"city_name": "London"}], kwargs={"run_id": self.run_id})
+
+        run = SyncRun.objects.get(id=self.run_id)
+        self.assertEqual((run.status, run.failed), ("finished", 2))
+        self.assertIsNone(cache.get(SYNC_LOCK_KEY))
+
+    def test_empty_run_finishes_at_once(self):
+        sync_all_cities_task.apply(task_id=self.run_id)
+
+        run = SyncRun.objects.get(id=self.run_id)
+        self.assertEqual((run.status, run.cities), ("finished", 0))
+
+    def test_status_of_unknown_and_pending_runs(self):
+        self.assertEqual(self.client.get("/api/sync/%s/" % self.run_id).status_code, 404)
+        cache.set(SYNC_LOCK_KEY, self.run_id)
+        self.assertEqual(
+            self.client.get("/api/sync/%s/" % self.run_id).json(),
+            {"id": self.run_id, "status": "pending"},
+        )
+
+
+@override_settings(CACHES=LOCMEM_CACHES, WEATHER_FEED_ENABLED=True, WEATHER_FEED_KEEPALIVE=0.1)
+class ChangeFeedTests(RedisTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.stream = self.redis_name("feed", "weather.feed.FEED_STREAM", "weather.feed.FEED_CHANNEL")
+
+    def test_changed_snapshots_are_published_after_commit(self):
+        city = {"city_name": "Paris", "latitude": 48.8566, "longitude": 2.3522}
+        with self.captureOnCommitCallbacks(execute=True):
+            save_weather_bulk([(city, {"current_weather": {"temperature": 1.0}})])
+        with self.captureOnCommitCallbacks(execute=True):
+            save_weather_bulk([(city, {"current_weather": {"temperature": 1.0}})])
+
+        entries = get_redis().xrange(self.stream)
+        self.assertEqual(len(entries), 1)
+        snapshot = json.loads(entries[0][1][b"data"])
+        self.assertEqual((snapshot["city_name"], snapshot["temperature"]), ("Paris", 1.0))
+
+    async def test_feed_replays_after_last_event_id_then_streams_live(self):
+        cities = [Weather(id=i, city_name="City %d" % i, latitude=0.0, longitude=0.0) for i in range(3)]
+        publish_changes(cities[:2])
+        first_id = get_redis().xrange(self.stream)[0][0].decode()
+
+        events = feed_events(first_id)
+        try:
+            self.assertEqual(await anext(events), "retry: 5000\n\n")
+            replayed = await anext(events)
+            self.assertIn('"city_name": "City 1"', replayed)
+            self.assertNotIn("City 0", replayed)
+
+            # nothing new yet: a keepalive comment, then the live event
+            self.assertEqual(await anext(events), ": keepalive\n\n")
+            publish_changes(cities[2:])
+            live = await anext(events)
+            while live == ": keepalive\n\n":
+                live = await anext(events)
+            self.assertTrue(live.startswith("id: "))
+            self.assertIn('"city_name": "City 2"', live)
+        finally:
+            await events.aclose()
+
+    async def test_streams_share_one_subscription(self):
+        streams = [feed_events(), feed_events()]
+        try:
+            for events in streams:
+                self.assertEqual(await anext(events), "retry: 5000\n\n")
+            self.assertEqual(get_redis().pubsub_numsub(self.stream), [(self.stream.encode(), 1)])
+
+            publish_changes([Weather(id=1, city_name="Paris", latitude=0.0, longitude=0.0)])
+            for events in streams:
+                live = await anext(events)
+                while live == ": keepalive\n\n":
+                    live = await anext(events)
+                self.assertIn('"city_name": "Paris"', live)
+        finally:
+            for events in streams:
+                await events.aclose()
+
+    @override_settings(WEATHER_FEED_CLIENT_BUFFER=1)
+    async def test_slow_client_is_disconnected(self):
+        events = feed_events()
+        try:
+            await anext(events)
+            publish_changes([Weather(id=i, city_name="City %d" % i, latitude=0.0, longitude=0.0) for i in range(3)])
+            # wait for the reader to fan the events out
+            await asyncio.sleep(0.2)
+            with self.assertRaises(StopAsyncIteration):
+                while True:
+                    self.assertEqual(await anext(events), ": keepalive\n\n")
+        finally:
+            await events.aclose()
+
+    async def test_feed_view_streams_event_stream(self):
+        resp = await async_views.weather_feed(AsyncRequestFactory().get("/api/weather/feed/"))
+        self.assertEqual(resp["Content-Type"], "text/event-stream")
+        self.assertEqual(resp["Cache-Control"], "no-cache")
+
+    def test_feed_needs_asgi(self):
+        self.assertEqual(self.client.get("/api/weather/feed/").status_code, 501)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class WeatherAggregatesTests(RedisTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.redis_name("agg", "weather.aggregates.PREFIX")
+        self.client = Client()
+        for name, code, temperature, windspeed in [
+            ("Paris", 3, 4.0, 10.0),
+            ("London", 3, 6.0, 20.0),
+            ("Cairo", 0, 30.0, None),
+        ]:
+            Weather.objects.create(
+                city_name=name, latitude=0.0, longitude=0.0,
+                weathercode=code, temperature=temperature, windspeed=windspeed,
+            )
+
+    @patch("weather.tasks.recompute_weather_aggregates_task.delay")
+    def test_first_read_queues_one_rebuild(self, mock_delay):
+        for _ in range(2):
+            resp = self.client.get("/api/weather/aggregates/")
+            self.assertEqual(resp.status_code, 503)
+            self.assertEqual(resp["Retry-After"], "10")
+        mock_delay.assert_called_once_with()
+
+        recompute_weather_aggregates_task()
+        body = self.client.get("/api/weather/aggregates/").json()
+
+        self.assertEqual(body["cities"], 3)
+        self.assertEqual(
+            body["temperature"],
+            {"count": 3, "min": 4.0, "min_city": "Paris", "max": 30.0, "max_city": "Cairo", "mean": 13.333},
+        )
+        self.assertEqual(body["windspeed"]["count"], 2)
+        self.assertEqual(list(body["by_weathercode"]), ["0", "3"])
+        self.assertEqual(body["by_weathercode"]["3"]["temperature"]["mean"], 5.0)
+        self.assertIsNone(body["by_weathercode"]["0"]["windspeed"]["mean"])
+
+    def test_redis_errors_answer_503(self):
+        with patch("weather.views.read_aggregates", side_effect=RedisError):
+            self.assertEqual(self.client.get("/api/weather/aggregates/").status_code, 503)
+
+    def test_rebuild_replaces_the_live_keys(self):
+        rebuild_aggregates()
+        Weather.objects.filter(city_name="Cairo").delete()
+        rebuild_aggregates()
+
+        self.assertEqual(list(read_aggregates()["by_weathercode"]), ["3"])
+        prefix = aggregates.PREFIX
+        self.assertEqual(get_redis().exists("%s:code:0" % prefix, "%s:code:0:temperature" % prefix), 0)
+        self.assertEqual(list(get_redis().scan_iter("%s:build:*" % prefix)), [])
+
+    def test_sync_updates_aggregates_incrementally(self):
+        rebuild_aggregates()
+        with self.captureOnCommitCallbacks(execute=True):
+            save_weather_bulk([
+                ({"city_name": "London", "latitude": 0.0, "longitude": 0.0},
+                 {"current_weather": {"temperature": -2.0, "windspeed": 5.0, "weathercode": 61}}),
+            ])
+
+        body = read_aggregates()
+        self.assertEqual(body["cities"], 3)
+        self.assertEqual((body["temperature"]["min"], body["temperature"]["min_city"]), (-2.0, "London"))
+        self.assertEqual(body["windspeed"]["mean"], 7.5)
+        self.assertEqual(body["by_weathercode"]["3"]["cities"], 1)
+        self.assertEqual(body["by_weathercode"]["61"]["temperature"]["max"], -2.0)
+
+        # a rebuild from the database agrees with the incremental state
+        rebuild_aggregates()
+        self.assertEqual(read_aggregates(), body)
+
+
+@override_settings(CACHES=LOCMEM_CACHES, WEATHER_HOURLY_VARIABLES=["temperature_2m", "windspeed_10m"])
+class HourlyForecastTests(TestCase):
+    def setUp(self):
+        self.client = Client()
+
+    def payload(self, temperature, start="2026-01-20T00:00", hours=6):
+        first = datetime.fromisoformat(start)
+        return {
+            "current_weather": {"temperature": temperature, "time": "2026-01-20T00:00"},
+            "hourly_units": {"temperature_2m": "°C"},
+            "hourly": {
+                "time": [(first + timedelta(hours=h)).isoformat(timespec="minutes") for h in range(hours)],
+                "temperature_2m": [temperature + h for h in range(hours)],
+                "windspeed_10m": [10.0] * (hours - 1) + [None],
+            },
+        }
+
+    def save(self, *cities):
+        return save_weather_bulk(
+            ({"city_name": name, "latitude": 0.0, "longitude": 0.0}, payload) for name, payload in cities
+        )
+
+    def test_sync_stores_packed_forecast(self):
+        self.save(("Paris", self.payload(1.0)))
+        forecast = HourlyForecast.objects.get(weather__city_name="Paris")
+        self.assertEqual(forecast.start.isoformat(), "2026-01-20T00:00:00+00:00")
+        self.assertEqual((forecast.hours, forecast.variables), (6, "temperature_2m,windspeed_10m"))
+        # two float32 arrays of six hours
+        self.assertEqual(len(forecast.data), 2 * 6 * 4)
+        matrix = unpack(forecast)
+        self.assertEqual(matrix[0].tolist(), [1.0, 2.0, 3.0, 4.0, 5.0, 6.0])
+        self.assertTrue(matrix[1, -1] != matrix[1, -1])
+
+        # the forecast is not kept twice in the raw payload
+        w = Weather.objects.get(city_name="Paris")
+        self.assertEqual(w.payload.raw_payload, {"current_weather": {"temperature": 1.0, "time": "2026-01-20T00:00"}})
+
+        # a new forecast is saved without rewriting the unchanged snapshot
+        with patch("weather.services.record_observations") as mock_observations:
+            with self.captureOnCommitCallbacks() as callbacks:
+                self.save(("Paris", self.payload(1.0, start="2026-01-20T01:00")))
+        mock_observations.assert_not_called()
+        self.assertEqual(callbacks, [])
+        forecast.refresh_from_db()
+        self.assertEqual(forecast.start.isoformat(), "2026-01-20T01:00:00+00:00")
+
+        # and an identical one is not rewritten
+        with patch("weather.forecast.HourlyForecast.objects.bulk_create") as mock_create:
+            self.save(("Paris", self.payload(1.0, start="2026-01-20T01:00")))
+        self.assertEqual(mock_create.call_args.args[0], [])
+
+    def test_invalid_forecast_keeps_current_weather(self):
+        payload = self.payload(1.0)
+        payload["hourly"]["temperature_2m"].pop()
+        self.assertEqual(self.save(("Paris", payload)), {"Paris": True})
+        self.assertEqual(Weather.objects.get(city_name="Paris").temperature, 1.0)
+        self.assertFalse(HourlyForecast.objects.exists())
+
+    def test_endpoint_slices_and_downsamples_window(self):
+        self.save(("Paris", self.payload(0.0)), ("London", self.payload(10.0, start="2026-01-20T02:00")))
+        paris, london = Weather.objects.get(city_name="Paris"), Weather.objects.get(city_name="London")
+
+        resp = self.client.get(
+            "/api/weather/forecast/?ids=%d,%d&start=2026-01-20T01:30:00Z&hours=6&step=2" % (paris.id, london.id)
+        )
+        self.assertEqual(resp.status_code, 200)
+        body = resp.json()
+        self.assertEqual(body["start"], "2026-01-20T01:00:00+00:00")
+        self.assertEqual(
+            body["times"],
+            ["2026-01-20T01:00:00+00:00", "2026-01-20T03:00:00+00:00", "2026-01-20T05:00:00+00:00"],
+        )
+        self.assertEqual(body["results"][0]["city_name"], "Paris")
+        # hours 1-2, 3-4, then 5 alone (the forecast ends at hour 5)
+        self.assertEqual(body["results"][0]["temperature_2m"], [1.5, 3.5, 5.0])
+        # hour 5 has no windspeed and hour 6 no forecast: an empty bucket
+        self.assertEqual(body["results"][0]["windspeed_10m"], [10.0, 10.0, None])
+        # London's forecast starts at hour 2
+        self.assertEqual(body["results"][1]["temperature_2m"], [10.0, 11.5, 13.5])
+
+        body = self.client.get(
+            "/api/weather/forecast/?start=2026-01-20T00:00:00Z&hours=4&step=4&agg=max&variables=temperature_2m"
+        ).json()
+        self.assertEqual(body["variables"], ["temperature_2m"])
+        self.assertEqual([r["temperature_2m"] for r in body["results"]], [[3.0], [11.0]])
+        self.assertNotIn("windspeed_10m", body["results"][0])
+
+        # before every forecast
+        body = self.client.get("/api/weather/forecast/?start=2025-01-01T00:00:00Z&hours=2").json()
+        self.assertEqual(body["results"][0]["temperature_2m"], [None, None])
+
+    def test_window_keeps_rows_in_order_across_groups(self):
+        def forecast(temperature, start="2026-01-20T00:00", variables=("temperature_2m", "windspeed_10m")):
+            with override_settings(WEATHER_HOURLY_VARIABLES=list(variables)):
+                start, hours, names, data = pack_hourly(self.payload(temperature, start))
+            return HourlyForecast(start=start, hours=hours, variables=",".join(names), data=data)
+
+        # two cities of one sync, interleaved with stragglers
+        forecasts = [
+            forecast(0.0),
+            forecast(100.0, start="2026-01-20T02:00"),
+            forecast(10.0),
+            forecast(50.0, variables=("windspeed_10m", "temperature_2m")),
+        ]
+        start = forecasts[0].start + HOUR
+        window = forecast_window(forecasts, ["temperature_2m"], start, 4)
+        np.testing.assert_array_equal(
+            window["temperature_2m"],
+            [[1.0, 2.0, 3.0, 4.0], [np.nan, 100.0, 101.0, 102.0], [11.0, 12.0, 13.0, 14.0], [51.0, 52.0, 53.0, 54.0]],
+        )
+
+    def test_endpoint_validates_params(self):
+        for query in ("hours=5&step=2", "agg=median", "variables=pressure", "step=0", "start=soon", "ids=a"):
+            self.assertEqual(self.client.get("/api/weather/forecast/?" + query).status_code, 400, query)
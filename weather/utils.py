@@ -0,0 +1,39 @@
+import hashlib
+import json
+import zlib
+from datetime import datetime, timezone as dt_timezone
+from itertools import islice
+
+
+def chunked(iterable, size):
+    """Yield lists of at most `size` items from any iterable."""
+    it = iter(iterable)
+    while True:
+        chunk = list(islice(it, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def compress_payload(data):
+    """Compact JSON of `data`, zlib-compressed."""
+    return zlib.compress(json.dumps(data, separators=(",", ":")).encode())
+
+
+def decompress_payload(blob):
+    """Inverse of compress_payload."""
+    return json.loads(zlib.decompress(blob))
+
+
+def parse_upstream_time(value):
+    """Timezone-aware datetime of an Open-Meteo time string (naive ones are UTC)."""
+    dt = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=dt_timezone.utc)
+    return dt
+
+
+def content_hash(values):
+    """128-bit hex digest of a dict of field values, stable across processes."""
+    blob = json.dumps(values, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.blake2b(blob.encode(), digest_size=16).hexdigest()
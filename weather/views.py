@@ -1,70 +1,534 @@
-from django.http import JsonResponse
+import base64
+import binascii
+import csv
+import json
+import math
+from datetime import timedelta, timezone as dt_timezone
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.handlers.asgi import ASGIRequest
+from django.db import connection
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
 from django.views.decorators.http import require_http_methods
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from django.utils.http import http_date
 from django.views.decorators.csrf import ensure_csrf_cookie, csrf_protect
 
-from .models import Weather
-from .tasks import sync_all_cities_task
+from redis.exceptions import RedisError
+
+from .aggregates import read_aggregates
+from .cache import cached_weather_response
+from .forecast import AGGREGATES, HOUR, forecast_window
+from .history import BUCKETS, observation_series
+from .metrics import render_metrics
+from .models import HourlyForecast, SyncRun, Weather, WeatherPayload
+from .runs import summary as sync_run_summary
+from .serializers import WEATHER_FIELDS, serialize_weather, serialize_weather_rows
+from .geo import MAX_DISTANCE_KM
+from .services import nearest_weather
+from .tasks import in_flight_sync_run, request_aggregates_rebuild, start_sync_all_cities
+from .utils import chunked
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 # Create your views here.
 
-def serialize_weather(w):
-    return {
-        "id": w.id,
-        "city_name": w.city_name,
-        "latitude": w.latitude,
-        "longitude": w.longitude,
-        "temperature": w.temperature,
-        "windspeed": w.windspeed,
-        "winddirection": w.winddirection,
-        "weathercode": w.weathercode,
-        "time": w.time.isoformat() if w.time else None,
-        "synced_at": w.synced_at.isoformat() if w.synced_at else None,
-    }
+def fast_json_response(body):
+    """
+    JSON response for bodies of plain types (str, int, float, bool, None,
+    list, dict). With the default WEATHER_JSON_BACKEND="json" the bytes are
+    identical to JsonResponse's; "orjson" is faster but writes compact JSON
+    (no spaces after separators), so it is opt-in.
+    """
+    if settings.WEATHER_JSON_BACKEND == "orjson" and orjson is not None:
+        content = orjson.dumps(body)
+    else:
+        content = json.dumps(body)
+    return HttpResponse(content, content_type="application/json")
 
-@require_http_methods(["GET"])
-def weather_list(request):
+def set_last_modified(response, synced_at):
+    """Set Last-Modified of a single-row response from its synced_at."""
+    if synced_at:
+        response["Last-Modified"] = http_date(synced_at.timestamp())
+    return response
+
+def encode_cursor(last_id):
+    """Opaque keyset cursor pointing just after the row with id `last_id`."""
+    raw = json.dumps({"id": last_id}).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+def decode_cursor(token):
+    """Return the last seen id from a cursor token; raises ValueError if malformed."""
+    try:
+        raw = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4))
+        last_id = json.loads(raw)["id"]
+    except (binascii.Error, UnicodeDecodeError, ValueError, TypeError, KeyError):
+        raise ValueError("invalid cursor")
+    if not isinstance(last_id, int) or isinstance(last_id, bool):
+        raise ValueError("invalid cursor")
+    return last_id
+
+# below this many estimated rows an exact COUNT(*) is cheap enough
+EXACT_COUNT_THRESHOLD = 10000
+
+def approximate_count(model):
+    """
+    Row count estimate from Postgres planner statistics (pg_class.reltuples),
+    falling back to an exact count for small or never-analyzed tables.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT reltuples::bigint FROM pg_class WHERE oid = %s::regclass",
+            [model._meta.db_table],
+        )
+        row = cursor.fetchone()
+    if row is None or row[0] < EXACT_COUNT_THRESHOLD:
+        return model.objects.count()
+    return row[0]
+
+def parse_keyset_params(request):
+    """
+    Validate the cursor and count parameters of a keyset list request.
+    Returns (last seen id or None, count mode, error response or None).
+    """
+    cursor = request.GET.get("cursor", "")
+    count_mode = request.GET.get("count", "none")
+    if count_mode not in ("none", "exact", "approx"):
+        return None, None, JsonResponse({"error": "count must be one of none, exact, approx"}, status=400)
+    if not cursor:
+        return None, count_mode, None
+    try:
+        return decode_cursor(cursor), count_mode, None
+    except ValueError:
+        return None, None, JsonResponse({"error": "invalid cursor"}, status=400)
+
+def keyset_page(request, rows, limit):
+    """
+    Body of a keyset page from up to limit + 1 WEATHER_FIELDS tuples (the
+    extra row only tells whether there is a next page).
+    """
+    has_next = len(rows) > limit
+    results, _ = serialize_weather_rows(rows[:limit])
+
+    next_url = None
+    if has_next:
+        params = request.GET.copy()
+        params["cursor"] = encode_cursor(results[-1]["id"])
+        next_url = request.build_absolute_uri("?" + params.urlencode())
+    return {"next": next_url, "results": results}
+
+def weather_list_keyset(request, limit):
+    """
+    Cursor-paginated list: WHERE id > last_id ORDER BY id LIMIT n, so every page
+    costs the same regardless of depth. The count is only computed on request
+    (count=exact or count=approx).
+    """
+    after_id, count_mode, error = parse_keyset_params(request)
+    if error:
+        return error
+
+    qs = Weather.objects.order_by("id")
+    if after_id is not None:
+        qs = qs.filter(id__gt=after_id)
+    body = keyset_page(request, list(qs.values_list(*WEATHER_FIELDS)[: limit + 1]), limit)
+
+    if count_mode == "exact":
+        body["count"] = Weather.objects.count()
+    elif count_mode == "approx":
+        body["count"] = approximate_count(Weather)
+    return fast_json_response(body)
+
+def parse_list_params(request):
+    """
+    Validate limit and offset of a list request; limit is capped at 1000.
+    Returns (limit, offset, error response or None).
+    """
     # get and validate pagination parameters
     try:
         limit = int(request.GET.get("limit", 10))
         offset = int(request.GET.get("offset", 0))
     except ValueError:
-        return JsonResponse({"error": "limit and offset must be integers"}, status=400)
+        return None, None, JsonResponse({"error": "limit and offset must be integers"}, status=400)
     
     # validate non-negative values
     if limit < 0 or offset < 0:
-        return JsonResponse({"error": "limit and offset must be non-negative"}, status=400)
+        return None, None, JsonResponse({"error": "limit and offset must be non-negative"}, status=400)
     
     # apply limits to prevent abuse
     if limit == 0:
-        return JsonResponse({"error": "limit must be greater than 0"}, status=400)
+        return None, None, JsonResponse({"error": "limit must be greater than 0"}, status=400)
     if limit > 1000:
         limit = 1000
+
+    if "cursor" in request.GET and "offset" in request.GET:
+        return None, None, JsonResponse({"error": "use either cursor or offset, not both"}, status=400)
+    return limit, offset, None
+
+@require_http_methods(["GET"])
+@cached_weather_response
+def weather_list(request):
+    limit, offset, error = parse_list_params(request)
+    if error:
+        return error
+
+    # keyset pagination when a cursor is given (an empty cursor is the first page)
+    if "cursor" in request.GET:
+        return weather_list_keyset(request, limit)
     
-    qs = Weather.objects.all().order_by("id")
+    qs = Weather.objects.order_by("id")
     total_count = qs.count()
     
     # apply pagination
-    paginated_qs = qs[offset : offset + limit]
+    results, _ = serialize_weather_rows(qs.values_list(*WEATHER_FIELDS)[offset : offset + limit])
     
-    return JsonResponse({
+    # no Last-Modified: a page changes when rows outside it are added or
+    # removed, so lists are only validated by their ETag
+    return fast_json_response({
         "count": total_count,
-        "results": [serialize_weather(w) for w in paginated_qs]
+        "results": results
     })
 
+def parse_include(request):
+    """
+    The opt-in extras of a detail request (?include=raw_payload).
+    Returns (set of names, error response or None).
+    """
+    include = set(filter(None, request.GET.get("include", "").split(",")))
+    if include - {"raw_payload"}:
+        return None, JsonResponse({"error": "include must be raw_payload"}, status=400)
+    return include, None
+
 @require_http_methods(["GET"])
+@cached_weather_response
 def weather_detail(request, id):
+    include, error = parse_include(request)
+    if error:
+        return error
+
+    rows, synced_at = serialize_weather_rows(Weather.objects.filter(id=id).values_list(*WEATHER_FIELDS))
+    if not rows:
+        return JsonResponse({"detail": "Not Found"}, status = 404)
+
+    body = rows[0]
+    if "raw_payload" in include:
+        payload = WeatherPayload.objects.filter(weather_id=id).first()
+        body["raw_payload"] = payload.raw_payload if payload else None
+    return set_last_modified(fast_json_response(body), synced_at)
+
+def parse_range_param(request, name, default):
+    """Parse an ISO datetime query parameter; raises ValueError if invalid."""
+    value = request.GET.get(name)
+    if not value:
+        return default
+    dt = parse_datetime(value)
+    if dt is None:
+        raise ValueError(name)
+    if timezone.is_naive(dt):
+        dt = timezone.make_aware(dt, timezone=dt_timezone.utc)
+    return dt
+
+@require_http_methods(["GET"])
+@cached_weather_response
+def weather_history(request, id):
     try:
-        w = Weather.objects.get(id=id)
+        w = Weather.objects.only("city_name").get(id=id)
     except Weather.DoesNotExist:
         return JsonResponse({"detail": "Not Found"}, status = 404)
-    return JsonResponse(serialize_weather(w))
+
+    now = timezone.now()
+    try:
+        end = parse_range_param(request, "end", now)
+        start = parse_range_param(request, "start", end - timedelta(days=1))
+    except ValueError as e:
+        return JsonResponse({"error": "%s must be an ISO 8601 datetime" % e}, status=400)
+    if start >= end:
+        return JsonResponse({"error": "start must be before end"}, status=400)
+
+    bucket = request.GET.get("bucket", "hour")
+    if bucket != "raw" and bucket not in BUCKETS:
+        return JsonResponse({"error": "bucket must be one of raw, %s" % ", ".join(BUCKETS)}, status=400)
+
+    return JsonResponse({
+        "city_name": w.city_name,
+        "start": start.isoformat(),
+        "end": end.isoformat(),
+        "bucket": bucket,
+        "results": observation_series(w.city_name, start, end, bucket),
+    })
+
+NEAREST_DEFAULT_K = 10
+NEAREST_MAX_K = 100
+
+@require_http_methods(["GET"])
+@cached_weather_response
+def weather_nearest(request):
+    try:
+        lat = float(request.GET["lat"])
+        lon = float(request.GET["lon"])
+        k = int(request.GET.get("k", NEAREST_DEFAULT_K))
+        radius_km = request.GET.get("radius_km")
+        radius_km = float(radius_km) if radius_km is not None else None
+    except KeyError:
+        return JsonResponse({"error": "lat and lon are required"}, status=400)
+    except ValueError:
+        return JsonResponse({"error": "lat, lon and radius_km must be numbers, k an integer"}, status=400)
+
+    if not (-90 <= lat <= 90 and -180 <= lon <= 180):
+        return JsonResponse({"error": "lat must be within [-90, 90] and lon within [-180, 180]"}, status=400)
+    if radius_km is not None and not math.isfinite(radius_km):
+        return JsonResponse({"error": "radius_km must be a finite number"}, status=400)
+    if k <= 0 or (radius_km is not None and radius_km <= 0):
+        return JsonResponse({"error": "k and radius_km must be greater than 0"}, status=400)
+    k = min(k, NEAREST_MAX_K)
+    if radius_km is not None:
+        # nothing on Earth is further away
+        radius_km = min(radius_km, MAX_DISTANCE_KM)
+
+    if radius_km is None:
+        matches = nearest_weather(lat, lon, k)
+    else:
+        matches = nearest_weather(lat, lon, k, max_radius_km=radius_km)
+
+    return JsonResponse({
+        "results": [
+            dict(serialize_weather(w), distance_km=round(distance, 3))
+            for distance, w in matches
+        ]
+    })
+
+# columns of serialize_weather, in the same order
+EXPORT_FIELDS = WEATHER_FIELDS
+EXPORT_CHUNK_SIZE = 2000
+
+def export_row(row):
+    """EXPORT_FIELDS tuple as a list with time and synced_at in ISO format."""
+    row = list(row)
+    row[-2] = row[-2].isoformat() if row[-2] else None
+    row[-1] = row[-1].isoformat() if row[-1] else None
+    return row
+
+def export_queryset():
+    return Weather.objects.order_by("id").values_list(*EXPORT_FIELDS)
+
+def export_rows():
+    """
+    Stream every Weather row as a list of EXPORT_FIELDS, reading through a
+    server-side cursor so memory stays flat regardless of table size.
+    """
+    for row in export_queryset().iterator(chunk_size=EXPORT_CHUNK_SIZE):
+        yield export_row(row)
+
+async def aexport_chunks():
+    """
+    export_rows in lists of EXPORT_CHUNK_SIZE, each read in a thread. Under
+    ASGI a sync generator would be read to the end with sync_to_async(list)
+    before the first byte is sent. (values_list().aiterator() would run the
+    query in the event loop: ValuesListIterable executes it in __iter__.)
+    """
+    chunks = chunked(export_rows(), EXPORT_CHUNK_SIZE)
+    try:
+        while (rows := await sync_to_async(next)(chunks, None)) is not None:
+            yield rows
+    finally:
+        # close the server-side cursor in the thread that opened it
+        await sync_to_async(chunks.close)()
+
+class Echo:
+    """File-like object whose write() returns the value, for csv.writer."""
+    def write(self, value):
+        return value
+
+def ndjson_lines(rows):
+    return "".join(json.dumps(dict(zip(EXPORT_FIELDS, row))) + "\n" for row in rows)
+
+def csv_lines(writer, rows):
+    return "".join(writer.writerow(row) for row in rows)
+
+def export_ndjson():
+    for rows in chunked(export_rows(), EXPORT_CHUNK_SIZE):
+        yield ndjson_lines(rows)
+
+def export_csv():
+    writer = csv.writer(Echo())
+    yield writer.writerow(EXPORT_FIELDS)
+    for rows in chunked(export_rows(), EXPORT_CHUNK_SIZE):
+        yield csv_lines(writer, rows)
+
+async def aexport_ndjson():
+    async for rows in aexport_chunks():
+        yield ndjson_lines(rows)
+
+async def aexport_csv():
+    writer = csv.writer(Echo())
+    yield writer.writerow(EXPORT_FIELDS)
+    async for rows in aexport_chunks():
+        yield csv_lines(writer, rows)
+
+# format: (content type, WSGI generator, ASGI generator)
+EXPORT_FORMATS = {
+    "ndjson": ("application/x-ndjson", export_ndjson, aexport_ndjson),
+    "csv": ("text/csv", export_csv, aexport_csv),
+}
+
+@require_http_methods(["GET"])
+def weather_export(request):
+    """
+    Stream the whole Weather table as NDJSON (default) or CSV, from an async
+    generator under ASGI and a sync one under WSGI.
+    """
+    fmt = request.GET.get("format", "ndjson")
+    if fmt not in EXPORT_FORMATS:
+        return JsonResponse({"error": "format must be ndjson or csv"}, status=400)
+    content_type, export, aexport = EXPORT_FORMATS[fmt]
+    content = aexport() if isinstance(request, ASGIRequest) else export()
+    response = StreamingHttpResponse(content, content_type=content_type)
+    response["Content-Disposition"] = 'attachment; filename="weather.%s"' % fmt
+    return response
+
+@require_http_methods(["GET"])
+def weather_aggregates(request):
+    """
+    Global and per-weathercode min/max/mean of temperature and windspeed,
+    read from the aggregates the sync keeps up to date (weather.aggregates).
+    Answers 503 while they are unavailable or still being built.
+    """
+    try:
+        body = read_aggregates()
+    except RedisError:
+        return aggregates_unavailable("Aggregates are unavailable")
+    if body is None:
+        # first read since Redis was emptied: a worker builds the state, once
+        request_aggregates_rebuild()
+        return aggregates_unavailable("Aggregates are being built")
+    return JsonResponse(body)
+
+def aggregates_unavailable(detail):
+    response = JsonResponse({"detail": detail}, status=503)
+    response["Retry-After"] = "10"
+    return response
+
+FORECAST_DEFAULT_HOURS = 24
+FORECAST_MAX_HOURS = 16 * 24
+FORECAST_DEFAULT_LIMIT = 100
+FORECAST_MAX_CITIES = 1000
+
+def parse_forecast_params(request):
+    """
+    Validate the parameters of a forecast request.
+    Returns ((ids, limit, variables, start, hours, step, aggregate), error response or None).
+    """
+    try:
+        ids = [int(i) for i in request.GET.get("ids", "").split(",") if i]
+        limit = int(request.GET.get("limit", FORECAST_DEFAULT_LIMIT))
+        hours = int(request.GET.get("hours", FORECAST_DEFAULT_HOURS))
+        step = int(request.GET.get("step", 1))
+    except ValueError:
+        return None, JsonResponse({"error": "ids, limit, hours and step must be integers"}, status=400)
+    if limit <= 0 or hours <= 0 or step <= 0:
+        return None, JsonResponse({"error": "limit, hours and step must be greater than 0"}, status=400)
+    if len(ids) > FORECAST_MAX_CITIES:
+        return None, JsonResponse({"error": "at most %d ids" % FORECAST_MAX_CITIES}, status=400)
+    if hours > FORECAST_MAX_HOURS or hours % step:
+        return None, JsonResponse(
+            {"error": "hours must be a multiple of step, at most %d" % FORECAST_MAX_HOURS}, status=400,
+        )
+    limit = min(limit, FORECAST_MAX_CITIES)
+
+    aggregate = request.GET.get("agg", "mean")
+    if aggregate not in AGGREGATES:
+        return None, JsonResponse({"error": "agg must be one of %s" % ", ".join(AGGREGATES)}, status=400)
+    variables = list(filter(None, request.GET.get("variables", "").split(","))) or settings.WEATHER_HOURLY_VARIABLES
+    if set(variables) - set(settings.WEATHER_HOURLY_VARIABLES):
+        return None, JsonResponse(
+            {"error": "variables must be among %s" % ", ".join(settings.WEATHER_HOURLY_VARIABLES)}, status=400,
+        )
+
+    try:
+        start = parse_range_param(request, "start", timezone.now())
+    except ValueError:
+        return None, JsonResponse({"error": "start must be an ISO 8601 datetime"}, status=400)
+    # windows are aligned on the hourly forecast steps
+    start = start.replace(minute=0, second=0, microsecond=0)
+    return (ids, limit, variables, start, hours, step, aggregate), None
+
+def forecast_values(values):
+    """JSON lists of a (cities x buckets) array, NaN as null."""
+    return [[None if v != v else v for v in row] for row in values.astype(float).round(3).tolist()]
+
+@require_http_methods(["GET"])
+def weather_forecast(request):
+    """
+    Hourly forecast of many cities over one time window, optionally
+    downsampled to buckets of `step` hours (weather.forecast). Cities are
+    picked with ?ids=1,2,3, else the first `limit` by id.
+    """
+    params, error = parse_forecast_params(request)
+    if error:
+        return error
+    ids, limit, variables, start, hours, step, aggregate = params
+
+    qs = (
+        HourlyForecast.objects.select_related("weather")
+        .only("start", "hours", "variables", "data", "weather__city_name")
+        .order_by("weather_id")
+    )
+    forecasts = list(qs.filter(weather_id__in=ids) if ids else qs[:limit])
+    window = {
+        name: forecast_values(values)
+        for name, values in forecast_window(forecasts, variables, start, hours, step, aggregate).items()
+    }
+
+    return fast_json_response({
+        "start": start.isoformat(),
+        "step_hours": step,
+        "aggregate": aggregate,
+        "times": [(start + i * step * HOUR).isoformat() for i in range(hours // step)],
+        "variables": variables,
+        "results": [
+            {
+                "id": f.weather_id,
+                "city_name": f.weather.city_name,
+                **{name: window[name][i] for name in variables},
+            }
+            for i, f in enumerate(forecasts)
+        ],
+    })
+
+def parse_force(request):
+    return request.GET.get("force") in ("1", "true")
+
+def sync_started_response(task_id, started):
+    return JsonResponse({"task_id": task_id, "status": "started" if started else "in_progress"})
 
 @csrf_protect
 @require_http_methods(["POST"])
 def sync_weather(request):
-    task = sync_all_cities_task.delay()
-    return JsonResponse({"task_id": task.id, "status": "started"})
+    # concurrent triggers join the run already in flight
+    task_id, started = start_sync_all_cities(force=parse_force(request))
+    return sync_started_response(task_id, started)
 
+@require_http_methods(["GET"])
+def sync_status(request, run_id):
+    """Progress and totals of a sync run (the task_id returned by /api/sync/)."""
+    run = SyncRun.objects.filter(id=run_id).first()
+    if run is None:
+        # triggered, but the coordinator has not picked the run up yet
+        if in_flight_sync_run() == run_id:
+            return JsonResponse({"id": run_id, "status": "pending"})
+        return JsonResponse({"detail": "Not Found"}, status = 404)
+    return JsonResponse(sync_run_summary(run))
+
+
+@require_http_methods(["GET"])
+def metrics(request):
+    """Prometheus text exposition of the sync and API metrics."""
+    body, content_type = render_metrics()
+    return HttpResponse(body, content_type=content_type)
 
 @ensure_csrf_cookie
 @require_http_methods(["GET"])